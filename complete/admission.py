@@ -0,0 +1,223 @@
+"""アドミッション制御（リポジトリ呼び出しの同時実行数の制限と過負荷時の即時拒否）
+
+データベースが遅くなってもサーバーはリクエストを受け付け続けるため、そのまま通すと
+接続と問い合わせが増えてさらに遅くなる。リポジトリの呼び出しを読み取りと書き込みに分け、
+それぞれ同時に実行できる数（枠）を決めて、空きを待てる数とリクエストごとの期限を超えたら
+データベースに問い合わせずに OverloadedError で断る。アプリは 503 と Retry-After を返す。
+
+制限はプロセスごとにかかる（gunicornのワーカーが複数あれば、データベースへの同時実行数は
+ワーカー数 × 枠になる）。同じスレッドで枠を持ったまま呼んだメソッドは、新たに枠を取らない。
+"""
+import functools
+import inspect
+import math
+import threading
+import time
+from typing import Dict, Optional
+
+from config import config
+from metrics import registry
+
+ADMISSION_WAIT = registry.histogram(
+    'admission_wait_seconds', 'リポジトリ呼び出しが枠の空きを待った時間', ('budget',),
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+ADMISSION_REJECTED = registry.counter(
+    'admission_rejected_total', '枠の空きを待てずに断ったリポジトリ呼び出しの数（queue_full: 待ち行列が満杯, timeout: 期限切れ）',
+    ('budget', 'reason'))
+
+# 読み取りの枠で実行するメソッド。それ以外の公開メソッドは書き込みの枠で実行する
+READ_METHODS = {
+    'get_all', 'list_assets', 'iter_assets', 'get_by_id', 'get_by_ids', 'get_summary', 'search',
+    'get_changes', 'get_change_cursor', 'get_value_history', 'get_job', 'list_jobs',
+    'iter_analytics_rows', 'verify_category_totals', 'has_assets', 'get_schema_version', 'get_category_totals',
+    'list_portfolios', 'explain',
+}
+# 制限の対象外（コンテキストマネージャを返すもの、統計、データベースに問い合わせない集計、後片付け）
+UNLIMITED_METHODS = {'get_connection', 'get_read_connection', 'get_pool_stats', 'shared_version', 'summarize', 'close'}
+
+_local = threading.local()
+
+
+class OverloadedError(Exception):
+    """枠の空きを待てずにリポジトリ呼び出しを断った"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def get_deadline() -> Optional[float]:
+    return getattr(_local, 'deadline', None)
+
+
+def set_deadline(deadline: Optional[float]):
+    """このスレッドで行うリポジトリ呼び出しが枠の空きを待てる期限（time.monotonic() の値）を設定する
+
+    None ならリクエストの外（バックグラウンドジョブや manage.py）とみなし、期限も待ち行列の上限もなく待つ。
+    """
+    _local.deadline = deadline
+
+
+class _Held:
+    """スレッドが持っている枠の数（同じスレッドからの入れ子の呼び出しで枠を取り直さないため）"""
+
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+
+def _held() -> _Held:
+    held = getattr(_local, 'held', None)
+    if held is None:
+        held = _local.held = _Held()
+    return held
+
+
+class Budget:
+    """同時に実行できる数と、空きを待てる数に上限のある枠"""
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self.in_use = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def acquire(self, deadline: Optional[float]):
+        """枠を1つ取る。取れなければ OverloadedError を送出する"""
+        with self._lock:
+            if self.in_use < self.limit and not self.waiting:
+                self.in_use += 1
+                self.admitted += 1
+                return
+            if deadline is not None and self.waiting >= self.max_queue:
+                self._reject('queue_full')
+            self.waiting += 1
+            started = time.monotonic()
+            try:
+                while self.in_use >= self.limit:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._reject('timeout')
+                    self._available.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_use += 1
+            self.admitted += 1
+        ADMISSION_WAIT.observe(time.monotonic() - started, self.name)
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        ADMISSION_REJECTED.inc(self.name, reason)
+        raise OverloadedError('サーバーが混み合っています。しばらくしてから再試行してください',
+                              config.ADMISSION_RETRY_AFTER)
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+            self._available.notify()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'limit': self.limit, 'max_queue': self.max_queue, 'in_use': self.in_use,
+                    'waiting': self.waiting, 'admitted': self.admitted, 'rejected': self.rejected}
+
+
+class _AdmittedIterator:
+    """ジェネレータを返すメソッドは、読み終えるか閉じられるまで枠を持ち続ける"""
+
+    def __init__(self, iterator, release):
+        self._iterator = iterator
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._release is None:
+            raise StopIteration
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            try:
+                self._iterator.close()
+            finally:
+                release()
+
+    def __del__(self):
+        self.close()
+
+
+class AdmissionControlledRepository:
+    """AssetRepository の公開メソッドを、読み取り・書き込みそれぞれの枠の中で実行するラッパー"""
+
+    def __init__(self, repository, read: Budget, write: Budget):
+        object.__setattr__(self, '_repository', repository)
+        object.__setattr__(self, 'budgets', {'read': read, 'write': write})
+
+    @classmethod
+    def from_config(cls, repository) -> 'AdmissionControlledRepository':
+        return cls(repository,
+                   Budget('read', config.ADMISSION_READ_LIMIT, config.ADMISSION_READ_QUEUE),
+                   Budget('write', config.ADMISSION_WRITE_LIMIT, config.ADMISSION_WRITE_QUEUE))
+
+    def __getattr__(self, name):
+        attr = getattr(self._repository, name)
+        if name.startswith('_') or name in UNLIMITED_METHODS or not callable(attr):
+            return attr
+        budget = self.budgets['read' if name in READ_METHODS else 'write']
+        return functools.partial(self._call, budget, attr)
+
+    def __setattr__(self, name, value):
+        setattr(self._repository, name, value)
+
+    def get_admission_stats(self) -> Dict:
+        return {name: budget.stats() for name, budget in self.budgets.items()}
+
+    @staticmethod
+    def _call(budget: Budget, method, *args, **kwargs):
+        held = _held()
+        if held.count:
+            return method(*args, **kwargs)
+        budget.acquire(get_deadline())
+        held.count += 1
+
+        def release():
+            held.count -= 1
+            budget.release()
+        try:
+            result = method(*args, **kwargs)
+        except BaseException:
+            release()
+            raise
+        if inspect.isgenerator(result):
+            return _AdmittedIterator(result, release)
+        release()
+        return result
+
+
+def retry_after_header(error: OverloadedError) -> str:
+    return str(max(1, math.ceil(error.retry_after)))
+
+
+def init_app(app):
+    """リクエストごとに、枠の空きを待てる期限（受け付けから ADMISSION_TIMEOUT 秒）を設定する"""
+
+    @app.before_request
+    def _set_admission_deadline():
+        set_deadline(time.monotonic() + config.ADMISSION_TIMEOUT)
+
+    @app.teardown_request
+    def _clear_admission_deadline(exc):
+        set_deadline(None)
@@ -0,0 +1,381 @@
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from database import ChangeLogExpiredError
+
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90, 95, 99)
+
+
+class AssetSnapshot:
+    """assets テーブルの分析用スナップショット（列指向）
+
+    id・金額・数量の各列をNumPy配列で、カテゴリと通貨を辞書符号化した整数列で保持する。
+    1行あたりのメモリは約33バイト（int64 + float64 + int64 + int32 + int32 + bool）。
+    金額を整数（補助通貨単位）で保存している場合は金額の列も int64 とし、評価額を整数のまま計算する。
+    数値として読めない金額・NaN・無限大の行は削除された行と同じく無効にして集計から除き、id を invalid_amounts に挙げる。
+    配列は id の昇順に並べ、書き込みは変更ログ（/api/assets/changes と同じもの）から差分で反映する。
+    """
+
+    def __init__(self, repository, max_age: float = 5.0, batch_size: int = 5000, full_reload_lag: int = 50000):
+        self.repository = repository
+        # 他のプロセスの書き込みを拾うため、データバージョンが変わらなくても max_age 秒ごとに変更ログを確認する
+        self.max_age = max_age
+        self.batch_size = batch_size
+        # 変更ログがこれ以上たまっていたら、差分ではなく全件を読み直す
+        self.full_reload_lag = full_reload_lag
+        self.money = repository.money
+        self._amount = int if repository.money.minor else float
+        self._amount_dtype = np.int64 if repository.money.minor else np.float64
+        self._lock = threading.Lock()
+        self._ids = np.empty(0, dtype=np.int64)
+        self._amounts = np.empty(0, dtype=self._amount_dtype)
+        self._quantities = np.empty(0, dtype=np.int64)
+        self._codes = np.empty(0, dtype=np.int32)
+        self._currency_codes = np.empty(0, dtype=np.int32)
+        self._valid = np.empty(0, dtype=bool)
+        # 金額が数値として読めないため除いている行の id
+        self._invalid_amounts = set()
+        self._size = 0
+        self._dead = 0
+        self.categories: List[Optional[str]] = []
+        self._category_codes: Dict[Optional[str], int] = {}
+        self.currencies: List[str] = []
+        self._currency_index: Dict[str, int] = {}
+        self._cursor = None
+        self._version = None
+        self._synced_at = 0.0
+        self.full_loads = 0
+        self.incremental_syncs = 0
+        self.last_sync_seconds = 0.0
+
+    def columns(self, factors: Optional[Dict] = None, currency: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """最新の状態に同期したうえで、有効な行だけの列のコピーを返す
+
+        factors（通貨ごとの報告通貨 currency への係数）を渡すと、評価額の列を報告通貨に換算する。換算は通貨ごとの係数の
+        配列を通貨の列で引いて掛ける1回の演算で行い、レートの無い通貨の行は除いて unconverted_currencies に挙げる。
+        """
+        with self._lock:
+            self._sync()
+            valid = self._valid[:self._size]
+            currencies = list(self.currencies)
+            columns = {
+                'id': self._ids[:self._size][valid],
+                'amount': self._amounts[:self._size][valid],
+                'quantity': self._quantities[:self._size][valid],
+                'category': self._codes[:self._size][valid],
+                'currency': self._currency_codes[:self._size][valid],
+                'categories': list(self.categories),
+                'currencies': currencies,
+                # 評価額の列を表示用の値にするための除数（報告通貨の補助通貨単位。整数で保存していなければ1）
+                'divisor': self.money.divisor_of(currency),
+                # 通貨ごとの金額の列を表示用の値にするための除数（currencies と同じ並び）
+                'amount_divisors': [self.money.divisor_of(code) for code in currencies],
+                'unconverted_currencies': [],
+                'invalid_amounts': sorted(self._invalid_amounts),
+            }
+        values = columns['amount'] * columns['quantity']
+        if factors is not None:
+            rates = np.array([float(factors[code]) if code in factors else np.nan for code in currencies],
+                             dtype=np.float64)
+            values = values * rates[columns['currency']]
+            converted = ~np.isnan(values)
+            if not converted.all():
+                present = np.bincount(columns['currency'], minlength=len(currencies)) > 0
+                columns['unconverted_currencies'] = sorted(
+                    code for i, code in enumerate(currencies) if present[i] and np.isnan(rates[i]))
+                for name in ('id', 'amount', 'quantity', 'category', 'currency'):
+                    columns[name] = columns[name][converted]
+                values = values[converted]
+            if self._amount is int:
+                # 整数（補助通貨単位）で保存している場合は、換算後の評価額も整数に丸める
+                values = np.rint(values).astype(np.int64)
+        columns['value'] = values
+        return columns
+
+    def stats(self) -> Dict:
+        with self._lock:
+            nbytes = sum(column.nbytes for column in (self._ids, self._amounts, self._quantities, self._codes,
+                                                      self._currency_codes, self._valid))
+            rows = self._size - self._dead
+            return {
+                'rows': rows,
+                'capacity': len(self._ids),
+                'bytes': nbytes,
+                'bytes_per_row': round(nbytes / rows, 1) if rows else None,
+                'categories': len(self.categories),
+                'currencies': len(self.currencies),
+                'invalid_amounts': len(self._invalid_amounts),
+                'cursor': self._cursor,
+                'full_loads': self.full_loads,
+                'incremental_syncs': self.incremental_syncs,
+                'last_sync_seconds': round(self.last_sync_seconds, 4),
+            }
+
+    def _sync(self):
+        version = self.repository.data_version.current
+        now = time.monotonic()
+        if self._cursor is not None and version == self._version and now - self._synced_at < self.max_age:
+            return
+        started = time.perf_counter()
+        if self._cursor is None or self.repository.get_change_cursor() - self._cursor > self.full_reload_lag:
+            self._load()
+        else:
+            try:
+                while True:
+                    result = self.repository.get_changes(self._cursor, self.batch_size)
+                    self._apply(result['changes'])
+                    self._cursor = result['cursor']
+                    if not result['has_more']:
+                        break
+                self.incremental_syncs += 1
+            except ChangeLogExpiredError:
+                self._load()
+        self._version = version
+        self._synced_at = now
+        self.last_sync_seconds = time.perf_counter() - started
+
+    def _load(self):
+        # 読み込み中の書き込みは、先に取得したカーソルからの差分として次回反映される
+        cursor = self.repository.get_change_cursor()
+        self.categories = []
+        self._category_codes = {}
+        self.currencies = []
+        self._currency_index = {}
+        ids, amounts, valid, quantities, codes, currency_codes = [], [], [], [], [], []
+        for batch in self.repository.iter_analytics_rows(self.batch_size):
+            ids.append(np.fromiter((row[0] for row in batch), dtype=np.int64, count=len(batch)))
+            parsed = [self._parse_amount(row[1]) for row in batch]
+            amounts.append(np.fromiter((0 if amount is None else amount for amount in parsed), dtype=self._amount_dtype,
+                                       count=len(batch)))
+            valid.append(np.fromiter((amount is not None for amount in parsed), dtype=bool, count=len(batch)))
+            quantities.append(np.fromiter((row[2] for row in batch), dtype=np.int64, count=len(batch)))
+            codes.append(np.fromiter((self._code(row[3]) for row in batch), dtype=np.int32, count=len(batch)))
+            currency_codes.append(np.fromiter((self._currency_code(row[4]) for row in batch), dtype=np.int32,
+                                              count=len(batch)))
+        self._ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+        self._amounts = np.concatenate(amounts) if amounts else np.empty(0, dtype=self._amount_dtype)
+        self._quantities = np.concatenate(quantities) if quantities else np.empty(0, dtype=np.int64)
+        self._codes = np.concatenate(codes) if codes else np.empty(0, dtype=np.int32)
+        self._currency_codes = np.concatenate(currency_codes) if currency_codes else np.empty(0, dtype=np.int32)
+        self._size = len(self._ids)
+        self._valid = np.concatenate(valid) if valid else np.empty(0, dtype=bool)
+        self._dead = int((~self._valid).sum())
+        self._invalid_amounts = set(self._ids[~self._valid].tolist())
+        self._cursor = cursor
+        self.full_loads += 1
+
+    def _parse_amount(self, value):
+        """保存されている金額を列の値にする（数値として読めない値・NaN・無限大は None）"""
+        try:
+            amount = self._amount(value)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        return amount if self._amount is int or math.isfinite(amount) else None
+
+    def _code(self, category: Optional[str]) -> int:
+        code = self._category_codes.get(category)
+        if code is None:
+            code = self._category_codes[category] = len(self.categories)
+            self.categories.append(category)
+        return code
+
+    def _currency_code(self, currency: str) -> int:
+        currency = currency.strip()
+        code = self._currency_index.get(currency)
+        if code is None:
+            code = self._currency_index[currency] = len(self.currencies)
+            self.currencies.append(currency)
+        return code
+
+    def _apply(self, changes: List[Dict]):
+        if not changes:
+            return
+        deleted = np.array([change['id'] for change in changes if change['op'] == 'delete'], dtype=np.int64)
+        upserts = [change['asset'] for change in changes if change['op'] != 'delete']
+        if len(deleted):
+            self._invalid_amounts.difference_update(deleted.tolist())
+            positions = self._find(deleted)
+            positions = positions[positions >= 0]
+            positions = positions[self._valid[positions]]
+            self._valid[positions] = False
+            self._dead += len(positions)
+        if upserts:
+            ids = np.array([asset['id'] for asset in upserts], dtype=np.int64)
+            parsed = [self._parse_amount(asset['amount']) for asset in upserts]
+            amounts = np.array([0 if amount is None else amount for amount in parsed], dtype=self._amount_dtype)
+            valid = np.array([amount is not None for amount in parsed], dtype=bool)
+            self._invalid_amounts.difference_update(ids.tolist())
+            self._invalid_amounts.update(ids[~valid].tolist())
+            quantities = np.array([asset['quantity'] for asset in upserts], dtype=np.int64)
+            codes = np.array([self._code(asset['category']) for asset in upserts], dtype=np.int32)
+            currency_codes = np.array([self._currency_code(asset['currency']) for asset in upserts], dtype=np.int32)
+            positions = self._find(ids)
+            existing = positions >= 0
+            if existing.any():
+                at = positions[existing]
+                self._dead += int((~valid[existing]).sum()) - int((~self._valid[at]).sum())
+                self._amounts[at] = amounts[existing]
+                self._quantities[at] = quantities[existing]
+                self._codes[at] = codes[existing]
+                self._currency_codes[at] = currency_codes[existing]
+                self._valid[at] = valid[existing]
+            new = ~existing
+            if new.any():
+                self._dead += int((~valid[new]).sum())
+                self._append(ids[new], amounts[new], quantities[new], codes[new], currency_codes[new], valid[new])
+        if self._dead > max(1024, self._size // 4):
+            self._compact()
+
+    def _find(self, ids: np.ndarray) -> np.ndarray:
+        """id の位置を返す（見つからない id は -1）"""
+        current = self._ids[:self._size]
+        positions = np.searchsorted(current, ids)
+        clipped = np.minimum(positions, max(self._size - 1, 0))
+        found = (positions < self._size) & (current[clipped] == ids) if self._size else np.zeros(len(ids), dtype=bool)
+        return np.where(found, positions, -1)
+
+    def _append(self, ids, amounts, quantities, codes, currency_codes, valid):
+        order = np.argsort(ids, kind='stable')
+        ids, amounts, quantities, codes = ids[order], amounts[order], quantities[order], codes[order]
+        currency_codes, valid = currency_codes[order], valid[order]
+        if self._size and ids[0] <= self._ids[self._size - 1]:
+            # 採番順とコミット順がずれた場合など、末尾以外への挿入はまとめて並べ直す
+            size = self._size
+            merged_ids = np.concatenate([self._ids[:size], ids])
+            order = np.argsort(merged_ids, kind='stable')
+            self._ids = merged_ids[order]
+            self._amounts = np.concatenate([self._amounts[:size], amounts])[order]
+            self._quantities = np.concatenate([self._quantities[:size], quantities])[order]
+            self._codes = np.concatenate([self._codes[:size], codes])[order]
+            self._currency_codes = np.concatenate([self._currency_codes[:size], currency_codes])[order]
+            self._valid = np.concatenate([self._valid[:size], valid])[order]
+            self._size = len(self._ids)
+            return
+        needed = self._size + len(ids)
+        if needed > len(self._ids):
+            capacity = max(needed, int(len(self._ids) * 1.5), 1024)
+            self._ids = self._grow(self._ids, capacity)
+            self._amounts = self._grow(self._amounts, capacity)
+            self._quantities = self._grow(self._quantities, capacity)
+            self._codes = self._grow(self._codes, capacity)
+            self._currency_codes = self._grow(self._currency_codes, capacity)
+            self._valid = self._grow(self._valid, capacity)
+        self._ids[self._size:needed] = ids
+        self._amounts[self._size:needed] = amounts
+        self._quantities[self._size:needed] = quantities
+        self._codes[self._size:needed] = codes
+        self._currency_codes[self._size:needed] = currency_codes
+        self._valid[self._size:needed] = valid
+        self._size = needed
+
+    def _grow(self, column: np.ndarray, capacity: int) -> np.ndarray:
+        grown = np.empty(capacity, dtype=column.dtype)
+        grown[:self._size] = column[:self._size]
+        return grown
+
+    def _compact(self):
+        keep = self._valid[:self._size]
+        self._ids = self._ids[:self._size][keep]
+        self._amounts = self._amounts[:self._size][keep]
+        self._quantities = self._quantities[:self._size][keep]
+        self._codes = self._codes[:self._size][keep]
+        self._currency_codes = self._currency_codes[:self._size][keep]
+        self._size = len(self._ids)
+        self._valid = np.ones(self._size, dtype=bool)
+        self._dead = 0
+
+
+def finite(value: float) -> Optional[float]:
+    """NaN・無限大（JSONとして不正な値）を None にする（評価額の合計が float の範囲を超えた場合など）"""
+    return value if math.isfinite(value) else None
+
+
+def category_breakdown(columns: Dict) -> List[Dict]:
+    """カテゴリ別の件数・評価額・構成比（評価額の降順）"""
+    categories = columns['categories']
+    divisor = columns['divisor']
+    totals = np.bincount(columns['category'], weights=columns['value'], minlength=len(categories))
+    counts = np.bincount(columns['category'], minlength=len(categories))
+    grand_total = totals.sum()
+    order = np.argsort(-totals, kind='stable')
+    return [
+        {
+            'category': categories[i],
+            'count': int(counts[i]),
+            'total': finite(float(totals[i]) / divisor),
+            'share': finite(float(totals[i] / grand_total)) if grand_total else 0.0,
+        }
+        for i in order if counts[i]
+    ]
+
+
+def top_holdings(columns: Dict, n: int, category: Optional[str] = None) -> List[Dict]:
+    """評価額（金額×数量）の上位 n 件"""
+    values = columns['value']
+    divisor = columns['divisor']
+    indexes = np.arange(len(values))
+    if category is not None:
+        if category not in columns['categories']:
+            return []
+        indexes = indexes[columns['category'] == columns['categories'].index(category)]
+    if n < len(indexes):
+        # 全体を並べ替えず、上位 n 件だけを取り出してから並べる
+        indexes = indexes[np.argpartition(-values[indexes], n - 1)[:n]]
+    indexes = indexes[np.argsort(-values[indexes], kind='stable')]
+    grand_total = values.sum()
+    return [
+        {
+            'id': int(columns['id'][i]),
+            'category': columns['categories'][columns['category'][i]],
+            'currency': columns['currencies'][columns['currency'][i]],
+            'amount': finite(float(columns['amount'][i]) / columns['amount_divisors'][columns['currency'][i]]),
+            'quantity': int(columns['quantity'][i]),
+            'value': finite(float(values[i]) / divisor),
+            'share': finite(float(values[i] / grand_total)) if grand_total else 0.0,
+        }
+        for i in indexes
+    ]
+
+
+def distribution(columns: Dict, percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> Dict:
+    """評価額の分布（パーセンタイル・平均・標準偏差）"""
+    values = columns['value']
+    divisor = columns['divisor']
+    if not len(values):
+        return {'count': 0, 'percentiles': {}, 'min': None, 'max': None, 'mean': None, 'std': None}
+    points = np.percentile(values, percentiles)
+    return {
+        'count': int(len(values)),
+        'percentiles': {f'p{p:g}': finite(float(v) / divisor) for p, v in zip(percentiles, points)},
+        'min': finite(float(values.min()) / divisor),
+        'max': finite(float(values.max()) / divisor),
+        'mean': finite(float(values.mean()) / divisor),
+        'std': finite(float(values.std()) / divisor),
+    }
+
+
+def concentration(columns: Dict, top: Sequence[int] = (1, 5, 10)) -> Dict:
+    """集中度の指標（上位N件の構成比、HHI、ジニ係数）"""
+    # 比率だけを求めるため、整数の評価額も浮動小数点で扱う（順位との積が int64 を超えないように）
+    values = columns['value'].astype(np.float64, copy=False)
+    total = values.sum()
+    if not len(values) or not total > 0 or not math.isfinite(total):
+        return {'top_shares': {}, 'hhi': None, 'category_hhi': None, 'gini': None}
+    shares = values / total
+    category_totals = np.bincount(columns['category'], weights=values, minlength=len(columns['categories']))
+    descending = np.sort(values)[::-1]
+    cumulative = np.cumsum(descending)
+    # ジニ係数は昇順に並べた値から求める
+    ascending = descending[::-1]
+    n = len(ascending)
+    gini = float((2 * np.sum(np.arange(1, n + 1) * ascending) / (n * total)) - (n + 1) / n)
+    return {
+        'top_shares': {f'top{k}': finite(float(cumulative[min(k, n) - 1] / total)) for k in top},
+        'hhi': finite(float(np.sum(shares ** 2))),
+        'category_hhi': finite(float(np.sum((category_totals / total) ** 2))),
+        'gini': finite(gini),
+    }
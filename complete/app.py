@@ -1,8 +1,110 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, send_file, url_for
 from flask_cors import CORS
 from config import config
-from database import repository
+from database import (repository, encode_cursor, decode_cursor, parse_search_terms, UPDATABLE_FIELDS,
+                      VALUE_ROLLUP_TABLES, ChangeLogExpiredError)
+from streaming import STREAM_FORMATS
+from cache import ResponseCache
+from bulk import READERS, bulk_import
+from jobs import JobManager, JobQueueFullError
+from metrics import registry
+from admission import OverloadedError, retry_after_header
+from fx import FxTable, normalize_currency
+from sharding import (DEFAULT_PORTFOLIO, PortfolioNotFoundError, ShardedRepository, current_portfolio,
+                      normalize_portfolio_id, set_portfolio, summarize_portfolios)
+import admission
+import instrumentation
+import static_assets
+from datetime import date, datetime
+import io
 import os
+import time
+
+def _parse_number(value, name):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f'{name} は数値で指定してください')
+
+def _parse_datetime(value, name):
+    if value is None or value == '':
+        return None
+    try:
+        return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise ValueError(f'{name} はISO 8601形式（例: 2024-01-01）で指定してください')
+
+def _parse_date(value, name):
+    if value is None or value == '':
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} は日付（例: 2024-01-01）で指定してください')
+
+def parse_asset_filters(args, money):
+    """クエリ文字列から一覧の絞り込み条件を取り出す（金額は表示用の値のまま。保存形式の桁数にはSQLで合わせる）"""
+    return {
+        'category': args.get('category') or None,
+        'min_amount': _parse_number(args.get('min_amount'), 'min_amount'),
+        'max_amount': _parse_number(args.get('max_amount'), 'max_amount'),
+        'created_from': _parse_datetime(args.get('created_from'), 'created_from'),
+        'created_to': _parse_datetime(args.get('created_to'), 'created_to'),
+    }
+
+PAGINATION_PARAMS = ('limit', 'cursor', 'category', 'min_amount', 'max_amount', 'created_from', 'created_to')
+
+def parse_page_args(args, money):
+    """一覧の1ページ分の指定を (limit, cursor, 絞り込み条件) で返す（不正な値は ValueError）"""
+    limit = args.get('limit', config.PAGE_SIZE_DEFAULT)
+    if not str(limit).isdigit() or not 1 <= int(limit) <= config.PAGE_SIZE_MAX:
+        raise ValueError(f'limit は1〜{config.PAGE_SIZE_MAX}で指定してください')
+    cursor = args.get('cursor')
+    return int(limit), decode_cursor(cursor) if cursor else None, parse_asset_filters(args, money)
+
+def build_page(assets, limit, money, currency=None, rates=None):
+    """1件多く取得した一覧から1ページ分の応答を作る（余分の1件で次ページの有無を判定する）"""
+    next_cursor = encode_cursor(assets[limit - 1]) if len(assets) > limit else None
+    page = {'items': money.present_assets(assets[:limit], currency), 'next_cursor': next_cursor}
+    if rates is not None:
+        page['currency'], page['fx'] = currency, rates.describe()
+    return page
+
+def resolve_currency(args, rates, money):
+    """currency（報告通貨、省略時は既定の通貨）を解釈し、(通貨, レート表, 係数) を返す（不正な値は ValueError）"""
+    currency = normalize_currency(args['currency']) if args.get('currency') else money.default_currency
+    # 係数は保存している値（各通貨の補助通貨単位）から報告通貨の保存形式の値への係数にしておく
+    return currency, rates, money.storage_factors(rates.factors(currency), currency)
+
+def amount_to_storage(data, money, current=()):
+    """書き込む内容の amount を保存形式の値にする（不正な値は ValueError。currency は検証済みであること）
+
+    整数で保存している場合、桁数は資産の通貨で決まる。currency を指定しない更新は current（更新する資産）の
+    通貨の桁数で変換し、資産が1つの通貨だけなら金額と一緒にその通貨も書き込む（読んでから書くまでに
+    通貨が変わっても、金額の桁数がずれないように）。
+    """
+    if not money.minor:
+        if 'amount' in data:
+            data['amount'] = money.to_storage(data['amount'])
+        return
+    currencies = {asset['currency'].strip() for asset in current} or {money.default_currency}
+    if data.get('currency'):
+        if 'amount' not in data:
+            if any(money.scale_of(code) != money.scale_of(data['currency']) for code in currencies):
+                raise ValueError('小数点以下の桁数が異なる通貨に変更する場合は amount も指定してください')
+            return
+        data['amount'] = money.to_storage(data['amount'], data['currency'])
+        return
+    if 'amount' not in data:
+        return
+    if len({money.scale_of(code) for code in currencies}) > 1:
+        raise ValueError('小数点以下の桁数が異なる通貨の資産の金額をまとめて変更する場合は currency も指定してください')
+    code = min(currencies)
+    data['amount'] = money.to_storage(data['amount'], code)
+    if current and len(currencies) == 1:
+        data['currency'] = code
 
 def create_app():
     app = Flask(__name__)
@@ -11,17 +113,190 @@ def create_app():
     from database import init_db
     init_db()
 
+    response_cache = ResponseCache(config.RESPONSE_CACHE_SIZE)
+    # 金額の保存形式。リポジトリは保存形式の値を返し、表示用の値への変換は応答を作る直前に行う
+    # （ポートフォリオごとにデータベースを分けていても、保存形式はすべて default と同じ）
+    money = repository.money
+    sharded = isinstance(repository.get(), ShardedRepository)
+    instrumentation.init_app(app)
+    admission.init_app(app)
+    static_assets.init_app(app)
+    # HTMLはスクリプトのルート（静的ファイルのURLが変わる）ごとに1回だけ描画する
+    index_page = static_assets.PageCache(lambda: render_template('index.html'))
+    jobs = JobManager(repository, config.JOB_ARTIFACT_DIR, config.JOB_WORKERS, config.JOB_MAX_QUEUED,
+                      parse_filters=lambda params: parse_asset_filters(params, money))
+    # 為替レート表。ファイルが更新されると次に参照したときに読み直す
+    fx_table = FxTable(config.FX_RATES_FILE, money.default_currency)
+
+    def reporting_currency(args):
+        return resolve_currency(args, fx_table.current(), money)
+
+    def collect_runtime_stats():
+        pool = repository.get_pool_stats()
+        cache = response_cache.stats()
+        yield 'db_pool_size', 'gauge', 'プール内の接続数', pool['size']
+        yield 'db_pool_in_use', 'gauge', '使用中の接続数', pool['in_use']
+        yield 'db_pool_idle', 'gauge', 'アイドル状態の接続数', pool['idle']
+        yield 'db_pool_waits_total', 'counter', '接続の空きを待った回数', pool['waits']
+        yield 'db_pool_wait_seconds_total', 'counter', '接続の空きを待った合計時間', pool['wait_time_total']
+        yield 'db_pool_timeouts_total', 'counter', '接続の取得がタイムアウトした回数', pool['timeouts']
+        yield 'db_pool_created_total', 'counter', '新規に確立した接続の数', pool['created']
+        if 'read' in pool:
+            yield 'db_read_pool_size', 'gauge', '読み取り用のプール内の接続数', pool['read']['size']
+            yield 'db_read_pool_in_use', 'gauge', '読み取り用の使用中の接続数', pool['read']['in_use']
+            yield 'db_read_pool_waits_total', 'counter', '読み取り用の接続の空きを待った回数', pool['read']['waits']
+        yield 'response_cache_entries', 'gauge', '応答キャッシュのエントリ数', cache['entries']
+        yield 'response_cache_hits_total', 'counter', '応答キャッシュのヒット数', cache['hits']
+        yield 'response_cache_misses_total', 'counter', '応答キャッシュのミス数', cache['misses']
+        yield 'data_version', 'gauge', '現在のデータバージョン', repository.data_version.current
+        get_admission_stats = getattr(repository, 'get_admission_stats', None)
+        if get_admission_stats is not None:
+            for name, budget in get_admission_stats().items():
+                yield f'admission_{name}_in_flight', 'gauge', f'実行中のリポジトリ呼び出しの数（{name}）', budget['in_use']
+                yield f'admission_{name}_queue_depth', 'gauge', f'枠の空きを待っているリポジトリ呼び出しの数（{name}）', budget['waiting']
+                yield f'admission_{name}_limit', 'gauge', f'同時に実行できるリポジトリ呼び出しの数（{name}）', budget['limit']
+        if sharded:
+            yield 'db_shards_open', 'gauge', '開いているポートフォリオのデータベースの数', repository.get_shard_count()
+    registry.register_collector('runtime', collect_runtime_stats)
+
+    @app.before_request
+    def select_portfolio():
+        """portfolio_id（省略時は default）で、このリクエストで扱うポートフォリオを選ぶ"""
+        try:
+            portfolio_id = normalize_portfolio_id(request.args.get('portfolio_id') or DEFAULT_PORTFOLIO)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if portfolio_id != DEFAULT_PORTFOLIO:
+            try:
+                if not sharded:
+                    raise PortfolioNotFoundError(f'ポートフォリオ {portfolio_id} が見つかりません')
+                repository.shard(portfolio_id)
+            except PortfolioNotFoundError as e:
+                return jsonify({'error': str(e)}), 404
+        set_portfolio(portfolio_id)
+
+    @app.teardown_request
+    def _reset_portfolio(exc):
+        set_portfolio(None)
+
+    def overloaded_response(error):
+        response = jsonify({'error': str(error)})
+        response.status_code = 503
+        response.headers['Retry-After'] = retry_after_header(error)
+        return response
+
+    def error_response(error):
+        """ルートで捕まえた例外の応答（混み合っているときは503、それ以外は500）"""
+        if isinstance(error, OverloadedError):
+            return overloaded_response(error)
+        return jsonify({'error': str(error)}), 500
+
+    def versioned_json(build, rates=None):
+        """データバージョンをETagにしてJSONを返す
+
+        If-None-Match が一致すれば304を、同じバージョンで生成済みの応答があればそれを返し、
+        どちらの場合もデータベースには問い合わせない。為替レートで換算した応答は rates を渡し、
+        レート表のバージョンもキャッシュのキーとETagに含める。
+        """
+        version = repository.data_version.current
+        etag = repository.data_version.etag(version)
+        if rates is not None:
+            version = (version, rates.version)
+            etag = f'{etag}-{rates.version}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            key = request.full_path
+            body = response_cache.get(key, version)
+            if body is None:
+                payload = build()
+                started = time.perf_counter()
+                body = app.json.response(payload).get_data()
+                instrumentation.SERIALIZE_DURATION.observe(time.perf_counter() - started, request.url_rule.rule)
+                response_cache.set(key, version, body)
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
     @app.route('/')
     def index():
-        return render_template('index.html')
+        return index_page.response(request.script_root)
+
+    def stream_assets(fmt, filters, currency=None, factors=None):
+        encoder, mimetype = STREAM_FORMATS[fmt]
+        assets = repository.iter_assets(filters, factors=factors)
+        return Response(encoder(money.present_asset(asset, currency) for asset in assets), mimetype=mimetype)
+
+    def listing_currency(args):
+        # 一覧は currency を指定したときだけ、報告通貨での評価額（value）を付ける
+        return reporting_currency(args) if args.get('currency') else (None, None, None)
 
     @app.route('/api/assets', methods=['GET'])
     def get_assets():
         try:
-            assets = repository.get_all()
-            return jsonify(assets), 200
+            stream = request.args.get('stream')
+            if stream:
+                if stream not in STREAM_FORMATS:
+                    return jsonify({'error': 'stream は ndjson または json を指定してください'}), 400
+                try:
+                    filters = parse_asset_filters(request.args, money)
+                    currency, _, factors = listing_currency(request.args)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+                return stream_assets(stream, filters, currency, factors)
+            try:
+                currency, rates, factors = listing_currency(request.args)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if config.ASSETS_UNPAGINATED and not any(key in request.args for key in PAGINATION_PARAMS):
+                return versioned_json(lambda: money.present_assets(repository.get_all(factors), currency), rates)
+            try:
+                limit, cursor, filters = parse_page_args(request.args, money)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return versioned_json(lambda: build_page(repository.list_assets(limit + 1, cursor, filters, factors),
+                                                     limit, money, currency, rates), rates)
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/assets/search', methods=['GET'])
+    def search_assets():
+        """名前・説明・カテゴリの全文検索（部分一致、関連度順）"""
+        query = request.args.get('q', '')
+        if len(query) > config.SEARCH_QUERY_MAX_LENGTH:
+            return jsonify({'error': f'q は{config.SEARCH_QUERY_MAX_LENGTH}文字以内で指定してください'}), 400
+        terms = parse_search_terms(query)
+        if not terms:
+            return jsonify({'error': 'q に検索語を指定してください'}), 400
+        limit = request.args.get('limit', config.PAGE_SIZE_DEFAULT)
+        offset = request.args.get('offset', 0)
+        if not str(limit).isdigit() or not 1 <= int(limit) <= config.PAGE_SIZE_MAX:
+            return jsonify({'error': f'limit は1〜{config.PAGE_SIZE_MAX}で指定してください'}), 400
+        if not str(offset).isdigit() or int(offset) >= config.SEARCH_MAX_CANDIDATES:
+            return jsonify({'error': f'offset は0〜{config.SEARCH_MAX_CANDIDATES - 1}で指定してください'}), 400
+        def build():
+            result = repository.search(terms, int(limit), int(offset))
+            money.present_assets(result['items'])
+            return result
+        try:
+            return versioned_json(build)
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return error_response(e)
+
+    @app.route('/api/assets/export', methods=['GET'])
+    def export_assets():
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in STREAM_FORMATS:
+            return jsonify({'error': 'format は ndjson または json を指定してください'}), 400
+        try:
+            filters = parse_asset_filters(request.args, money)
+            currency, _, factors = listing_currency(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        response = stream_assets(fmt, filters, currency, factors)
+        response.headers['Content-Disposition'] = f'attachment; filename=assets.{fmt}'
+        return response
 
     @app.route('/api/assets', methods=['POST'])
     def create_asset():
@@ -29,21 +304,95 @@ def create_app():
             data = request.get_json()
             if not data.get('name') or not data.get('amount') or not data.get('category'):
                 return jsonify({'error': '必須項目が不足しています'}), 400
+            try:
+                if data.get('currency'):
+                    data['currency'] = normalize_currency(data['currency'])
+                amount_to_storage(data, money)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
             asset = repository.create(data)
-            return jsonify(asset), 201
+            return jsonify(money.present_asset(asset)), 201
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/assets/bulk', methods=['POST'])
+    def bulk_create_assets():
+        fmt = request.args.get('format')
+        if not fmt:
+            fmt = 'csv' if request.mimetype in ('text/csv', 'application/csv') else 'ndjson'
+        if fmt not in READERS:
+            return jsonify({'error': 'format は ndjson または csv を指定してください'}), 400
+        batch_size = request.args.get('batch_size', config.BULK_BATCH_SIZE)
+        if not str(batch_size).isdigit() or int(batch_size) < 1:
+            return jsonify({'error': 'batch_size は1以上の整数で指定してください'}), 400
+        try:
+            # 本文は全体を読み込まず、ストリームのまま1行ずつ処理する
+            text = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline='')
+            report = bulk_import(repository, READERS[fmt](text), int(batch_size), config.BULK_MAX_ERRORS)
+            status = 200 if report['failed'] == 0 else 207
+            return jsonify(report), status
+        except UnicodeDecodeError:
+            return jsonify({'error': '本文はUTF-8で送信してください'}), 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return error_response(e)
 
     @app.route('/api/assets/<int:asset_id>', methods=['PUT'])
     def update_asset(asset_id):
         try:
             data = request.get_json()
+            current = []
+            if money.minor and ('amount' in data or 'currency' in data):
+                # 金額の桁数は資産の通貨で決まるため、通貨を指定しない更新は今の通貨を読んでから変換する
+                current = [asset for asset in (repository.get_by_id(asset_id),) if asset is not None]
+                if not current:
+                    return jsonify({'error': '資産が見つかりません'}), 404
+            try:
+                if 'currency' in data:
+                    data['currency'] = normalize_currency(data['currency'])
+                amount_to_storage(data, money, current)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
             asset = repository.update(asset_id, data)
             if not asset:
                 return jsonify({'error': '資産が見つかりません'}), 404
-            return jsonify(asset), 200
+            return jsonify(money.present_asset(asset)), 200
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/assets', methods=['PATCH'])
+    def patch_assets():
+        """複数の資産を1文でまとめて更新・削除する
+
+        {"ids": [1, 2], "changes": {"category": "株式"}} または {"ids": [1, 2], "delete": true}
+        """
+        try:
+            data = request.get_json()
+            ids = data.get('ids') if isinstance(data, dict) else None
+            if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+                return jsonify({'error': 'ids は整数の配列で指定してください'}), 400
+            if len(ids) > config.BATCH_MAX_IDS:
+                return jsonify({'error': f'ids は{config.BATCH_MAX_IDS}件以内で指定してください'}), 400
+            if data.get('delete') is True:
+                deleted = repository.delete_many(ids)
+                not_found = sorted(set(ids) - set(deleted))
+                return jsonify({'deleted': sorted(deleted), 'not_found': not_found}), 200
+            changes = data.get('changes')
+            if not isinstance(changes, dict) or not changes or not set(changes) <= set(UPDATABLE_FIELDS):
+                return jsonify({'error': f'changes には {", ".join(UPDATABLE_FIELDS)} のいずれかを指定してください'}), 400
+            current = []
+            if money.minor and ('amount' in changes or 'currency' in changes):
+                current = repository.get_by_ids(ids)
+            try:
+                if 'currency' in changes:
+                    changes['currency'] = normalize_currency(changes['currency'])
+                amount_to_storage(changes, money, current)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            updated = repository.update_many(ids, changes)
+            not_found = sorted(set(ids) - {asset['id'] for asset in updated})
+            return jsonify({'updated': money.present_assets(updated), 'not_found': not_found}), 200
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return error_response(e)
 
     @app.route('/api/assets/<int:asset_id>', methods=['DELETE'])
     def delete_asset(asset_id):
@@ -53,15 +402,333 @@ def create_app():
                 return jsonify({'error': '資産が見つかりません'}), 404
             return jsonify({'message': '資産を削除しました'}), 200
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return error_response(e)
 
     @app.route('/api/assets/summary', methods=['GET'])
     def get_summary():
+        """カテゴリ別・通貨別の集計（currency で指定した報告通貨、省略時は既定の通貨に換算する）"""
+        try:
+            currency, rates, factors = reporting_currency(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        def build():
+            summary = money.present_summary(repository.get_summary(currency, factors))
+            summary['fx'] = rates.describe()
+            return summary
+        try:
+            return versioned_json(build, rates)
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/dashboard', methods=['GET'])
+    def get_dashboard():
+        """画面の初期表示に使う、差分同期のカーソル・一覧の最初のページ・集計をまとめて返す
+
+        一覧の指定（limit や絞り込み条件）と currency は /api/assets・/api/assets/summary と同じ。
+        ASGIで起動した場合（asgi.py）は、一覧と集計を並行に読む。
+        """
+        try:
+            currency, rates, factors = reporting_currency(request.args)
+            limit, cursor, filters = parse_page_args(request.args, money)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # 一覧は currency を指定したときだけ、報告通貨での評価額（value）を付ける
+        listing = (currency, rates, factors) if request.args.get('currency') else (None, None, None)
+
+        def build():
+            # カーソルは一覧より先に読む（読み取り中の変更を、次の差分同期で拾えるように）
+            change_cursor = repository.get_change_cursor()
+            assets = repository.list_assets(limit + 1, cursor, filters, listing[2])
+            summary = money.present_summary(repository.get_summary(currency, factors))
+            summary['fx'] = rates.describe()
+            return {'cursor': change_cursor, 'assets': build_page(assets, limit, money, *listing[:2]), 'summary': summary}
+        try:
+            return versioned_json(build, rates)
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/assets/history', methods=['GET'])
+    def get_asset_history():
+        """評価額の合計の推移（日次・月次の集計テーブルだけを読む）
+
+        from / to は日付（YYYY-MM-DD、UTC）。granularity=month の場合は from を含む月から返す。
+        """
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in VALUE_ROLLUP_TABLES:
+            return jsonify({'error': 'granularity は day または month を指定してください'}), 400
+        try:
+            start, end = (_parse_date(request.args.get(name), name) for name in ('from', 'to'))
+            currency, rates, factors = reporting_currency(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if granularity == 'month' and start is not None:
+            start = start.replace(day=1)
+        if start is not None and end is not None and start > end:
+            return jsonify({'error': 'from は to 以前の日付を指定してください'}), 400
+
+        def build():
+            history = repository.get_value_history(granularity, start and start.isoformat(), end and end.isoformat(),
+                                                   currency, factors)
+            history['from'], history['to'] = start and start.isoformat(), end and end.isoformat()
+            history['fx'] = rates.describe()
+            return money.present_history(history)
         try:
-            summary = repository.get_summary()
+            return versioned_json(build, rates)
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/assets/changes', methods=['GET'])
+    def get_asset_changes():
+        """since 以降の追加・更新・削除を返す
+
+        since を省略すると現在のカーソルだけを返す。クライアントは一覧を取得する前にカーソルを取得しておき、
+        以降はそのカーソルからの差分を手元の一覧に適用する。
+        """
+        since = request.args.get('since')
+        if since in (None, ''):
+            return versioned_json(lambda: {'changes': [], 'cursor': repository.get_change_cursor(), 'has_more': False})
+        limit = request.args.get('limit', config.CHANGES_MAX_BATCH)
+        if not since.isdigit():
+            return jsonify({'error': 'since は整数のカーソルで指定してください'}), 400
+        if not str(limit).isdigit() or not 1 <= int(limit) <= config.CHANGES_MAX_BATCH:
+            return jsonify({'error': f'limit は1〜{config.CHANGES_MAX_BATCH}で指定してください'}), 400
+        try:
+            return versioned_json(lambda: money.present_changes(repository.get_changes(int(since), int(limit))))
+        except ChangeLogExpiredError:
+            return jsonify({'error': '変更履歴が保持期間を過ぎています。一覧を再取得してください'}), 410
+        except Exception as e:
+            return error_response(e)
+
+    # 分析用スナップショットは最初の分析リクエストで作る（NumPyの読み込みと全件の読み込みを起動時に行わない）
+    analytics_state = {}
+
+    def get_snapshot():
+        # スナップショットはポートフォリオごとに作る
+        portfolio_id = current_portfolio()
+        if portfolio_id not in analytics_state:
+            from analytics import AssetSnapshot
+            analytics_state.setdefault(portfolio_id, AssetSnapshot(
+                repository.shard() if sharded else repository,
+                max_age=config.ANALYTICS_MAX_AGE, full_reload_lag=config.ANALYTICS_FULL_RELOAD_LAG))
+        return analytics_state[portfolio_id]
+
+    def analytics_json(build):
+        """currency（報告通貨）に換算した分析用の列で build(columns, currency) を実行し、JSONで返す"""
+        try:
+            currency, rates, factors = reporting_currency(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            return versioned_json(lambda: build(get_snapshot().columns(factors, currency), currency), rates)
+        except Exception as e:
+            return error_response(e)
+
+    def with_names(holdings):
+        names = {asset['id']: asset['name'] for asset in repository.get_by_ids([item['id'] for item in holdings])}
+        for item in holdings:
+            item['name'] = names.get(item['id'])
+        return holdings
+
+    @app.route('/api/assets/analytics', methods=['GET'])
+    def get_analytics():
+        """分析指標をまとめて返す（ダッシュボード用）"""
+        import analytics
+        return analytics_json(lambda columns, currency: {
+            'currency': currency,
+            'count': int(len(columns['id'])),
+            'total_value': money.to_display(int(columns['value'].sum()), currency) if money.minor
+            else analytics.finite(float(columns['value'].sum())),
+            'categories': analytics.category_breakdown(columns),
+            'top': with_names(analytics.top_holdings(columns, 10)),
+            'distribution': analytics.distribution(columns),
+            'concentration': analytics.concentration(columns),
+            'unconverted_currencies': columns['unconverted_currencies'],
+            'invalid_amounts': columns['invalid_amounts'],
+        })
+
+    @app.route('/api/assets/analytics/top', methods=['GET'])
+    def get_analytics_top():
+        import analytics
+        n = request.args.get('n', 10)
+        if not str(n).isdigit() or not 1 <= int(n) <= config.ANALYTICS_TOP_MAX:
+            return jsonify({'error': f'n は1〜{config.ANALYTICS_TOP_MAX}で指定してください'}), 400
+        category = request.args.get('category') or None
+        return analytics_json(lambda columns, currency: {
+            'currency': currency,
+            'items': with_names(analytics.top_holdings(columns, int(n), category)),
+        })
+
+    @app.route('/api/assets/analytics/categories', methods=['GET'])
+    def get_analytics_categories():
+        import analytics
+        return analytics_json(lambda columns, currency: {
+            'currency': currency, 'items': analytics.category_breakdown(columns),
+        })
+
+    @app.route('/api/assets/analytics/distribution', methods=['GET'])
+    def get_analytics_distribution():
+        import analytics
+        try:
+            percentiles = [float(p) for p in request.args['percentiles'].split(',')] \
+                if request.args.get('percentiles') else analytics.DEFAULT_PERCENTILES
+            if not all(0 <= p <= 100 for p in percentiles):
+                raise ValueError
+        except ValueError:
+            return jsonify({'error': 'percentiles は0〜100の数値をカンマ区切りで指定してください'}), 400
+        return analytics_json(lambda columns, currency: {
+            'currency': currency, **analytics.distribution(columns, percentiles),
+        })
+
+    @app.route('/api/assets/analytics/concentration', methods=['GET'])
+    def get_analytics_concentration():
+        import analytics
+        return analytics_json(lambda columns, currency: {
+            'currency': currency, **analytics.concentration(columns),
+        })
+
+    @app.route('/api/assets/analytics/snapshot', methods=['GET'])
+    def get_analytics_snapshot():
+        snapshot = analytics_state.get(current_portfolio())
+        return jsonify(snapshot.stats() if snapshot else {'loaded': False}), 200
+
+    @app.route('/api/portfolios', methods=['GET'])
+    def list_portfolios():
+        try:
+            portfolios = repository.list_portfolios() if sharded else [DEFAULT_PORTFOLIO]
+            return jsonify({'items': portfolios, 'sharded': sharded}), 200
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/portfolios', methods=['POST'])
+    def create_portfolio():
+        """ポートフォリオを作る（{"id": "acme"}）。データベースを作り、スキーマを作ってから一覧に加える"""
+        if not sharded:
+            return jsonify({'error': 'ポートフォリオを分けるには SHARD_URL_TEMPLATE を設定してください'}), 400
+        data = request.get_json(silent=True)
+        try:
+            portfolio_id = normalize_portfolio_id(data.get('id') if isinstance(data, dict) else None)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            created = repository.create_portfolio(portfolio_id)
+            return jsonify({'id': portfolio_id, 'created': created}), 201 if created else 200
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/portfolios/summary', methods=['GET'])
+    def get_portfolios_summary():
+        """全ポートフォリオの集計（各データベースに並行に問い合わせて合算し、ポートフォリオ別の合計を添える）"""
+        try:
+            currency, rates, factors = reporting_currency(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            if sharded:
+                summary = repository.get_portfolio_summary(currency, factors)
+            else:
+                summary = summarize_portfolios(repository, {DEFAULT_PORTFOLIO: repository.get_category_totals()},
+                                               currency, factors)
+            summary = money.present_summary(summary)
+            summary['fx'] = rates.describe()
             return jsonify(summary), 200
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return error_response(e)
+
+    @app.route('/api/fx/rates', methods=['GET'])
+    def get_fx_rates():
+        """読み込んでいる為替レート表（rates はその通貨1単位が base の何単位か）"""
+        rates = fx_table.current()
+        return jsonify({**rates.describe(), 'default_currency': money.default_currency,
+                        'rates': {code: str(rates.rates[code]) for code in rates.currencies}}), 200
+
+    def present_job(job):
+        artifact = job.pop('artifact')
+        job['progress'] = {'processed': job.pop('processed'), 'total': job.pop('total')}
+        job['artifact_url'] = url_for('download_job_artifact', job_id=job['id']) if artifact else None
+        return job
+
+    @app.route('/api/jobs', methods=['POST'])
+    def create_job():
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not data.get('kind'):
+            return jsonify({'error': 'kind を指定してください'}), 400
+        if not isinstance(data.get('params', {}), dict):
+            return jsonify({'error': 'params はオブジェクトで指定してください'}), 400
+        try:
+            job = jobs.submit(data['kind'], data.get('params'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except JobQueueFullError as e:
+            return jsonify({'error': str(e)}), 503
+        except Exception as e:
+            return error_response(e)
+        response = jsonify(present_job(job))
+        response.headers['Location'] = url_for('get_job', job_id=job['id'])
+        return response, 202
+
+    @app.route('/api/jobs', methods=['GET'])
+    def list_jobs():
+        limit = request.args.get('limit', 20)
+        if not str(limit).isdigit() or not 1 <= int(limit) <= config.JOB_LIST_MAX:
+            return jsonify({'error': f'limit は1〜{config.JOB_LIST_MAX}で指定してください'}), 400
+        try:
+            return jsonify({'items': [present_job(job) for job in jobs.recent(int(limit))]}), 200
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/jobs/<int:job_id>', methods=['GET'])
+    def get_job(job_id):
+        try:
+            job = jobs.get(job_id)
+            if not job:
+                return jsonify({'error': 'ジョブが見つかりません'}), 404
+            return jsonify(present_job(job)), 200
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+    def cancel_job(job_id):
+        try:
+            job = jobs.cancel(job_id)
+            if not job:
+                return jsonify({'error': 'ジョブが見つかりません'}), 404
+            if not job['cancel_requested']:
+                return jsonify({'error': f"ジョブはすでに終了しています（{job['status']}）"}), 409
+            return jsonify(present_job(job)), 202
+        except Exception as e:
+            return error_response(e)
+
+    @app.route('/api/jobs/<int:job_id>/artifact', methods=['GET'])
+    def download_job_artifact(job_id):
+        job = jobs.get(job_id)
+        if not job or not job['artifact']:
+            return jsonify({'error': '成果物が見つかりません'}), 404
+        path = jobs.artifact_path(job['artifact'])
+        if not os.path.exists(path):
+            return jsonify({'error': '成果物は削除されています'}), 410
+        # ファイルは一定サイズずつ読みながら送るため、大きな成果物もメモリに載せない
+        fmt = job['params']['format']
+        return send_file(os.path.abspath(path), mimetype=STREAM_FORMATS[fmt][1], as_attachment=True,
+                         download_name=f'assets-{job_id}.{fmt}')
+
+    @app.route('/api/pool/stats', methods=['GET'])
+    def get_pool_stats():
+        return jsonify(repository.get_pool_stats()), 200
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/api/cache/stats', methods=['GET'])
+    def get_cache_stats():
+        stats = response_cache.stats()
+        stats['data_version'] = repository.data_version.current
+        return jsonify(stats), 200
+
+    @app.errorhandler(OverloadedError)
+    def overloaded(error):
+        return overloaded_response(error)
 
     @app.errorhandler(404)
     def not_found(error):
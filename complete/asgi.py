@@ -0,0 +1,226 @@
+"""ASGIのエントリーポイント（uvicorn asgi:app）
+
+ダッシュボードが繰り返し読むルート（一覧、集計、差分同期、/api/dashboard）は非同期のハンドラーで処理し、
+データベースを待っている間もイベントループが他のリクエストを受け付ける。接続を待つリクエストが増えても
+OSのスレッドは増えない。それ以外のルートは Flask のアプリ（create_app()）を ASGI_WSGI_THREADS 本の
+スレッドで実行する（a2wsgi）。
+
+応答の形式・ETag（データバージョン）・エラーは Flask のルートと同じ。
+"""
+import asyncio
+import time
+import urllib.parse
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.http import parse_etags
+
+from admission import OverloadedError, retry_after_header
+from app import PAGINATION_PARAMS, build_page, create_app, parse_page_args, resolve_currency
+from async_database import AsyncRepositories, request_deadline
+from cache import ResponseCache
+from config import config
+from database import ChangeLogExpiredError, repository
+from fx import FxTable
+from sharding import DEFAULT_PORTFOLIO, PortfolioNotFoundError, normalize_portfolio_id
+import instrumentation
+
+
+class HTTPError(Exception):
+    """クライアントに返すエラー（400・404・410）"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    __slots__ = ('path', 'full_path', 'args', 'headers')
+
+    def __init__(self, scope):
+        query = scope['query_string'].decode('latin-1')
+        self.path = scope['path']
+        self.full_path = f'{self.path}?{query}'
+        # Flask の request.args.get と同じく、同じ名前が複数あれば最初の値を使う
+        self.args = {}
+        for key, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+            self.args.setdefault(key, value)
+        self.headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+
+
+class AsyncAssetApp:
+    """非同期のハンドラーを持つルートを処理し、それ以外を Flask のアプリに渡すASGIアプリ"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WSGIMiddleware(flask_app, workers=config.ASGI_WSGI_THREADS)
+        self.repositories = AsyncRepositories(repository, config.ASYNC_DB_THREADS)
+        self.money = repository.money
+        self.fx_table = FxTable(config.FX_RATES_FILE, self.money.default_currency)
+        self.response_cache = ResponseCache(config.RESPONSE_CACHE_SIZE)
+        self.routes = {
+            '/api/assets': self.get_assets,
+            '/api/assets/summary': self.get_summary,
+            '/api/assets/changes': self.get_changes,
+            '/api/dashboard': self.get_dashboard,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get(scope['path']) if scope['type'] == 'http' and scope['method'] == 'GET' else None
+        request = Request(scope) if handler is not None else None
+        if handler is None or not self.handles(request):
+            return await self.wsgi(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+        try:
+            status = await self.dispatch(handler, request, send)
+        finally:
+            instrumentation.HTTP_REQUESTS.inc('GET', request.path, str(status))
+            instrumentation.HTTP_DURATION.observe(time.perf_counter() - started, 'GET', request.path)
+
+    def handles(self, request: Request) -> bool:
+        # ストリーミング出力とページングしない一覧は Flask のルートで返す
+        if request.path != '/api/assets':
+            return True
+        if request.args.get('stream'):
+            return False
+        return not (config.ASSETS_UNPAGINATED and not any(key in request.args for key in PAGINATION_PARAMS))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.repositories.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, handler, request: Request, send) -> int:
+        request_deadline.set(time.monotonic() + config.ADMISSION_TIMEOUT)
+        try:
+            try:
+                portfolio_id = normalize_portfolio_id(request.args.get('portfolio_id') or DEFAULT_PORTFOLIO)
+            except ValueError as e:
+                raise HTTPError(400, str(e))
+            try:
+                async_repository = await self.repositories.get(portfolio_id)
+            except PortfolioNotFoundError as e:
+                raise HTTPError(404, str(e))
+            status, body, headers = await handler(request, async_repository)
+        except HTTPError as e:
+            status, body, headers = e.status, self.dumps({'error': str(e)}), {}
+        except OverloadedError as e:
+            status, body, headers = 503, self.dumps({'error': str(e)}), {'Retry-After': retry_after_header(e)}
+        except Exception as e:
+            status, body, headers = 500, self.dumps({'error': str(e)}), {}
+        await self.send(send, status, body, headers)
+        return status
+
+    def dumps(self, payload) -> bytes:
+        # Flask の jsonify と同じ設定（Decimal・日時の変換、ensure_ascii など）でシリアライズする
+        return (self.flask_app.json.dumps(payload, separators=(',', ':')) + '\n').encode('utf-8')
+
+    @staticmethod
+    async def send(send, status: int, body: bytes, headers):
+        raw = [(b'access-control-allow-origin', b'*')]
+        if status != 304:
+            raw += [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('ascii'))]
+        raw += [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()]
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw})
+        await send({'type': 'http.response.body', 'body': body if status != 304 else b''})
+
+    async def versioned_json(self, request: Request, async_repository, build, rates=None):
+        """データバージョンをETagにしてJSONを返す（app.py の versioned_json と同じ。build はコルーチン関数）"""
+        version = await async_repository.current_version()
+        etag = async_repository.data_version.etag(version)
+        if rates is not None:
+            version = (version, rates.version)
+            etag = f'{etag}-{rates.version}'
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if parse_etags(request.headers.get('if-none-match')).contains(etag):
+            return 304, b'', headers
+        body = self.response_cache.get(request.full_path, version)
+        if body is None:
+            payload = await build()
+            started = time.perf_counter()
+            body = self.dumps(payload)
+            instrumentation.SERIALIZE_DURATION.observe(time.perf_counter() - started, request.path)
+            self.response_cache.set(request.full_path, version, body)
+        return 200, body, headers
+
+    def reporting_currency(self, args):
+        try:
+            return resolve_currency(args, self.fx_table.current(), self.money)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+    def page_args(self, args):
+        try:
+            return parse_page_args(args, self.money)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+    async def get_assets(self, request: Request, async_repository):
+        currency, rates, factors = self.reporting_currency(request.args) if request.args.get('currency') \
+            else (None, None, None)
+        limit, cursor, filters = self.page_args(request.args)
+
+        async def build():
+            assets = await async_repository.list_assets(limit + 1, cursor, filters, factors)
+            return build_page(assets, limit, self.money, currency, rates)
+        return await self.versioned_json(request, async_repository, build, rates)
+
+    async def get_summary(self, request: Request, async_repository):
+        currency, rates, factors = self.reporting_currency(request.args)
+
+        async def build():
+            summary = self.money.present_summary(await async_repository.get_summary(currency, factors))
+            summary['fx'] = rates.describe()
+            return summary
+        return await self.versioned_json(request, async_repository, build, rates)
+
+    async def get_changes(self, request: Request, async_repository):
+        since = request.args.get('since')
+        if since in (None, ''):
+            async def build_cursor():
+                return {'changes': [], 'cursor': await async_repository.get_change_cursor(), 'has_more': False}
+            return await self.versioned_json(request, async_repository, build_cursor)
+        limit = request.args.get('limit', config.CHANGES_MAX_BATCH)
+        if not since.isdigit():
+            raise HTTPError(400, 'since は整数のカーソルで指定してください')
+        if not str(limit).isdigit() or not 1 <= int(limit) <= config.CHANGES_MAX_BATCH:
+            raise HTTPError(400, f'limit は1〜{config.CHANGES_MAX_BATCH}で指定してください')
+
+        async def build():
+            return self.money.present_changes(await async_repository.get_changes(int(since), int(limit)))
+        try:
+            return await self.versioned_json(request, async_repository, build)
+        except ChangeLogExpiredError:
+            raise HTTPError(410, '変更履歴が保持期間を過ぎています。一覧を再取得してください')
+
+    async def get_dashboard(self, request: Request, async_repository):
+        currency, rates, factors = self.reporting_currency(request.args)
+        limit, cursor, filters = self.page_args(request.args)
+        # 一覧は currency を指定したときだけ、報告通貨での評価額（value）を付ける
+        listing = (currency, rates, factors) if request.args.get('currency') else (None, None, None)
+
+        async def build():
+            # カーソルは一覧より先に読む。一覧と集計は互いに依存しないため並行に読む
+            change_cursor = await async_repository.get_change_cursor()
+            assets, summary = await asyncio.gather(
+                async_repository.list_assets(limit + 1, cursor, filters, listing[2]),
+                async_repository.get_summary(currency, factors))
+            summary = self.money.present_summary(summary)
+            summary['fx'] = rates.describe()
+            return {'cursor': change_cursor, 'assets': build_page(assets, limit, self.money, *listing[:2]),
+                    'summary': summary}
+        return await self.versioned_json(request, async_repository, build, rates)
+
+
+def create_asgi_app() -> AsyncAssetApp:
+    return AsyncAssetApp(create_app())
+
+
+app = create_asgi_app()
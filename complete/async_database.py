@@ -0,0 +1,251 @@
+"""AssetRepository の非同期版（ASGIで起動した場合に使う）
+
+AsyncAssetRepository は同期のリポジトリ（計測・アドミッション制御のラッパーを含む）の各メソッドを、
+スレッド数に上限のあるスレッドプールで実行する。pyodbc には非同期のAPIが無いため、Azure SQLでは
+すべての呼び出しがこの方法になる（データベースを待っている間もイベントループは他のリクエストを処理できる）。
+SQLiteでは、ダッシュボードが繰り返し読むもの（一覧・集計・差分同期）を aiosqlite で直接読み、
+書き込みなどそれ以外のメソッドは同じくスレッドプールで実行する（グループコミットや変更ログは同期の実装のまま）。
+
+リクエストの期限（アドミッション制御）は request_deadline に設定する。スレッドプールで実行する呼び出しには
+期限を引き継ぎ、実行を待っている間に期限を過ぎた呼び出しはデータベースに問い合わせずに OverloadedError で断る。
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import sqlite3
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import aiosqlite
+
+import admission
+from admission import ADMISSION_REJECTED, OverloadedError
+from config import config
+from database import ChangeLogExpiredError, build_asset_filters, coalesce_changes
+from instrumentation import REPOSITORY_DURATION
+from sharding import DEFAULT_PORTFOLIO, PortfolioNotFoundError, ShardedRepository
+
+# このリクエストのリポジトリ呼び出しが待てる期限（time.monotonic() の値）。None なら期限なし
+request_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('request_deadline', default=None)
+
+
+def _overloaded(budget: str, reason: str) -> OverloadedError:
+    ADMISSION_REJECTED.inc(budget, reason)
+    return OverloadedError('サーバーが混み合っています。しばらくしてから再試行してください', config.ADMISSION_RETRY_AFTER)
+
+
+class AsyncAssetRepository:
+    """同期のリポジトリのメソッドを、スレッドプールで実行するコルーチンとして呼べるようにする
+
+    repository.create(data) は await async_repository.create(data) になる。ジェネレータを返すメソッド
+    （iter_assets など）は対象外。
+    """
+
+    def __init__(self, repository, executor: ThreadPoolExecutor):
+        self.repository = repository
+        self.executor = executor
+        self.money = repository.money
+        self.data_version = repository.data_version
+
+    def __getattr__(self, name):
+        attr = getattr(self.repository, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return method
+
+    async def run(self, func, *args, **kwargs):
+        """func(*args, **kwargs) をスレッドプールで実行する（リクエストの期限を引き継ぐ）"""
+        deadline = request_deadline.get()
+
+        def call():
+            if deadline is not None and time.monotonic() > deadline:
+                raise _overloaded('async', 'timeout')
+            admission.set_deadline(deadline)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                admission.set_deadline(None)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def current_version(self) -> int:
+        # 他のプロセスの書き込みの確認（shared_version）でデータベースに問い合わせることがあるため、スレッドで読む
+        return await self.run(lambda: self.data_version.current)
+
+    async def get_summary(self, currency: Optional[str] = None, factors: Optional[Dict[str, Decimal]] = None) -> Dict:
+        # 読み取りは get_category_totals だけで、換算はイベントループで行う（データベースに問い合わせない）
+        return self.repository.summarize(await self.get_category_totals(), currency, factors)
+
+    async def close(self):
+        pass
+
+
+class SQLiteAsyncAssetRepository(AsyncAssetRepository):
+    """一覧・集計・差分同期の読み取りを aiosqlite で行う（SQLは SQLiteAssetRepository と同じ）
+
+    接続は読み取り専用（mode=ro）で開き、最大 size 本まで使い回す。空きを待つ数には ASYNC_DB_QUEUE、
+    待つ時間にはリクエストの期限（ADMISSION_TIMEOUT）の上限をかける。
+    """
+
+    def __init__(self, repository, executor: ThreadPoolExecutor, path: str, size: int):
+        super().__init__(repository, executor)
+        self.path = path
+        self.size = max(1, size)
+        self._idle: Optional[asyncio.Queue] = None
+        self._connections: List[aiosqlite.Connection] = []
+        # 開いた（開いている途中を含む）接続の数
+        self._opened = 0
+        self._waiting = 0
+
+    async def _connect(self) -> aiosqlite.Connection:
+        uri = f'file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro'
+        conn = await aiosqlite.connect(uri, uri=True, timeout=config.POOL_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        await conn.execute(f'PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}')
+        return conn
+
+    async def _acquire(self) -> aiosqlite.Connection:
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if self._idle.empty() and self._opened < self.size:
+            # 接続を開いている間に他の呼び出しが上限を超えて開かないよう、先に数に入れる
+            self._opened += 1
+            try:
+                conn = await self._connect()
+            except BaseException:
+                self._opened -= 1
+                raise
+            self._connections.append(conn)
+            return conn
+        deadline = request_deadline.get()
+        if deadline is not None and self._waiting >= config.ASYNC_DB_QUEUE:
+            raise _overloaded('async', 'queue_full')
+        self._waiting += 1
+        try:
+            return await asyncio.wait_for(self._idle.get(),
+                                          None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise _overloaded('async', 'timeout')
+        finally:
+            self._waiting -= 1
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        conn = await self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def _timed(self, method: str):
+        started = time.perf_counter()
+        try:
+            async with self.connection() as conn:
+                yield conn
+        finally:
+            REPOSITORY_DURATION.observe(time.perf_counter() - started, method)
+
+    async def list_assets(self, limit: int, cursor: Optional[Tuple[str, int]] = None,
+                          filters: Optional[Dict] = None, factors: Optional[Dict[str, Decimal]] = None) -> List[Dict]:
+        value, value_params = self.repository._value_column(factors)
+        where, params = build_asset_filters(filters, cursor, self.money)
+        async with self._timed('list_assets') as conn:
+            rows = await conn.execute_fetchall(
+                f'SELECT *{value} FROM assets{where} ORDER BY created_at DESC, id DESC LIMIT ?',
+                value_params + params + [limit])
+        return [dict(row) for row in rows]
+
+    async def get_by_id(self, asset_id: int) -> Optional[Dict]:
+        async with self._timed('get_by_id') as conn:
+            rows = await conn.execute_fetchall('SELECT * FROM assets WHERE id = ?', (asset_id,))
+        return dict(rows[0]) if rows else None
+
+    async def get_category_totals(self) -> List[Dict]:
+        async with self._timed('get_category_totals') as conn:
+            rows = await conn.execute_fetchall('''
+                SELECT NULLIF(category, ''), currency, total, asset_count FROM asset_category_totals
+                WHERE asset_count > 0 ORDER BY category, currency
+            ''')
+        return [{'category': row[0], 'currency': row[1], 'total': row[2], 'count': row[3]} for row in rows]
+
+    async def get_change_cursor(self) -> int:
+        async with self._timed('get_change_cursor') as conn:
+            rows = await conn.execute_fetchall('''
+                SELECT MAX(latest) FROM (
+                    SELECT MAX(id) AS latest FROM asset_changes
+                    UNION ALL SELECT compacted_through FROM asset_change_log
+                )
+            ''')
+        return rows[0][0] or 0
+
+    async def get_changes(self, since: int, limit: int) -> Dict:
+        async with self._timed('get_changes') as conn:
+            rows = await conn.execute_fetchall(
+                'SELECT id, asset_id, op FROM asset_changes WHERE id > ? ORDER BY id LIMIT ?', (since, limit))
+            entries = [tuple(row) for row in rows]
+            # 読み出し後に確認し、読み出し中に圧縮された場合も取りこぼしを検出する
+            rows = await conn.execute_fetchall('SELECT compacted_through FROM asset_change_log')
+            if since < rows[0][0]:
+                raise ChangeLogExpiredError(since)
+            ids = sorted({asset_id for _, asset_id, op in entries if op != 'D'})
+            assets_by_id = {}
+            if ids:
+                rows = await conn.execute_fetchall('SELECT * FROM assets WHERE id IN (SELECT value FROM json_each(?))',
+                                                   (json.dumps(ids),))
+                assets_by_id = {row['id']: dict(row) for row in rows}
+        return {
+            'changes': coalesce_changes(entries, assets_by_id),
+            'cursor': entries[-1][0] if entries else since,
+            'has_more': len(entries) == limit,
+        }
+
+    async def close(self):
+        connections, self._connections, self._opened = self._connections, [], 0
+        for conn in connections:
+            await conn.close()
+
+
+class AsyncRepositories:
+    """ポートフォリオごとの非同期版のリポジトリ（同期のリポジトリのシャードごとに1つ）
+
+    すべてのポートフォリオで1つのスレッドプール（ASYNC_DB_THREADS）を共有する。
+    """
+
+    def __init__(self, repository, threads: int):
+        self.repository = repository
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='async-db')
+        self._repositories: Dict[str, AsyncAssetRepository] = {}
+
+    async def get(self, portfolio_id: str = DEFAULT_PORTFOLIO) -> AsyncAssetRepository:
+        """ポートフォリオのリポジトリ。一覧に無ければ PortfolioNotFoundError"""
+        repository = self._repositories.get(portfolio_id)
+        if repository is not None:
+            return repository
+        sync = self.repository.get()
+        if isinstance(sync, ShardedRepository):
+            # シャードを開く（一覧の確認・スキーマの移行）のは同期の処理なので、スレッドで行う
+            sync = await asyncio.get_running_loop().run_in_executor(self.executor, sync.shard, portfolio_id)
+        elif portfolio_id != DEFAULT_PORTFOLIO:
+            raise PortfolioNotFoundError(f'ポートフォリオ {portfolio_id} が見つかりません')
+        return self._repositories.setdefault(portfolio_id, self._create(sync))
+
+    def _create(self, repository) -> AsyncAssetRepository:
+        # SQLiteのリポジトリだけが db_path を持つ（ラッパー越しでも読める）
+        path = getattr(repository, 'db_path', None)
+        if path is not None:
+            return SQLiteAsyncAssetRepository(repository, self.executor, path, config.POOL_SIZE)
+        return AsyncAssetRepository(repository, self.executor)
+
+    async def close(self):
+        repositories, self._repositories = list(self._repositories.values()), {}
+        for repository in repositories:
+            await repository.close()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,564 @@
+"""資産APIとリポジトリのベンチマーク
+
+合成データを投入したデータベースに対して、リポジトリのメソッド、Flaskテストクライアント経由の
+全ルート、マルチスレッドのHTTP負荷の3種類を計測し、結果をJSONで出力する。
+
+使い方:
+    python benchmark.py --rows 100000 --output result.json
+    python benchmark.py --backend azure-sim --rows 10000          # Azure SQLの往復遅延をSQLiteで模擬
+    python benchmark.py --backend azure --dsn "Driver=...;Server=localhost,1433;..."  # ローカルのSQL Server等
+    python benchmark.py --compare before.json after.json          # 2回分の結果を比較
+    python benchmark.py --group-commit                            # グループコミットを有効にして計測
+    python benchmark.py --money-storage minor                     # 金額を整数（補助通貨単位）で保存して計測
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# 実際のポートフォリオに近い偏りを持たせたカテゴリ分布
+CATEGORY_WEIGHTS = {
+    '株式': 45,
+    '投資信託': 20,
+    '預金': 18,
+    'その他': 8,
+    '現金': 6,
+    '不動産': 3,
+}
+# カテゴリごとの単価の中央値（対数正規分布の中心）
+CATEGORY_PRICE = {
+    '株式': 3000,
+    '投資信託': 15000,
+    '預金': 1000000,
+    'その他': 50000,
+    '現金': 100000,
+    '不動産': 30000000,
+}
+
+
+def generate_assets(rows: int, seed: int, batch_size: int = 50000):
+    """(name, amount, quantity, description, category, created_at) をバッチ単位で生成する"""
+    rng = random.Random(seed)
+    categories = list(CATEGORY_WEIGHTS)
+    weights = list(CATEGORY_WEIGHTS.values())
+    start = datetime(2020, 1, 1)
+    span = int(timedelta(days=5 * 365).total_seconds())
+    batch = []
+    for i in range(rows):
+        category = rng.choices(categories, weights)[0]
+        amount = round(rng.lognormvariate(0, 1) * CATEGORY_PRICE[category], 2)
+        quantity = rng.randint(1, 1000) if category in ('株式', '投資信託') else 1
+        created_at = start + timedelta(seconds=rng.randrange(span))
+        batch.append((f'{category}{i}', amount, quantity, f'ベンチマーク用データ{i}', category,
+                      created_at.strftime('%Y-%m-%d %H:%M:%S')))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(group, name, latencies, elapsed, peak_memory=None, **extra):
+    latencies = sorted(latencies)
+    result = {
+        'group': group,
+        'name': name,
+        'iterations': len(latencies),
+        'elapsed_seconds': round(elapsed, 4),
+        'throughput_per_second': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'max_ms': _ms(latencies[-1] if latencies else None),
+        'peak_memory_bytes': peak_memory,
+    }
+    result.update(extra)
+    return result
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+class Runner:
+    """シナリオを一定回数実行し、レイテンシとメモリのピークを記録する"""
+
+    def __init__(self, iterations: int, trace_memory: bool):
+        self.iterations = iterations
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def run(self, group, name, func, iterations=None, **extra):
+        iterations = iterations or self.iterations
+        latencies = []
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            for i in range(iterations):
+                t0 = time.perf_counter()
+                func(i)
+                latencies.append(time.perf_counter() - t0)
+        except Exception as e:
+            extra['error'] = f'{type(e).__name__}: {e}'
+        elapsed = time.perf_counter() - started
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        result = summarize(group, name, latencies, elapsed, peak, **extra)
+        self.results.append(result)
+        print(f"  {group:<10} {name:<36} {result['throughput_per_second'] or 0:>10.1f}/s "
+              f"p50={result['p50_ms']}ms p99={result['p99_ms']}ms"
+              + (f"  ERROR {extra['error']}" if 'error' in extra else ''), file=sys.stderr)
+        return result
+
+
+class _LatencyCursor:
+    def __init__(self, cursor, rtt):
+        self._cursor = cursor
+        self._rtt = rtt
+
+    def execute(self, *args):
+        time.sleep(self._rtt)
+        return self._cursor.execute(*args)
+
+    def executemany(self, *args):
+        time.sleep(self._rtt)
+        return self._cursor.executemany(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class LatencyConnection:
+    """SQLite接続に往復遅延を加え、Azure SQL Databaseの代わりとして使う
+
+    接続確立（TLS・ログイン）と、execute / commit ごとのネットワーク往復を sleep で模擬する。
+    """
+
+    def __init__(self, conn, rtt):
+        self._conn = conn
+        self._rtt = rtt
+
+    def cursor(self):
+        return _LatencyCursor(self._conn.cursor(), self._rtt)
+
+    def execute(self, *args):
+        time.sleep(self._rtt)
+        return self._conn.execute(*args)
+
+    def commit(self):
+        time.sleep(self._rtt)
+        return self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def seed_database(repository, rows, seed):
+    """リポジトリのテーブルに合成データを投入する（既に同じ件数があれば再利用する）"""
+    with repository.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM assets')
+        existing = cursor.fetchone()[0]
+    if existing == rows:
+        return {'rows': rows, 'reused': True, 'seconds': 0}
+    started = time.perf_counter()
+    money = repository.money
+    with repository.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM assets')
+        conn.commit()
+        if hasattr(cursor, 'fast_executemany'):
+            cursor.fast_executemany = True
+        for batch in generate_assets(rows, seed):
+            if money.minor:
+                batch = [(row[0], money.to_storage(row[1])) + row[2:] for row in batch]
+            cursor.executemany('''
+                INSERT INTO assets (name, amount, quantity, description, category, created_at, currency)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [row + (money.default_currency,) for row in batch])
+            conn.commit()
+    # 投入時に記録された変更ログは計測に不要なので、ここでまとめて削除する
+    repository.compact_changes()
+    return {'rows': rows, 'reused': False, 'seconds': round(time.perf_counter() - started, 2)}
+
+
+def bench_repository(runner, repository, sample_ids, categories, args):
+    rng = random.Random(args.seed)
+    group = 'repository'
+    runner.run(group, 'get_by_id', lambda i: repository.get_by_id(rng.choice(sample_ids)))
+    runner.run(group, 'list_assets(first page)', lambda i: repository.list_assets(51))
+    runner.run(group, 'list_assets(category)', lambda i: repository.list_assets(51, None, {'category': rng.choice(categories)}))
+    runner.run(group, 'list_assets(amount range)',
+               lambda i: repository.list_assets(51, None, {'min_amount': 1000, 'max_amount': 100000}))
+
+    cursor_state = {'cursor': None}
+
+    def walk_pages(i):
+        page = repository.list_assets(501, cursor_state['cursor'])
+        cursor_state['cursor'] = (str(page[499]['created_at']), page[499]['id']) if len(page) > 500 else None
+    runner.run(group, 'list_assets(walk 500-row pages)', walk_pages)
+
+    runner.run(group, 'get_summary', lambda i: repository.get_summary())
+    # assets 全体を SUM(amount * quantity) で集計する（金額の保存形式による差が出る）
+    runner.run(group, 'verify_category_totals(full aggregate)', lambda i: repository.verify_category_totals(),
+               iterations=args.heavy_iterations)
+    runner.run(group, 'iter_assets(full stream)', lambda i: sum(1 for _ in repository.iter_assets()),
+               iterations=args.heavy_iterations)
+    if args.rows <= args.max_get_all:
+        runner.run(group, 'get_all', lambda i: repository.get_all(), iterations=args.heavy_iterations)
+
+    created = []
+    runner.run(group, 'create', lambda i: created.append(repository.create(
+        {'name': f'bench{i}', 'amount': 1000 + i, 'quantity': 1, 'category': rng.choice(categories)})['id']))
+    runner.run(group, 'update', lambda i: repository.update(created[i % len(created)], {'amount': 2000 + i}))
+    runner.run(group, 'update_many(100 ids)',
+               lambda i: repository.update_many(created[:100], {'description': f'batch{i}'}))
+    runner.run(group, 'delete', lambda i: repository.delete(created.pop()), iterations=len(created) // 2)
+    runner.run(group, 'delete_many', lambda i: repository.delete_many(list(created)), iterations=1)
+
+    # 同時に届く書き込み（グループコミットの有無で比較する）
+    with ThreadPoolExecutor(args.write_threads) as writers:
+        def concurrent_writes(i):
+            ids = list(writers.map(lambda n: repository.create(
+                {'name': f'burst{i}-{n}', 'amount': 1000 + n, 'category': rng.choice(categories)})['id'],
+                range(args.write_threads)))
+            list(writers.map(repository.delete, ids))
+        runner.run(group, f'create+delete ({args.write_threads} threads)', concurrent_writes,
+                   rows_per_iteration=args.write_threads)
+
+    batch = [(f'bulk{i}', repository.money.to_storage(100.0 + i), 1, None, 'その他', repository.money.default_currency)
+             for i in range(args.bulk_rows)]
+    inserted = []
+
+    def insert_many(i):
+        repository.insert_many(batch)
+        inserted.append(i)
+    runner.run(group, f'insert_many({args.bulk_rows} rows)', insert_many, iterations=args.heavy_iterations,
+               rows_per_iteration=args.bulk_rows)
+
+
+def bench_routes(runner, app, sample_ids, categories, args):
+    """create_app() の全ルートをテストクライアントで計測する"""
+    client = app.test_client()
+    rng = random.Random(args.seed + 1)
+    group = 'flask'
+    covered = set()
+
+    def run(rule, name, func, **kwargs):
+        covered.add(rule)
+        runner.run(group, name, func, **kwargs)
+
+    def get(url, **kwargs):
+        response = client.get(url, **kwargs)
+        response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError(f'{url} -> {response.status_code}')
+        return response
+
+    run('/', 'GET /', lambda i: get('/'))
+    run('/api/assets', 'GET /api/assets', lambda i: get('/api/assets'))
+    run('/api/assets', 'GET /api/assets?category', lambda i: get(f'/api/assets?category={rng.choice(categories)}'))
+    etag = get('/api/assets/summary').headers.get('ETag')
+    run('/api/assets/summary', 'GET /api/assets/summary', lambda i: get('/api/assets/summary'))
+    run('/api/assets/summary', 'GET /api/assets/summary (If-None-Match)',
+        lambda i: client.get('/api/assets/summary', headers={'If-None-Match': etag or ''}))
+    run('/api/assets/export', 'GET /api/assets/export (ndjson)', lambda i: get('/api/assets/export'),
+        iterations=args.heavy_iterations)
+    run('/api/assets/search', 'GET /api/assets/search?q (category)',
+        lambda i: get(f'/api/assets/search?q={rng.choice(categories)}'))
+    run('/api/assets/search', 'GET /api/assets/search?q (prefix)', lambda i: get('/api/assets/search?q=サ'))
+    run('/api/pool/stats', 'GET /api/pool/stats', lambda i: get('/api/pool/stats'))
+    run('/api/cache/stats', 'GET /api/cache/stats', lambda i: get('/api/cache/stats'))
+    run('/metrics', 'GET /metrics', lambda i: get('/metrics'))
+    # 分析系は初回にスナップショットを読み込むため、読み込み時間を別に記録してから計測する
+    run('/api/assets/analytics', 'GET /api/assets/analytics (snapshot load)', lambda i: get('/api/assets/analytics'),
+        iterations=1)
+    run('/api/assets/analytics', 'GET /api/assets/analytics', lambda i: get('/api/assets/analytics'))
+    run('/api/assets/analytics/top', 'GET /api/assets/analytics/top?category',
+        lambda i: get(f'/api/assets/analytics/top?n=20&category={rng.choice(categories)}'))
+    run('/api/assets/analytics/categories', 'GET /api/assets/analytics/categories',
+        lambda i: get('/api/assets/analytics/categories'))
+    run('/api/assets/analytics/distribution', 'GET /api/assets/analytics/distribution',
+        lambda i: get('/api/assets/analytics/distribution'))
+    run('/api/assets/analytics/concentration', 'GET /api/assets/analytics/concentration',
+        lambda i: get('/api/assets/analytics/concentration'))
+    run('/api/assets/analytics/snapshot', 'GET /api/assets/analytics/snapshot',
+        lambda i: get('/api/assets/analytics/snapshot'))
+
+    change_cursor = get('/api/assets/changes').get_json()['cursor']
+    created = []
+
+    def post(i):
+        response = client.post('/api/assets', json={'name': f'route{i}', 'amount': 1000 + i, 'category': '現金'})
+        created.append(response.get_json()['id'])
+    run('/api/assets', 'POST /api/assets', post)
+    run('/api/assets/<int:asset_id>', 'PUT /api/assets/<id>',
+        lambda i: client.put(f'/api/assets/{created[i % len(created)]}', json={'amount': 5000 + i}))
+    run('/api/assets', 'PATCH /api/assets (update)',
+        lambda i: client.patch('/api/assets', json={'ids': created[:50], 'changes': {'category': 'その他'}}))
+    run('/api/assets/<int:asset_id>', 'DELETE /api/assets/<id>',
+        lambda i: client.delete(f'/api/assets/{created.pop()}'), iterations=len(created) // 2)
+    run('/api/assets', 'PATCH /api/assets (delete)',
+        lambda i: client.patch('/api/assets', json={'ids': list(created), 'delete': True}), iterations=1)
+    # 上の書き込みで生じた変更を、差分同期で1ページずつ読み出す
+    run('/api/assets/changes', 'GET /api/assets/changes', lambda i: get(f'/api/assets/changes?since={change_cursor}'))
+
+    body = '\n'.join(json.dumps({'name': f'bulkroute{i}', 'amount': i + 1, 'category': 'その他'})
+                     for i in range(args.bulk_rows)).encode('utf-8')
+    run('/api/assets/bulk', f'POST /api/assets/bulk ({args.bulk_rows} rows)',
+        lambda i: client.post('/api/assets/bulk', data=body, content_type='application/x-ndjson'),
+        iterations=args.heavy_iterations, rows_per_iteration=args.bulk_rows)
+
+    rules = {rule.rule for rule in app.url_map.iter_rules() if rule.endpoint != 'static'}
+    return sorted(rules - covered)
+
+
+def bench_http(runner, app, categories, args):
+    """実際のHTTPサーバーに対して複数スレッドから負荷をかける"""
+    import logging
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{port}'
+    # ダッシュボードのポーリングを想定した読み取り中心の構成
+    mix = [('/api/assets', 70), ('/api/assets/summary', 20), ('/api/assets?category={category}', 10)]
+    paths = [path for path, _ in mix]
+    weights = [weight for _, weight in mix]
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.http_duration
+
+    def worker(worker_id):
+        local_rng = random.Random(args.seed + worker_id)
+        local = []
+        while time.perf_counter() < deadline:
+            path = local_rng.choices(paths, weights)[0].format(category=urllib.request.quote(local_rng.choice(categories)))
+            t0 = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base + path, timeout=30) as response:
+                    response.read()
+                local.append(time.perf_counter() - t0)
+            except (urllib.error.URLError, OSError) as e:
+                with lock:
+                    errors.append(str(e))
+        with lock:
+            latencies.extend(local)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.http_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    peak = None
+    if args.trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    server.shutdown()
+    result = summarize('http', f'mixed read load ({args.http_threads} threads)', latencies, elapsed, peak,
+                       errors=len(errors), mix={path: weight for path, weight in mix})
+    runner.results.append(result)
+    print(f"  http       {result['name']:<36} {result['throughput_per_second'] or 0:>10.1f}/s "
+          f"p50={result['p50_ms']}ms p99={result['p99_ms']}ms errors={len(errors)}", file=sys.stderr)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path):
+    """2つの結果ファイルのスループットとp99を並べて表示する"""
+    with open(before_path, encoding='utf-8') as f:
+        before = {(r['group'], r['name']): r for r in json.load(f)['results']}
+    with open(after_path, encoding='utf-8') as f:
+        after = {(r['group'], r['name']): r for r in json.load(f)['results']}
+    print(f"{'scenario':<56} {'throughput':>22} {'p99 ms':>22}")
+    for key in sorted(set(before) | set(after)):
+        b, a = before.get(key, {}), after.get(key, {})
+
+        def fmt(field):
+            old, new = b.get(field), a.get(field)
+            if old and new:
+                return f'{old:>8} -> {new:<8} ({(new - old) / old * 100:+.0f}%)'
+            return f'{old} -> {new}'
+        print(f"{key[0] + ' ' + key[1]:<56} {fmt('throughput_per_second'):>22} {fmt('p99_ms'):>22}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='資産管理アプリのベンチマーク')
+    parser.add_argument('--backend', choices=['sqlite', 'azure-sim', 'azure'], default='sqlite')
+    parser.add_argument('--rows', type=int, default=10000, help='合成データの行数（1,000〜10,000,000）')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db', help='SQLiteのファイルパス（省略時は一時ディレクトリ。同じ行数なら再利用する）')
+    parser.add_argument('--dsn', help='--backend azure で使う接続文字列（ローカルのSQL Server / Azure SQL Edge など）')
+    parser.add_argument('--connect-latency', type=float, default=0.03, help='azure-sim: 接続確立の遅延（秒）')
+    parser.add_argument('--rtt', type=float, default=0.002, help='azure-sim: 1往復あたりの遅延（秒）')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--heavy-iterations', type=int, default=3, help='全件走査など重いシナリオの実行回数')
+    parser.add_argument('--bulk-rows', type=int, default=1000)
+    parser.add_argument('--max-get-all', type=int, default=200000, help='この行数以下のときだけ get_all() を計測する')
+    parser.add_argument('--http-threads', type=int, default=8)
+    parser.add_argument('--write-threads', type=int, default=16, help='同時書き込みシナリオのスレッド数')
+    parser.add_argument('--group-commit', action='store_true', help='GROUP_COMMIT=true で計測する')
+    parser.add_argument('--money-storage', choices=['decimal', 'minor'], default='decimal',
+                        help='金額の保存形式（minor: 補助通貨単位の整数。合成データに合わせて小数点以下2桁とする）')
+    parser.add_argument('--http-duration', type=float, default=10.0)
+    parser.add_argument('--skip', action='append', default=[], choices=['repository', 'flask', 'http'])
+    parser.add_argument('--trace-memory', action='store_true', help='シナリオごとにtracemallocでメモリのピークを計測する')
+    parser.add_argument('--output', help='結果のJSONを書き出すファイル（省略時は標準出力）')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='2つの結果ファイルを比較する')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.compare:
+        return compare(*args.compare)
+
+    # database モジュールは読み込み時に接続先を決めるため、先に環境変数を設定する
+    if args.backend == 'azure':
+        if not args.dsn:
+            print('--backend azure には --dsn が必要です', file=sys.stderr)
+            return 2
+        os.environ['DATABASE_URL'] = args.dsn
+        db_label = 'dsn'
+    else:
+        suffix = '_minor' if args.money_storage == 'minor' else ''
+        db_path = args.db or os.path.join(tempfile.gettempdir(), f'asset_bench_{args.rows}_{args.seed}{suffix}.db')
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+        db_label = db_path
+
+    if args.group_commit:
+        os.environ['GROUP_COMMIT'] = 'true'
+    if args.money_storage == 'minor':
+        os.environ['MONEY_STORAGE'] = 'minor'
+        os.environ['MONEY_SCALE'] = '2'
+
+    cold_start = time.perf_counter()
+    import database
+    import_seconds = time.perf_counter() - cold_start
+    started = time.perf_counter()
+    repository = database.repository.get()
+    repository_init_seconds = time.perf_counter() - started
+
+    print(f'データ投入中: {args.rows}行 ({db_label})', file=sys.stderr)
+    dataset = seed_database(repository, args.rows, args.seed)
+
+    if args.backend == 'azure-sim':
+        from pool import ConnectionPool
+        real_connect = repository._connect
+
+        def connect():
+            time.sleep(args.connect_latency)
+            return LatencyConnection(real_connect(), args.rtt)
+        repository.pool.close()
+        repository.pool = ConnectionPool(connect, max_size=repository.pool.max_size, timeout=repository.pool.timeout,
+                                         recycle=repository.pool.recycle, ping_interval=repository.pool.ping_interval,
+                                         ping=database._ping)
+
+    from app import create_app
+    started = time.perf_counter()
+    app = create_app()
+    create_app_seconds = time.perf_counter() - started
+
+    rng = random.Random(args.seed)
+    with repository.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT MIN(id), MAX(id) FROM assets')
+        min_id, max_id = cursor.fetchone()
+    sample_ids = [rng.randint(min_id, max_id) for _ in range(1000)] if min_id is not None else [1]
+    categories = list(CATEGORY_WEIGHTS)
+
+    runner = Runner(args.iterations, args.trace_memory)
+    uncovered = []
+    if 'repository' not in args.skip:
+        bench_repository(runner, repository, sample_ids, categories, args)
+    if 'flask' not in args.skip:
+        uncovered = bench_routes(runner, app, sample_ids, categories, args)
+    if 'http' not in args.skip:
+        bench_http(runner, app, categories, args)
+
+    # ベンチマーク中に追加した行を片付け、次回の実行でデータセットを再利用できるようにする
+    with repository.get_connection() as conn:
+        conn.cursor().execute('DELETE FROM assets WHERE id > ?', (max_id or 0,))
+        conn.commit()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlite_version': sqlite3.sqlite_version,
+            'backend': args.backend,
+            'rows': args.rows,
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'rtt_seconds': args.rtt if args.backend == 'azure-sim' else None,
+            'connect_latency_seconds': args.connect_latency if args.backend == 'azure-sim' else None,
+            'group_commit': args.group_commit,
+            'money_storage': repository.money.describe(),
+        },
+        'dataset': dataset,
+        'startup': {
+            'import_database_seconds': round(import_seconds, 4),
+            'repository_init_seconds': round(repository_init_seconds, 4),
+            'repository_init_breakdown': {key: round(value, 4) if isinstance(value, float) else value
+                                          for key, value in repository.startup_timings.items()},
+            'create_app_seconds': round(create_app_seconds, 4),
+        },
+        'results': runner.results,
+        'pool': repository.get_pool_stats(),
+        'uncovered_routes': uncovered,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
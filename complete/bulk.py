@@ -0,0 +1,109 @@
+import csv
+import json
+import time
+from typing import Dict, Iterable, Iterator, TextIO, Tuple
+
+from fx import normalize_currency
+from money import MoneyFormat
+
+
+def validate_asset_row(data: Dict, money=None) -> Tuple:
+    """1行分の入力を検証し、INSERT用のタプルに変換する（金額は money の保存形式の値にする）
+
+    currency を省略した行は既定の通貨（money.default_currency）とする。money を省略すると従来の形式として扱う。
+    """
+    money = money or MoneyFormat()
+    if not isinstance(data, dict):
+        raise ValueError('オブジェクト形式ではありません')
+    if not data.get('name') or data.get('amount') in (None, '') or not data.get('category'):
+        raise ValueError('必須項目が不足しています')
+    if data.get('currency') in (None, ''):
+        currency = money.default_currency
+    else:
+        currency = normalize_currency(data['currency'])
+    # 1件ずつの登録・更新と同じ変換と検証（整数で保存している場合、桁数は行の通貨で決まる）
+    amount = money.to_storage(data['amount'], currency)
+    quantity = data.get('quantity')
+    try:
+        quantity = 1 if quantity in (None, '') else int(quantity)
+    except (TypeError, ValueError):
+        raise ValueError('quantity は整数で指定してください')
+    return (data['name'], amount, quantity, data.get('description') or None, data['category'], currency)
+
+
+def read_ndjson(stream: TextIO) -> Iterator[Tuple[int, Dict]]:
+    """NDJSONを1行ずつ読み出す。解析できない行は例外オブジェクトを返す"""
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError:
+            yield line_no, ValueError('JSONとして解析できません')
+
+
+def read_csv(stream: TextIO) -> Iterator[Tuple[int, Dict]]:
+    """ヘッダー行付きCSVを1行ずつ読み出す（行番号はヘッダーを1行目として数える）"""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+READERS = {
+    'ndjson': read_ndjson,
+    'csv': read_csv,
+}
+
+
+def bulk_import(repository, records: Iterable[Tuple[int, Dict]], batch_size: int = 1000,
+                max_errors: int = 100) -> Dict:
+    """検証済みの行をバッチ単位で挿入し、結果のレポートを返す
+
+    1バッチ = 1トランザクション。入力全体を保持しないため、メモリ使用量はバッチサイズに比例する。
+    バッチの挿入に失敗した場合は、そのバッチだけ1行ずつ挿入し直す。
+    """
+    started = time.perf_counter()
+    report = {'received': 0, 'inserted': 0, 'failed': 0, 'batches': 0, 'errors': []}
+
+    def record_error(line_no, message):
+        report['failed'] += 1
+        if len(report['errors']) < max_errors:
+            report['errors'].append({'line': line_no, 'error': message})
+
+    def flush(batch):
+        report['batches'] += 1
+        try:
+            report['inserted'] += repository.insert_many([values for _, values in batch])
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                record_error(batch[0][0], f'挿入に失敗しました: {e}')
+                return
+        # どの行で失敗したかは分からないため、1行ずつ挿入し直して失敗した行だけを報告する
+        for line_no, values in batch:
+            try:
+                report['inserted'] += repository.insert_many([values])
+            except Exception as e:
+                record_error(line_no, f'挿入に失敗しました: {e}')
+
+    batch = []
+    for line_no, data in records:
+        report['received'] += 1
+        try:
+            if isinstance(data, Exception):
+                raise data
+            batch.append((line_no, validate_asset_row(data, repository.money)))
+        except ValueError as e:
+            record_error(line_no, str(e))
+            continue
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    elapsed = time.perf_counter() - started
+    report['errors_truncated'] = report['failed'] > len(report['errors'])
+    report['elapsed_seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['inserted'] / elapsed, 1) if elapsed > 0 else None
+    return report
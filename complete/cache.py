@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+
+class DataVersion:
+    """リポジトリへの書き込みごとに単調増加するデータバージョン
+
+    プロセス起動ごとに異なる epoch を持つため、再起動前に発行したETagと衝突しない。
+    shared を渡すと、他のプロセス（gunicornの別ワーカーなど）の書き込みも検出する。shared はデータベースが
+    変更されるたびに変わる値を返す関数で、最後の確認から check_interval 秒以上経っていれば呼ぶ。
+    changed_at は最後にバージョンが進んだ時刻（time.monotonic()）。起動前の書き込みは分からないため、起動時刻で初期化する。
+    """
+
+    def __init__(self, shared: Optional[Callable[[], Hashable]] = None, check_interval: float = 0.0):
+        self.epoch = format(time.time_ns(), 'x')
+        self._value = 0
+        self._lock = threading.Lock()
+        self._shared = shared
+        self._check_interval = check_interval
+        self._check_lock = threading.Lock()
+        self._shared_token = None
+        self._checked_at = float('-inf')
+        self.changed_at = time.monotonic()
+
+    @property
+    def current(self) -> int:
+        if self._shared is not None:
+            self._check_shared()
+        return self._value
+
+    def _check_shared(self):
+        started = time.monotonic()
+        if started - self._checked_at < self._check_interval:
+            return
+        with self._check_lock:
+            # 待っている間に他のスレッドが確認を始めていれば、その結果を使う
+            if self._checked_at >= started:
+                return
+            try:
+                token = self._shared()
+            except Exception:
+                # 確認できなくても、続くデータベースへの問い合わせでエラーになる
+                return
+            self._checked_at = started
+            if token != self._shared_token:
+                if self._shared_token is not None:
+                    self.bump()
+                self._shared_token = token
+
+    def bump(self) -> int:
+        with self._lock:
+            self._value += 1
+            self.changed_at = time.monotonic()
+            return self._value
+
+    def etag(self, version: Optional[int] = None) -> str:
+        """強いETagとして使える値を返す"""
+        return f'{self.epoch}-{self.current if version is None else version}'
+
+
+class ResponseCache:
+    """データバージョンをキーの一部にしたLRUの応答キャッシュ
+
+    バージョンが変わった時点で古いエントリは参照されなくなり、LRUで追い出される。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, version: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, version: int, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -6,6 +6,92 @@ load_dotenv()
 class Config:
     """基本設定クラス"""
     DEBUG = False
+    # コネクションプール設定
+    POOL_SIZE = int(os.environ.get('POOL_SIZE', 5))
+    POOL_TIMEOUT = float(os.environ.get('POOL_TIMEOUT', 30))
+    POOL_RECYCLE = float(os.environ.get('POOL_RECYCLE', 1800))
+    POOL_PING_INTERVAL = float(os.environ.get('POOL_PING_INTERVAL', 30))
+    # SQLiteのメモリマップサイズ（バイト）
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    # 資産一覧のページサイズ
+    PAGE_SIZE_DEFAULT = int(os.environ.get('PAGE_SIZE_DEFAULT', 50))
+    PAGE_SIZE_MAX = int(os.environ.get('PAGE_SIZE_MAX', 500))
+    # ストリーミング出力時にfetchmanyで一度に読み出す行数
+    STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+    # 一括登録で1トランザクションにまとめる行数と、レポートに含めるエラーの上限
+    BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+    BULK_MAX_ERRORS = int(os.environ.get('BULK_MAX_ERRORS', 100))
+    # PATCH /api/assets で一度に指定できるidの上限
+    BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', 1000))
+    # スロークエリログ（しきい値を超えたSQLと、パラメータの型の並びを警告ログに出す）
+    SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'false').lower() == 'true'
+    SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 100))
+    # 応答キャッシュに保持するエントリ数の上限（0で無効）
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+    # trueにするとパラメータなしの GET /api/assets で従来どおり全件を配列で返す（小規模環境向け）
+    ASSETS_UNPAGINATED = os.environ.get('ASSETS_UNPAGINATED', 'false').lower() == 'true'
+    # 差分同期: 1回の応答で返す変更ログの件数の上限、保持する件数、何回の書き込みごとに古い変更を削除するか
+    CHANGES_MAX_BATCH = int(os.environ.get('CHANGES_MAX_BATCH', 1000))
+    CHANGE_LOG_RETENTION = int(os.environ.get('CHANGE_LOG_RETENTION', 10000))
+    CHANGE_LOG_COMPACT_INTERVAL = int(os.environ.get('CHANGE_LOG_COMPACT_INTERVAL', 100))
+    # グループコミット: 同時に届いた追加・更新・削除を1トランザクションにまとめる（最大待ち時間と最大件数）
+    GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'false').lower() == 'true'
+    GROUP_COMMIT_MAX_LATENCY_MS = float(os.environ.get('GROUP_COMMIT_MAX_LATENCY_MS', 2))
+    GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))
+    # 分析用スナップショット: 他プロセスの書き込みを確認する間隔（秒）と、差分ではなく全件を読み直す変更件数
+    ANALYTICS_MAX_AGE = float(os.environ.get('ANALYTICS_MAX_AGE', 5))
+    ANALYTICS_FULL_RELOAD_LAG = int(os.environ.get('ANALYTICS_FULL_RELOAD_LAG', 50000))
+    # 全文検索: 並べ替えの対象にする候補数（新しいものから）と、検索文字列の最大長
+    SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 200))
+    SEARCH_QUERY_MAX_LENGTH = int(os.environ.get('SEARCH_QUERY_MAX_LENGTH', 100))
+    # 他のプロセス（gunicornの別ワーカーなど）の書き込みを確認する間隔（秒）。0ならリクエストごとに確認する
+    DATA_VERSION_CHECK_INTERVAL = float(os.environ.get('DATA_VERSION_CHECK_INTERVAL', 0))
+    # 読み取り用の接続先（レプリカ）。一覧・集計・検索を送る。SQLiteでは同じファイルを指定すると読み取り専用で開く
+    DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL') or None
+    # レプリカの遅れとして許容する秒数。最後の書き込みからこの秒数の間は読み取りもプライマリに送る
+    READ_REPLICA_MAX_STALENESS = float(os.environ.get('READ_REPLICA_MAX_STALENESS', 2))
+    # gunicornのワーカー数（0ならCPU数から決める）
+    WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY') or 0)
+    # 金額の保存形式: minor にすると新しいデータベースでは金額を補助通貨単位の整数で保存する
+    # （既存のデータベースは python manage.py money convert で変換する）。MONEY_SCALE を省略すると通貨の標準の桁数
+    MONEY_STORAGE = os.environ.get('MONEY_STORAGE', 'decimal').lower()
+    CURRENCY = os.environ.get('CURRENCY', 'JPY')
+    MONEY_SCALE = int(os.environ['MONEY_SCALE']) if os.environ.get('MONEY_SCALE') else None
+    # 為替レート表（JSON）のパス。ファイルが無ければ CURRENCY 以外の通貨の資産は換算できない
+    FX_RATES_FILE = os.environ.get('FX_RATES_FILE', 'fx_rates.json')
+    # バックグラウンドジョブ: 同時に実行する数と、ワーカーごとに実行を待てる数の上限、成果物の保存先、
+    # 進捗を記録する間隔（秒）、再評価で1トランザクションにまとめる件数、一覧で返す件数の上限
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+    JOB_MAX_QUEUED = int(os.environ.get('JOB_MAX_QUEUED', 16))
+    JOB_ARTIFACT_DIR = os.environ.get('JOB_ARTIFACT_DIR', 'job_artifacts')
+    JOB_PROGRESS_INTERVAL = float(os.environ.get('JOB_PROGRESS_INTERVAL', 0.5))
+    JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', 1000))
+    JOB_LIST_MAX = int(os.environ.get('JOB_LIST_MAX', 100))
+    # python manage.py jobs purge で削除する、終了してからの日数
+    JOB_RETENTION_DAYS = float(os.environ.get('JOB_RETENTION_DAYS', 7))
+    # アドミッション制御: リポジトリ呼び出しを読み取り・書き込みそれぞれ同時に実行できる数（プロセスごと）と、
+    # 空きを待てる数の上限、リクエストを受け付けてから空きを待てる秒数、断ったときの Retry-After（秒）
+    ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'true').lower() == 'true'
+    ADMISSION_READ_LIMIT = int(os.environ.get('ADMISSION_READ_LIMIT') or POOL_SIZE)
+    ADMISSION_WRITE_LIMIT = int(os.environ.get('ADMISSION_WRITE_LIMIT') or max(1, POOL_SIZE // 2))
+    ADMISSION_READ_QUEUE = int(os.environ.get('ADMISSION_READ_QUEUE', 32))
+    ADMISSION_WRITE_QUEUE = int(os.environ.get('ADMISSION_WRITE_QUEUE', 16))
+    ADMISSION_TIMEOUT = float(os.environ.get('ADMISSION_TIMEOUT', 5))
+    ADMISSION_RETRY_AFTER = float(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+    # ポートフォリオごとのデータベース（シャード）の接続先。{portfolio} をポートフォリオのidに置き換える
+    # （例: sqlite:///shards/{portfolio}.db）。未設定なら分割しない。default のポートフォリオは常に DATABASE_URL
+    SHARD_URL_TEMPLATE = os.environ.get('SHARD_URL_TEMPLATE') or None
+    # ポートフォリオをまたぐ集計で、同時に問い合わせるシャードの数
+    SHARD_FANOUT_WORKERS = int(os.environ.get('SHARD_FANOUT_WORKERS', 8))
+    # ASGIで起動した場合（uvicorn asgi:app）に、同期のリポジトリ（pyodbc など）の呼び出しを実行するスレッド数と、
+    # 非同期のハンドラーの無いルート（Flaskのアプリ）を実行するスレッド数
+    ASYNC_DB_THREADS = int(os.environ.get('ASYNC_DB_THREADS', 16))
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 10))
+    # ASGIで起動した場合に、aiosqlite の接続の空きを待てる呼び出しの数（待っている間はスレッドを使わないため
+    # ADMISSION_READ_QUEUE より大きくできる。待つ時間の上限は ADMISSION_TIMEOUT）
+    ASYNC_DB_QUEUE = int(os.environ.get('ASYNC_DB_QUEUE', 256))
+    # /api/assets/analytics/top で指定できる件数の上限
+    ANALYTICS_TOP_MAX = int(os.environ.get('ANALYTICS_TOP_MAX', 100))
 
 class DevelopmentConfig(Config):
     """開発環境設定"""
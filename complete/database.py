@@ -1,156 +1,1309 @@
-import sqlite3
-import pyodbc
 from config import config
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Optional
+from decimal import Decimal
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+from pool import ConnectionPool
+from cache import DataVersion
+from instrumentation import InstrumentedRepository, instrumented_connection
+from admission import AdmissionControlledRepository
+from metrics import registry
+from migrations import SQLITE_MIGRATIONS, AZURE_MIGRATIONS
+from group_commit import GroupCommitQueue
+from money import MoneyFormat
+from fx import convert_totals, to_decimal
+import base64
+import functools
+import importlib
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+change_log_logger = logging.getLogger('asset_manager.changes')
+
+READ_ROUTES = registry.counter(
+    'db_read_routes_total', '一覧・集計などの読み取りを送った接続先（primary / replica）の件数', ('target',))
+
+class ChangeLogExpiredError(Exception):
+    """差分同期のカーソルが圧縮済みの範囲を指している（一覧の再取得が必要）"""
+
+def _ping(conn):
+    conn.execute('SELECT 1').fetchall()
+
+def bumps_version(method):
+    """書き込みメソッドが成功した後にデータバージョンを進める（応答キャッシュ・ETagの無効化用）
+
+    あわせて一定回数の書き込みごとに変更ログの圧縮を予約する。例外で終わった書き込みはロールバック
+    されているため、どちらも行わない。
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.data_version.bump()
+        self._maybe_compact_changes()
+        return result
+    return wrapper
+
+# 部分更新でも文のかたちが変わらないよう、列ごとに「更新するか」のフラグと値を渡す
+UPDATABLE_FIELDS = ('name', 'amount', 'quantity', 'description', 'category', 'currency')
+PARTIAL_UPDATE_SET = ', '.join(f'{field} = CASE WHEN ? = 1 THEN ? ELSE {field} END' for field in UPDATABLE_FIELDS)
+
+def partial_update_params(asset_data: Dict) -> List:
+    params = []
+    for field in UPDATABLE_FIELDS:
+        params.extend([1 if field in asset_data else 0, asset_data.get(field)])
+    return params
+
+def coalesce_changes(entries: List[Tuple[int, int, str]], assets_by_id: Dict[int, Dict]) -> List[Dict]:
+    """変更ログ (id, asset_id, op) を資産ごとに1件へまとめる
+
+    最後の変更が削除なら削除、範囲内に追加があれば追加、それ以外は更新として、
+    追加・更新には現在の行を添える。行がすでに無い資産は削除として返す。
+    """
+    latest = {}
+    inserted = set()
+    for _, asset_id, op in entries:
+        latest.pop(asset_id, None)
+        latest[asset_id] = op
+        if op == 'I':
+            inserted.add(asset_id)
+    changes = []
+    for asset_id, op in latest.items():
+        asset = assets_by_id.get(asset_id)
+        if op == 'D' or asset is None:
+            changes.append({'op': 'delete', 'id': asset_id})
+        else:
+            changes.append({'op': 'insert' if asset_id in inserted else 'update', 'id': asset_id, 'asset': asset})
+    return changes
+
+# 記号・空白・アンダースコア以外の連続を1つの検索語とする
+SEARCH_TERM = re.compile(r'[^\W_]+')
+
+def parse_search_terms(query: str) -> List[str]:
+    """検索文字列を検索語に分ける（重複は除く）"""
+    terms = []
+    for term in SEARCH_TERM.findall(query or ''):
+        if term.lower() not in (t.lower() for t in terms):
+            terms.append(term)
+    return terms
+
+def search_grams(term: str) -> List[str]:
+    """検索語を索引と同じ2文字ずつの語に分ける（1文字の語はそのまま）"""
+    if len(term) == 1:
+        return [term]
+    return [term[i:i + 2] for i in range(len(term) - 1)]
+
+def fts5_query(terms: List[str]) -> str:
+    """検索語をFTS5の検索式にする
+
+    2文字以上の語は2文字ずつの語が連続するフレーズ（＝部分文字列として含む）、
+    1文字の語はその文字で始まる語の前方一致とし、すべての語をANDで結ぶ。
+    """
+    parts = []
+    for term in terms:
+        phrase = '"' + ' '.join(search_grams(term)) + '"'
+        parts.append(phrase + '*' if len(term) == 1 else phrase)
+    return ' AND '.join(parts)
+
+# 検索結果の並び順: 検索語ごとに、名前に含む +10、名前の先頭に一致 +5、カテゴリに含む +5、説明に含む +1
+SQLITE_SEARCH_SCORE = (
+    "(instr(lower(a.name), lower(t.value)) > 0) * 10 + (instr(lower(a.name), lower(t.value)) = 1) * 5"
+    " + (instr(lower(COALESCE(a.category, '')), lower(t.value)) > 0) * 5"
+    " + (instr(lower(COALESCE(a.description, '')), lower(t.value)) > 0)"
+)
+AZURE_SEARCH_SCORE = (
+    "CASE WHEN CHARINDEX(t.value, a.name) > 0 THEN 10 ELSE 0 END + CASE WHEN CHARINDEX(t.value, a.name) = 1 THEN 5 ELSE 0 END"
+    " + CASE WHEN CHARINDEX(t.value, COALESCE(a.category, N'')) > 0 THEN 5 ELSE 0 END"
+    " + CASE WHEN CHARINDEX(t.value, COALESCE(a.description, N'')) > 0 THEN 1 ELSE 0 END"
+)
+
+def like_escape(value: str) -> str:
+    """SQL ServerのLIKEで特別な意味を持つ文字をエスケープする"""
+    return re.sub(r'([\[%_])', r'[\1]', value)
+
+def search_page(rows: List[Dict], limit: int, offset: int, max_candidates: int) -> Dict:
+    """検索結果の1ページ分を応答の形にする（rows の total 列は候補の総数）"""
+    total = rows[0]['total'] if rows else 0
+    for row in rows:
+        del row['total']
+    return {
+        'items': rows,
+        'total': total,
+        # 候補は新しいものから max_candidates 件までに絞っているため、それ以上は数えない
+        'total_is_lower_bound': total >= max_candidates,
+        'next_offset': offset + limit if rows and offset + limit < total else None,
+    }
+
+def encode_cursor(asset: Dict) -> str:
+    """一覧の最終行から次ページ取得用のカーソル文字列を作る"""
+    created_at = asset['created_at']
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat(sep=' ')
+    raw = json.dumps([created_at, asset['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """カーソル文字列を (created_at, id) に戻す"""
+    try:
+        created_at, asset_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(created_at), int(asset_id)
+    except (ValueError, TypeError):
+        raise ValueError('カーソルが不正です')
+
+def build_asset_filters(filters: Optional[Dict], cursor: Optional[Tuple[str, int]] = None,
+                        money: Optional[MoneyFormat] = None) -> Tuple[str, List]:
+    """一覧用のWHERE句とパラメータを組み立てる（SQLite / Azure SQL共通）
+
+    金額の範囲は表示用の値で受け取る。整数で保存している場合は、資産の通貨の桁数に合わせた境界値と比べる。
+    """
+    clauses = []
+    params = []
+    filters = filters or {}
+    if filters.get('category') is not None:
+        clauses.append('category = ?')
+        params.append(filters['category'])
+    for key, operator, upper in (('min_amount', '>=', False), ('max_amount', '<=', True)):
+        if filters.get(key) is None:
+            continue
+        if money is not None and money.minor:
+            bound, bound_params = money.bound_sql(filters[key], upper)
+            clauses.append(f'amount {operator} {bound}')
+            params.extend(bound_params)
+        else:
+            clauses.append(f'amount {operator} ?')
+            params.append(filters[key])
+    if filters.get('created_from') is not None:
+        clauses.append('created_at >= ?')
+        params.append(filters['created_from'])
+    if filters.get('created_to') is not None:
+        clauses.append('created_at < ?')
+        params.append(filters['created_to'])
+    if cursor is not None:
+        # (created_at, id) の降順でキーセットページング
+        clauses.append('(created_at < ? OR (created_at = ? AND id < ?))')
+        params.extend([cursor[0], cursor[0], cursor[1]])
+    where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+    return where, params
+
+def sql_literal(value) -> str:
+    """SQL Serverのリテラルに変換する（実行計画の確認でパラメータを埋め込むため）"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float, Decimal)):
+        return repr(value) if isinstance(value, float) else str(value)
+    if isinstance(value, datetime):
+        value = value.isoformat(sep=' ')
+    return "N'" + str(value).replace("'", "''") + "'"
+
+def inline_params(sql: str, params) -> str:
+    """文中の ? （文字列リテラルの中は除く）をパラメータのリテラルに置き換える"""
+    values = iter(params or ())
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\?', lambda m: sql_literal(next(values)), parts[i])
+    return ''.join(parts)
+
+SHOWPLAN_NS = '{http://schemas.microsoft.com/sqlserver/2004/07/showplan}'
+
+def showplan_lines(document: str) -> List[str]:
+    """SHOWPLAN_XML の演算子を「物理演算子 テーブル.インデックス」の行にする（入れ子は字下げで表す）"""
+    lines = []
+
+    def walk(element, depth):
+        for child in element:
+            if child.tag == SHOWPLAN_NS + 'RelOp':
+                target = next((obj for op in child for obj in op if obj.tag == SHOWPLAN_NS + 'Object'), None)
+                line = child.get('PhysicalOp')
+                if target is not None:
+                    index = target.get('Index', '').strip('[]')
+                    # 主キーの制約名はデータベースごとに自動で付くため、比較できるように揃える
+                    index = 'PK' if index.startswith('PK__') else index
+                    line += ' ' + target.get('Table', '').strip('[]') + (f'.{index}' if index else '')
+                lines.append('  ' * depth + line)
+                walk(child, depth + 1)
+            else:
+                walk(child, depth)
+    walk(ElementTree.fromstring(document), 0)
+    return lines
+
+# 評価額の推移の粒度ごとの集計テーブル
+VALUE_ROLLUP_TABLES = {'day': 'asset_value_daily', 'month': 'asset_value_monthly'}
+
+JOB_COLUMNS = ('id', 'kind', 'params', 'status', 'processed', 'total', 'result', 'error', 'artifact', 'owner',
+               'cancel_requested', 'created_at', 'started_at', 'finished_at')
+
+SAMPLE_ASSETS = [
+    ('現金', 500000, 1, '手元現金', '現金'),
+    ('株式', 1000000, 100, 'A社の株式', '株式'),
+    ('不動産', 30000000, 1, '自宅', '不動産'),
+    ('預金', 2000000, 1, '銀行預金', '預金'),
+]
 
 class AssetRepository:
-    def get_all(self) -> List[Dict]:
+    pool: ConnectionPool
+    # DATABASE_READ_URL が設定されていれば読み取り専用の接続のプール、無ければ None
+    read_pool: Optional[ConnectionPool] = None
+    data_version: DataVersion
+    MIGRATIONS: List[Tuple[int, str, List[str]]] = []
+    def _load_driver(self, module_name: str):
+        # 使うバックエンドのドライバーだけを読み込む（SQLite環境ではpyodbcを読み込まない）
+        started = time.perf_counter()
+        self._driver = importlib.import_module(module_name)
+        self.startup_timings = {'driver_import': time.perf_counter() - started}
+    def _initialize(self):
+        """最初の接続とスキーマの確認を行い、起動時間の内訳を記録する"""
+        started = time.perf_counter()
+        with self.get_connection():
+            pass
+        self.startup_timings['connect'] = time.perf_counter() - started
+        started = time.perf_counter()
+        self.startup_timings['schema_migrated'] = self.init_table()
+        self.startup_timings['schema'] = time.perf_counter() - started
+        self._writes = itertools.count(1)
+        self._compacting = threading.Lock()
+        self._compactor = None
+        self.write_queue = None
+        self.money = self._read_money_format()
+        if config.MONEY_STORAGE == 'minor' and not self.money.minor:
+            if self.has_assets():
+                print("金額は従来の形式で保存されています。整数で保存するには python manage.py money convert を実行してください")
+            else:
+                self.convert_money_storage(config.CURRENCY, config.MONEY_SCALE)
+        if config.GROUP_COMMIT:
+            self.write_queue = GroupCommitQueue(
+                self.get_connection,
+                max_latency=config.GROUP_COMMIT_MAX_LATENCY_MS / 1000,
+                max_batch=config.GROUP_COMMIT_MAX_BATCH,
+            )
+    def init_table(self) -> bool:
+        """スキーマを最新版まで移行する。最新であればDDLは実行せず False を返す"""
+        latest = self.MIGRATIONS[-1][0]
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self._read_schema_version(cursor) >= latest:
+                return False
+            # 複数のプロセスが同時に起動しても、移行は1つずつ行われるようにする
+            self._lock_schema(cursor)
+            try:
+                current = self._read_schema_version(cursor)
+                if current >= latest:
+                    # 待っている間に他のプロセスが移行を終えていた
+                    conn.commit()
+                    return False
+                for version, description, statements in self.MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for statement in statements:
+                        cursor.execute(statement)
+                    print(f"スキーマを移行しました: v{version} {description}")
+                cursor.execute('DELETE FROM schema_version')
+                cursor.execute('INSERT INTO schema_version (version) VALUES (?)', (latest,))
+                conn.commit()
+            finally:
+                self._unlock_schema(cursor)
+            return True
+    def get_schema_version(self) -> Dict:
+        with self.get_connection() as conn:
+            current = self._read_schema_version(conn.cursor())
+        return {'current': current, 'latest': self.MIGRATIONS[-1][0]}
+    def _read_schema_version(self, cursor) -> int:
+        try:
+            cursor.execute('SELECT MAX(version) FROM schema_version')
+            return cursor.fetchone()[0] or 0
+        except self._driver.Error:
+            return 0
+    def _lock_schema(self, cursor):
+        raise NotImplementedError
+    def _unlock_schema(self, cursor):
+        pass
+    def _read_money_format(self) -> MoneyFormat:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT currency, scale FROM money_storage')
+            row = cursor.fetchone()
+        return MoneyFormat(row[0].strip(), row[1]) if row else MoneyFormat(default_currency=config.CURRENCY)
+    def has_assets(self) -> bool:
+        raise NotImplementedError
+    def _create_pool(self, connect) -> ConnectionPool:
+        return ConnectionPool(
+            connect,
+            max_size=config.POOL_SIZE,
+            timeout=config.POOL_TIMEOUT,
+            recycle=config.POOL_RECYCLE,
+            ping_interval=config.POOL_PING_INTERVAL,
+            ping=_ping,
+        )
+    def get_connection(self):
+        return instrumented_connection(self.pool)
+    def get_read_connection(self):
+        """一覧・集計など、多少古くても構わない読み取りに使う接続
+
+        読み取り用の接続先が設定されていても、最後の書き込み（他のプロセスの書き込みを含む）から
+        READ_REPLICA_MAX_STALENESS 秒の間はプライマリを使う。書き込んだ直後の読み取りに書き込んだ内容が
+        反映されていること（read-your-own-writes）と、古い内容の応答を新しいデータバージョンで
+        キャッシュしないことのため。
+        """
+        if self.read_pool is None or self._replica_may_lag():
+            READ_ROUTES.inc('primary')
+            return instrumented_connection(self.pool)
+        READ_ROUTES.inc('replica')
+        return instrumented_connection(self.read_pool)
+    def _replica_may_lag(self) -> bool:
+        self.data_version.current  # 他のプロセスの書き込みを確認する
+        return time.monotonic() - self.data_version.changed_at < config.READ_REPLICA_MAX_STALENESS
+    def get_pool_stats(self) -> Dict:
+        stats = self.pool.stats()
+        if self.read_pool is not None:
+            stats['read'] = self.read_pool.stats()
+        return stats
+    def shared_version(self):
+        """データベースが変更されるたびに変わる値（他のプロセスの書き込みを検出してキャッシュを無効にするため）"""
+        raise NotImplementedError
+    def close(self):
+        if self.write_queue is not None:
+            self.write_queue.close()
+        if self._compactor is not None:
+            # 実行中の変更ログの圧縮を待ってから接続を閉じる
+            self._compactor.shutdown(wait=True)
+            self._compactor = None
+        self.pool.close()
+        if self.read_pool is not None:
+            self.read_pool.close()
+    def get_all(self, factors: Optional[Dict[str, Decimal]] = None) -> List[Dict]:
+        raise NotImplementedError
+    def list_assets(self, limit: int, cursor: Optional[Tuple[str, int]] = None,
+                    filters: Optional[Dict] = None, factors: Optional[Dict[str, Decimal]] = None) -> List[Dict]:
+        """factors（通貨ごとの報告通貨への係数）を渡すと、報告通貨での評価額を value 列としてSQLで求める"""
+        raise NotImplementedError
+    def iter_assets(self, filters: Optional[Dict] = None, batch_size: Optional[int] = None,
+                    factors: Optional[Dict[str, Decimal]] = None) -> Iterator[Dict]:
+        raise NotImplementedError
+    def _value_column(self, factors: Optional[Dict[str, Decimal]]) -> Tuple[str, List]:
+        """報告通貨での評価額（金額×数量×係数、保存形式の桁数に丸める）を求める列とそのパラメータ
+
+        係数は通貨コードをキーにしたJSON1つで渡すため、通貨の数によらず同じ文になる。レートの無い通貨の資産は NULL。
+        """
         raise NotImplementedError
     def get_by_id(self, asset_id: int) -> Optional[Dict]:
         raise NotImplementedError
+    def get_by_ids(self, asset_ids: List[int]) -> List[Dict]:
+        raise NotImplementedError
+    def iter_analytics_rows(self, batch_size: Optional[int] = None) -> Iterator[List[Tuple]]:
+        """分析用スナップショットの読み込み用に (id, amount, quantity, category, currency) を id順にバッチで返す"""
+        raise NotImplementedError
+    def _write(self, func, *args):
+        """func(cursor, *args) を実行してコミットする
+
+        グループコミットが有効な場合は書き込みキューに渡し、他の書き込みと同じトランザクションでコミットする。
+        """
+        if self.write_queue is not None:
+            return self.write_queue.submit(lambda cursor: func(cursor, *args))
+        with self.get_connection() as conn:
+            result = func(conn.cursor(), *args)
+            conn.commit()
+            return result
+    @bumps_version
     def create(self, asset_data: Dict) -> Dict:
+        return self._write(self._create, asset_data)
+    def _create(self, cursor, asset_data: Dict) -> Dict:
+        raise NotImplementedError
+    def insert_many(self, rows: List[Tuple]) -> int:
         raise NotImplementedError
+    @bumps_version
     def update(self, asset_id: int, asset_data: Dict) -> Optional[Dict]:
+        if not any(field in asset_data for field in UPDATABLE_FIELDS):
+            return self.get_by_id(asset_id)
+        return self._write(self._update, asset_id, asset_data)
+    def _update(self, cursor, asset_id: int, asset_data: Dict) -> Optional[Dict]:
+        raise NotImplementedError
+    def update_many(self, asset_ids: List[int], asset_data: Dict) -> List[Dict]:
         raise NotImplementedError
+    @bumps_version
     def delete(self, asset_id: int) -> bool:
+        return self._write(self._delete, asset_id)
+    def _delete(self, cursor, asset_id: int) -> bool:
+        raise NotImplementedError
+    def delete_many(self, asset_ids: List[int]) -> List[int]:
+        raise NotImplementedError
+    def get_category_totals(self) -> List[Dict]:
+        """(カテゴリ, 通貨) ごとの評価額の合計（保存形式の値）と件数。トリガーで維持している集計を読むだけ"""
+        raise NotImplementedError
+    def get_summary(self, currency: Optional[str] = None, factors: Optional[Dict[str, Decimal]] = None) -> Dict:
+        """カテゴリ別・通貨別の集計を報告通貨 currency（省略時は既定の通貨）に換算して返す
+
+        換算は (カテゴリ, 通貨) ごとの合計に対して行うため、計算量は資産の件数ではなく「カテゴリ数 × 通貨数」に比例する。
+        factors は各通貨から報告通貨への係数（FxRates.factors の結果）で、省略すると報告通貨の資産だけを換算できる。
+        レートの無い通貨の資産は合計に含めず（件数には含める）、unconverted_currencies に挙げる。
+        """
+        return self.summarize(self.get_category_totals(), currency, factors)
+    def summarize(self, totals: Iterable[Dict], currency: Optional[str] = None,
+                  factors: Optional[Dict[str, Decimal]] = None) -> Dict:
+        """get_category_totals の行（複数のデータベースの行を連結したものでもよい）を集計・換算する"""
+        currency = currency or self.money.default_currency
+        if factors is None:
+            factors = {currency: Decimal(1)}
+        categories, currencies = {}, {}
+        for row in totals:
+            native = to_decimal(row['total'])
+            factor = factors.get(row['currency'])
+            converted = native * factor if factor is not None else None
+            category = categories.setdefault(row['category'], {'total': Decimal(0), 'count': 0})
+            category['count'] += row['count']
+            by_currency = currencies.setdefault(row['currency'], {'total': Decimal(0), 'count': 0, 'converted': None})
+            by_currency['total'] += native
+            by_currency['count'] += row['count']
+            if converted is not None:
+                category['total'] += converted
+                by_currency['converted'] = (by_currency['converted'] or 0) + converted
+        category_summary = [
+            {'category': category, 'total': self._reporting_value(item['total']), 'count': item['count']}
+            for category, item in categories.items()
+        ]
+        currency_summary = [
+            {'currency': code, 'total': self._reporting_value(item['total']), 'count': item['count'],
+             'converted': self._reporting_value(item['converted']) if item['converted'] is not None else None}
+            for code, item in sorted(currencies.items())
+        ]
+        total_amount = sum((item['total'] for item in categories.values()), Decimal(0))
+        return {
+            'currency': currency,
+            'total_amount': self._reporting_value(total_amount),
+            'category_summary': category_summary,
+            'currency_summary': currency_summary,
+            'unconverted_currencies': [item['currency'] for item in currency_summary if item['converted'] is None],
+        }
+    def _reporting_value(self, value: Decimal):
+        # 整数で保存している場合は補助通貨単位の整数、従来の形式では小数点以下2桁に丸める
+        if self.money.minor:
+            return int(value.to_integral_value())
+        return float(value.quantize(Decimal('0.01')))
+    def list_portfolios(self) -> List[str]:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id FROM portfolios ORDER BY id')
+            return [row[0] for row in cursor.fetchall()]
+    def register_portfolio(self, portfolio_id: str) -> bool:
+        """ポートフォリオを一覧に加える（すでにあれば False）"""
+        raise NotImplementedError
+    def search(self, terms: List[str], limit: int, offset: int = 0) -> Dict:
+        """名前・説明・カテゴリを全文検索し、関連度の高い順に返す（terms は parse_search_terms の結果）"""
+        raise NotImplementedError
+    def rebuild_category_totals(self):
+        raise NotImplementedError
+    def get_change_cursor(self) -> int:
+        """差分同期の起点となる、最新の変更ログのid"""
+        raise NotImplementedError
+    def get_changes(self, since: int, limit: int) -> Dict:
+        """since より後の変更を資産ごとにまとめて返す
+
+        since が圧縮済みの範囲なら ChangeLogExpiredError を送出する。
+        """
+        raise NotImplementedError
+    def compact_changes(self, keep: Optional[int] = None) -> int:
+        """最新の keep 件を残して変更ログを削除し、削除した件数を返す"""
+        raise NotImplementedError
+
+    def _maybe_compact_changes(self):
+        interval = config.CHANGE_LOG_COMPACT_INTERVAL
+        if interval <= 0 or next(self._writes) % interval:
+            return
+        # 圧縮は書き込んだリクエストを待たせないよう専用のスレッドで行う。前回の圧縮がまだ終わって
+        # いなければ今回は見送る（次の機会にまとめて削除される）
+        if not self._compacting.acquire(blocking=False):
+            return
+        try:
+            if self._compactor is None:
+                self._compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='change-log-compactor')
+            self._compactor.submit(self._compact_changes_in_background)
+        except RuntimeError:
+            # close() と同時に行われた書き込み（圧縮用のスレッドは停止済み）
+            self._compacting.release()
+
+    def _compact_changes_in_background(self):
+        try:
+            self.compact_changes()
+        except Exception as e:
+            # 圧縮に失敗しても書き込みには影響しないため、警告だけ出して次の機会に回す
+            change_log_logger.warning('変更ログの圧縮に失敗しました: %s', e)
+        finally:
+            self._compacting.release()
+
+    def verify_category_totals(self, tolerance: float = 0.005) -> List[Dict]:
+        """asset_category_totals を assets から再計算した値と比較し、ずれのあるカテゴリを返す
+
+        金額を整数で保存している場合は誤差を許さずに比較する。
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COALESCE(category, ''), currency, SUM(amount * quantity), COUNT(*)
+                FROM assets GROUP BY COALESCE(category, ''), currency
+            ''')
+            expected = {(row[0], row[1].strip()): (row[2] or 0, row[3]) for row in cursor.fetchall()}
+            cursor.execute('SELECT category, currency, total, asset_count FROM asset_category_totals WHERE asset_count <> 0')
+            stored = {(row[0], row[1].strip()): (row[2], row[3]) for row in cursor.fetchall()}
+        drift = []
+        for category, currency in sorted(set(expected) | set(stored)):
+            exp_total, exp_count = expected.get((category, currency), (0, 0))
+            got_total, got_count = stored.get((category, currency), (0, 0))
+            if self.money.minor:
+                exp_total = self.money.to_display(int(exp_total), currency)
+                got_total = self.money.to_display(int(got_total), currency)
+                differs = exp_total != got_total
+            else:
+                differs = abs(float(exp_total) - float(got_total)) > tolerance
+            if exp_count != got_count or differs:
+                drift.append({
+                    'category': category or None,
+                    'currency': currency,
+                    'expected_total': float(exp_total), 'stored_total': float(got_total),
+                    'expected_count': exp_count, 'stored_count': got_count,
+                })
+        return drift
+    @bumps_version
+    def convert_money_storage(self, currency: str, scale: Optional[int] = None) -> Dict:
+        """金額を補助通貨単位の整数で保存する形式に変換する（既存のデータベースの移行用）
+
+        桁数は資産の通貨ごとに決まる（currency の資産は scale 桁、ほかの通貨は標準の桁数）。
+        変換前の金額から正確に求めたカテゴリ・通貨別の合計（金額×数量）・件数と、変換後にSQLで整数のまま
+        集計した値が一致しなければ、ロールバックして ValueError を送出する。
+        """
+        if self.money.minor:
+            raise ValueError(f'金額はすでに整数で保存されています（{self.money.currency}、小数点以下{self.money.scale}桁）')
+        money = MoneyFormat(currency, scale)
+        started = time.perf_counter()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self._lock_assets(cursor)
+                # 変換前の値を1行ずつ整数に直して合計する（SQLのSUMは浮動小数点の誤差を含みうるため使わない）
+                expected, inexact = {}, 0
+                cursor.execute('SELECT category, currency, amount, quantity FROM assets')
+                while True:
+                    rows = cursor.fetchmany(config.STREAM_BATCH_SIZE)
+                    if not rows:
+                        break
+                    for category, code, amount, quantity in rows:
+                        try:
+                            minor = money.to_storage(amount, code)
+                        except ValueError:
+                            inexact += 1
+                            continue
+                        key = (category or '', code.strip())
+                        total, count = expected.get(key, (0, 0))
+                        expected[key] = (total + minor * quantity, count + 1)
+                if inexact:
+                    raise ValueError(f'通貨ごとの小数点以下の桁数で表せない金額が{inexact}件あります')
+                cursor.execute(f'''
+                    SELECT {self.CATEGORY_KEY}, currency, SUM(amount * quantity) FROM assets
+                    GROUP BY {self.CATEGORY_KEY}, currency
+                ''')
+                previous = {(row[0], row[1].strip()): row[2] for row in cursor.fetchall()}
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM asset_changes')
+                last_change = cursor.fetchone()[0]
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM asset_valuations')
+                last_valuation = cursor.fetchone()[0]
+                self._convert_amounts(cursor, money)
+                cursor.execute(f'''
+                    SELECT {self.CATEGORY_KEY}, currency, SUM(amount * quantity), COUNT(*) FROM assets
+                    GROUP BY {self.CATEGORY_KEY}, currency
+                ''')
+                converted = {(row[0], row[1].strip()): (int(row[2]), row[3]) for row in cursor.fetchall()}
+                if converted != expected:
+                    raise ValueError('変換後のカテゴリ・通貨別の合計・件数が変換前と一致しません')
+                # 表示上の値は変わらないため、変換で記録された変更ログと評価額の履歴は取り除き、
+                # それまでの履歴を補助通貨単位に直して日次・月次の集計を作り直す
+                cursor.execute('DELETE FROM asset_changes WHERE id > ?', (last_change,))
+                cursor.execute('DELETE FROM asset_valuations WHERE id > ?', (last_valuation,))
+                self._scale_valuations(cursor, money)
+                self._rebuild_value_rollups(cursor)
+                cursor.execute('INSERT INTO money_storage (currency, scale) VALUES (?, ?)', (money.currency, money.scale))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self.money = money
+        categories = [
+            {
+                'category': category or None,
+                'currency': code,
+                'count': count,
+                'total': money.to_display(total, code),
+                # 変換前にSQLで集計した値（SQLiteでは浮動小数点の誤差を含む）
+                'previous_total': float(previous.get((category, code)) or 0),
+            }
+            for (category, code), (total, count) in sorted(expected.items())
+        ]
+        totals = {}
+        for (_, code), (total, _) in expected.items():
+            totals[code] = totals.get(code, 0) + total
+        return {
+            **money.describe(),
+            'rows': sum(item['count'] for item in categories),
+            'totals': {code: money.to_display(total, code) for code, total in sorted(totals.items())},
+            'categories': categories,
+            'seconds': round(time.perf_counter() - started, 3),
+        }
+    def _lock_assets(self, cursor):
+        raise NotImplementedError
+    def _convert_amounts(self, cursor, money: MoneyFormat):
+        """assets.amount を補助通貨単位の整数に置き換え、カテゴリ別集計を作り直す"""
+        raise NotImplementedError
+    def _scale_valuations(self, cursor, money: MoneyFormat):
+        """評価額の履歴の金額を補助通貨単位の整数に置き換える"""
         raise NotImplementedError
-    def get_summary(self) -> Dict:
+    def _rebuild_value_rollups(self, cursor):
+        """評価額の履歴から日次・月次の集計を作り直す"""
+        raise NotImplementedError
+    @bumps_version
+    def rebuild_value_rollups(self):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._lock_assets(cursor)
+            try:
+                self._rebuild_value_rollups(cursor)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    def get_value_history(self, granularity: str, start: Optional[str] = None, end: Optional[str] = None,
+                          currency: Optional[str] = None, factors: Optional[Dict[str, Decimal]] = None) -> Dict:
+        """日次（day）または月次（month）の集計から、評価額の合計の推移を返す
+
+        points には期間中に変更のあった期間だけが含まれ、変更の無い期間の値は直前の点と同じ。
+        opening_value は start より前の最後の期間の終わりの評価額。集計は通貨ごとに持っており、
+        報告通貨 currency への換算は集計の行に対して行う（過去の期間も factors の係数で換算する）。
+        """
+        currency = currency or self.money.default_currency
+        if factors is None:
+            factors = {currency: Decimal(1)}
+        table = VALUE_ROLLUP_TABLES[granularity]
+        clauses, params = [], []
+        if start is not None:
+            clauses.append('period >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append('period <= ?')
+            params.append(end)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            closing = {}
+            if start is not None:
+                cursor.execute(f'''
+                    SELECT r.currency, r.closing_value FROM {table} AS r
+                    WHERE r.period = (SELECT MAX(period) FROM {table} WHERE currency = r.currency AND period < ?)
+                ''', (start,))
+                closing = {row[0].strip(): to_decimal(row[1]) for row in cursor.fetchall()}
+            cursor.execute(f'''
+                SELECT period, currency, closing_value, net_change, change_count FROM {table}{where}
+                ORDER BY period, currency
+            ''', params)
+            rows = cursor.fetchall()
+        missing = set()
+
+        def convert(values):
+            total, unconverted = convert_totals(values, factors)
+            missing.update(unconverted)
+            return total
+        opening_value = convert(closing.items())
+        points = []
+        for period, group in itertools.groupby(rows, key=lambda row: row[0]):
+            changes, count = [], 0
+            for _, code, closing_value, net_change, change_count in group:
+                code = code.strip()
+                closing[code] = to_decimal(closing_value)
+                changes.append((code, net_change))
+                count += change_count
+            points.append({'period': str(period), 'value': self._reporting_value(convert(closing.items())),
+                           'change': self._reporting_value(convert(changes)), 'changes': count})
+        return {
+            'granularity': granularity,
+            'currency': currency,
+            'opening_value': self._reporting_value(opening_value),
+            'points': points,
+            'unconverted_currencies': sorted(missing),
+        }
+    def explain(self, sql: str, params=None) -> List[str]:
+        """文を実行せずに実行計画を求め、演算子ごとの行（入れ子は字下げ）で返す（python query_plans.py で使う）"""
         raise NotImplementedError
     def insert_sample_data(self):
         raise NotImplementedError
+    def revalue_assets(self, factor: str, category: Optional[str], after_id: int, limit: int) -> List[int]:
+        """id が after_id より大きい資産を id順に最大 limit 件選び、金額を factor 倍にする（更新したidを返す）
 
-class SQLiteAssetRepository(AssetRepository):
-    def __init__(self, db_path: str = 'assets.db'):
-        self.db_path = db_path
-        self.init_table()
-    def get_connection(self):
-        return sqlite3.connect(self.db_path)
-    def init_table(self):
+        金額は保存形式の桁数（整数で保存している場合は補助通貨単位、従来の形式では小数点以下2桁）に丸める。
+        """
+        raise NotImplementedError
+    def _insert_job(self, cursor, kind: str, params: str, owner: str) -> int:
+        raise NotImplementedError
+    def create_job(self, kind: str, params: Dict, owner: str) -> Dict:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            job_id = self._insert_job(cursor, kind, json.dumps(params, ensure_ascii=False), owner)
+            conn.commit()
+        return self.get_job(job_id)
+    def _job_from_row(self, row) -> Dict:
+        job = dict(zip(JOB_COLUMNS, row))
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['cancel_requested'] = bool(job['cancel_requested'])
+        return job
+    def get_job(self, job_id: int) -> Optional[Dict]:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+        return self._job_from_row(row) if row else None
+    def list_jobs(self, limit: int, active_only: bool = False) -> List[Dict]:
+        where = " WHERE status IN ('queued', 'running')" if active_only else ''
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs{where} ORDER BY id DESC')
+            rows = cursor.fetchmany(limit)
+        return [self._job_from_row(row) for row in rows]
+    def start_job(self, job_id: int) -> bool:
+        """待機中のジョブを実行中にする（開始前に取り消されていれば False）"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'queued'
+            ''', (job_id,))
+            started = cursor.rowcount > 0
+            conn.commit()
+        return started
+    def update_job_progress(self, job_id: int, processed: int, total: Optional[int]) -> bool:
+        """進捗を記録し、取り消しが要求されていれば True を返す"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE jobs SET processed = ?, total = ? WHERE id = ?', (processed, total, job_id))
+            cursor.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            conn.commit()
+        return bool(row and row[0])
+    def finish_job(self, job_id: int, status: str, result: Optional[Dict] = None, error: Optional[str] = None,
+                   artifact: Optional[str] = None):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET status = ?, result = ?, error = ?, artifact = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, artifact,
+                  job_id))
+            conn.commit()
+    def cancel_job(self, job_id: int) -> Optional[Dict]:
+        """ジョブの取り消しを要求する。待機中のジョブはその場で取り消し済みにし、実行中のジョブは次の進捗の記録で止まる"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS assets (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name VARCHAR(255) NOT NULL,
-                    amount DECIMAL(15,2) NOT NULL,
-                    quantity INTEGER NOT NULL DEFAULT 1,
-                    description TEXT,
-                    category VARCHAR(100),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                UPDATE jobs SET cancel_requested = 1,
+                    status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                    finished_at = CASE WHEN status = 'queued' THEN CURRENT_TIMESTAMP ELSE finished_at END
+                WHERE id = ? AND status IN ('queued', 'running')
+            ''', (job_id,))
+            conn.commit()
+        return self.get_job(job_id)
+    def delete_jobs(self, finished_before: str) -> List[str]:
+        """finished_before より前に終了したジョブを削除し、削除したジョブの成果物のファイル名を返す"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT artifact FROM jobs
+                WHERE status IN ('succeeded', 'failed', 'cancelled') AND finished_at < ?
+            ''', (finished_before,))
+            artifacts = [row[0] for row in cursor.fetchall() if row[0]]
+            cursor.execute('''
+                DELETE FROM jobs WHERE status IN ('succeeded', 'failed', 'cancelled') AND finished_at < ?
+            ''', (finished_before,))
+            conn.commit()
+        return artifacts
+
+class SQLiteAssetRepository(AssetRepository):
+    MIGRATIONS = SQLITE_MIGRATIONS
+    CATEGORY_KEY = "COALESCE(category, '')"
+    def __init__(self, db_path: str = 'assets.db', read_path: Optional[str] = None):
+        self._load_driver('sqlite3')
+        self.db_path = db_path
+        self.read_path = read_path
+        self._monitor = None
+        self.data_version = DataVersion(self.shared_version, config.DATA_VERSION_CHECK_INTERVAL)
+        self.pool = self._create_pool(self._connect)
+        self._initialize()
+        # 読み取り専用の接続はスキーマの移行が済んでから開く
+        if read_path:
+            self.read_pool = self._create_pool(self._connect_read)
+    def _connect(self):
+        # 接続はプール内で使い回すため、PRAGMAは接続確立時に一度だけ設定する
+        conn = self._driver.connect(self.db_path, timeout=config.POOL_TIMEOUT, check_same_thread=False)
+        conn.row_factory = self._driver.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}')
+        return conn
+    def _connect_read(self):
+        # レプリカの代わりに、同じファイルを読み取り専用（mode=ro）で開く。書き込もうとするとエラーになる。
+        # ジャーナルモード（WAL）はファイルに記録されているため、ここでは設定しない
+        uri = f'file:{urllib.parse.quote(os.path.abspath(self.read_path))}?mode=ro'
+        conn = self._driver.connect(uri, uri=True, timeout=config.POOL_TIMEOUT, check_same_thread=False)
+        conn.row_factory = self._driver.Row
+        conn.execute(f'PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}')
+        return conn
+    def shared_version(self):
+        # PRAGMA data_version は、この接続以外（他のプロセスを含む）がコミットするたびに変わる。
+        # 書き込みに使わない専用の接続で読むため、ファイルのヘッダーを確認するだけで済む
+        if self._monitor is None:
+            self._monitor = self._driver.connect(self.db_path, timeout=config.POOL_TIMEOUT, check_same_thread=False)
+        return self._monitor.execute('PRAGMA data_version').fetchone()[0]
+    def close(self):
+        super().close()
+        if self._monitor is not None:
+            self._monitor.close()
+            self._monitor = None
+    def _lock_schema(self, cursor):
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    def _lock_assets(self, cursor):
+        cursor.execute('BEGIN IMMEDIATE')
+    def _convert_amounts(self, cursor, money: MoneyFormat):
+        # 列の宣言は DECIMAL(15,2)（NUMERIC型親和性）のままでも、整数を入れれば INTEGER として保存される
+        cursor.execute(f'UPDATE assets SET amount = CAST(round(amount * {money.multiplier_sql()}) AS INTEGER)')
+        cursor.execute('DELETE FROM asset_category_totals')
+        cursor.execute('''
+            INSERT INTO asset_category_totals (category, currency, total, asset_count)
+            SELECT COALESCE(category, ''), currency, SUM(amount * quantity), COUNT(*)
+            FROM assets GROUP BY COALESCE(category, ''), currency
+        ''')
+    def _scale_valuations(self, cursor, money: MoneyFormat):
+        multiplier = money.multiplier_sql()
+        cursor.execute(f'''
+            UPDATE asset_valuations SET
+                amount = CAST(round(amount * {multiplier}) AS INTEGER),
+                value = CAST(round(value * {multiplier}) AS INTEGER),
+                delta = CAST(round(delta * {multiplier}) AS INTEGER)
+        ''')
+    def _rebuild_value_rollups(self, cursor):
+        for table, period in (('asset_value_daily', "date(valued_at)"),
+                              ('asset_value_monthly', "strftime('%Y-%m-01', valued_at)")):
+            cursor.execute(f'DELETE FROM {table}')
+            cursor.execute(f'''
+                INSERT INTO {table} (currency, period, closing_value, net_change, change_count)
+                SELECT currency, period, SUM(net_change) OVER (PARTITION BY currency ORDER BY period),
+                       net_change, change_count FROM (
+                    SELECT currency, {period} AS period, SUM(delta) AS net_change, COUNT(*) AS change_count
+                    FROM asset_valuations GROUP BY currency, {period}
                 )
             ''')
-            conn.commit()
-    def get_all(self) -> List[Dict]:
+    def has_assets(self) -> bool:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM assets)')
+            return bool(cursor.fetchone()[0])
+    def explain(self, sql: str, params=None) -> List[str]:
         with self.get_connection() as conn:
-            conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM assets ORDER BY created_at DESC')
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params or ())
+            rows = cursor.fetchall()
+        # (id, parent, notused, detail)。parent をたどって入れ子の深さを求める
+        depths, lines = {0: -1}, []
+        for node_id, parent, _, detail in rows:
+            depths[node_id] = depths.get(parent, -1) + 1
+            lines.append('  ' * depths[node_id] + detail)
+        return lines
+    def _value_column(self, factors: Optional[Dict[str, Decimal]]) -> Tuple[str, List]:
+        if factors is None:
+            return '', []
+        value = 'amount * quantity * (SELECT value FROM json_each(?) WHERE key = currency)'
+        value = f'CAST(round({value}) AS INTEGER)' if self.money.minor else f'round({value}, 2)'
+        return f', {value} AS value', [json.dumps({code: float(factor) for code, factor in factors.items()})]
+    def get_all(self, factors: Optional[Dict[str, Decimal]] = None) -> List[Dict]:
+        value, value_params = self._value_column(factors)
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT *{value} FROM assets ORDER BY created_at DESC, id DESC', value_params)
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
+    def list_assets(self, limit: int, cursor: Optional[Tuple[str, int]] = None,
+                    filters: Optional[Dict] = None, factors: Optional[Dict[str, Decimal]] = None) -> List[Dict]:
+        value, value_params = self._value_column(factors)
+        where, params = build_asset_filters(filters, cursor, self.money)
+        with self.get_read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT *{value} FROM assets{where} ORDER BY created_at DESC, id DESC LIMIT ?',
+                        value_params + params + [limit])
+            return [dict(row) for row in cur.fetchall()]
+    def iter_assets(self, filters: Optional[Dict] = None, batch_size: Optional[int] = None,
+                    factors: Optional[Dict[str, Decimal]] = None) -> Iterator[Dict]:
+        # fetchmanyで少しずつ読み出し、全件をメモリに載せない
+        batch_size = batch_size or config.STREAM_BATCH_SIZE
+        value, value_params = self._value_column(factors)
+        where, params = build_asset_filters(filters, money=self.money)
+        with self.get_read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT *{value} FROM assets{where} ORDER BY created_at DESC, id DESC', value_params + params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
     def get_by_id(self, asset_id: int) -> Optional[Dict]:
         with self.get_connection() as conn:
-            conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM assets WHERE id = ?', (asset_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
-    def create(self, asset_data: Dict) -> Dict:
+    def get_by_ids(self, asset_ids: List[int]) -> List[Dict]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO assets (name, amount, quantity, description, category)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                asset_data.get('name'),
-                asset_data.get('amount'),
-                asset_data.get('quantity', 1),
-                asset_data.get('description'),
-                asset_data.get('category')
-            ))
-            conn.commit()
-            asset_id = cursor.lastrowid
-            return self.get_by_id(asset_id)
-    def update(self, asset_id: int, asset_data: Dict) -> Optional[Dict]:
+            cursor.execute('SELECT * FROM assets WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(asset_ids),))
+            return [dict(row) for row in cursor.fetchall()]
+    def iter_analytics_rows(self, batch_size: Optional[int] = None) -> Iterator[List[Tuple]]:
+        batch_size = batch_size or config.STREAM_BATCH_SIZE
+        with self.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT id, amount, quantity, category, currency FROM assets ORDER BY id')
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [tuple(row) for row in rows]
+    def _create(self, cursor, asset_data: Dict) -> Dict:
+        cursor.execute('''
+            INSERT INTO assets (name, amount, quantity, description, category, currency)
+            VALUES (?, ?, ?, ?, ?, ?)
+            RETURNING *
+        ''', (
+            asset_data.get('name'),
+            asset_data.get('amount'),
+            asset_data.get('quantity', 1),
+            asset_data.get('description'),
+            asset_data.get('category'),
+            asset_data.get('currency') or self.money.default_currency
+        ))
+        return dict(cursor.fetchone())
+    @bumps_version
+    def insert_many(self, rows: List[Tuple]) -> int:
+        # (name, amount, quantity, description, category, currency) のタプルを1トランザクションで挿入する
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            fields = []
-            values = []
-            for key in ['name', 'amount', 'quantity', 'description', 'category']:
-                if key in asset_data:
-                    fields.append(f"{key} = ?")
-                    values.append(asset_data[key])
-            if not fields:
-                return self.get_by_id(asset_id)
-            values.append(asset_id)
-            cursor.execute(f"UPDATE assets SET {', '.join(fields)} WHERE id = ?", values)
+            cursor.executemany('''
+                INSERT INTO assets (name, amount, quantity, description, category, currency)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
             conn.commit()
-            return self.get_by_id(asset_id)
-    def delete(self, asset_id: int) -> bool:
+            return len(rows)
+    def _update(self, cursor, asset_id: int, asset_data: Dict) -> Optional[Dict]:
+        cursor.execute(f'UPDATE assets SET {PARTIAL_UPDATE_SET} WHERE id = ? RETURNING *',
+                       partial_update_params(asset_data) + [asset_id])
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    @bumps_version
+    def update_many(self, asset_ids: List[int], asset_data: Dict) -> List[Dict]:
+        # id一覧はJSON配列1つで渡し、件数によらず同じ文を使う
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('DELETE FROM assets WHERE id = ?', (asset_id,))
+            cursor.execute(f'UPDATE assets SET {PARTIAL_UPDATE_SET} WHERE id IN (SELECT value FROM json_each(?)) RETURNING *',
+                           partial_update_params(asset_data) + [json.dumps(asset_ids)])
+            rows = cursor.fetchall()
             conn.commit()
-            return cursor.rowcount > 0
-    def get_summary(self) -> Dict:
+            return [dict(row) for row in rows]
+    def _delete(self, cursor, asset_id: int) -> bool:
+        cursor.execute('DELETE FROM assets WHERE id = ?', (asset_id,))
+        return cursor.rowcount > 0
+    @bumps_version
+    def delete_many(self, asset_ids: List[int]) -> List[int]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT SUM(amount * quantity) FROM assets')
-            total_amount = cursor.fetchone()[0] or 0
-            cursor.execute('SELECT category, SUM(amount * quantity) as total, COUNT(*) as count FROM assets GROUP BY category')
-            category_summary = [
-                {'category': row[0], 'total': row[1], 'count': row[2]}
+            cursor.execute('DELETE FROM assets WHERE id IN (SELECT value FROM json_each(?)) RETURNING id',
+                           (json.dumps(asset_ids),))
+            deleted = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            return deleted
+    def get_category_totals(self) -> List[Dict]:
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT NULLIF(category, ''), currency, total, asset_count FROM asset_category_totals
+                WHERE asset_count > 0 ORDER BY category, currency
+            ''')
+            return [
+                {'category': row[0], 'currency': row[1], 'total': row[2], 'count': row[3]}
                 for row in cursor.fetchall()
             ]
-            return {'total_amount': total_amount, 'category_summary': category_summary}
+    def register_portfolio(self, portfolio_id: str) -> bool:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT OR IGNORE INTO portfolios (id) VALUES (?)', (portfolio_id,))
+            conn.commit()
+            return cursor.rowcount > 0
+    def search(self, terms: List[str], limit: int, offset: int = 0) -> Dict:
+        # 一致した行のうち新しいものから候補を絞り、その中を SQLITE_SEARCH_SCORE の順に並べる
+        # （bm25は一致する全行の件数を数えるため、よく出る語では遅くなる）
+        max_candidates = config.SEARCH_MAX_CANDIDATES
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT a.*, (
+                    SELECT SUM({SQLITE_SEARCH_SCORE}) FROM json_each(?) AS t
+                ) AS score, COUNT(*) OVER () AS total
+                FROM (
+                    SELECT rowid AS id FROM asset_search WHERE asset_search MATCH ?
+                    ORDER BY rowid DESC LIMIT ?
+                ) AS s
+                JOIN assets AS a ON a.id = s.id
+                ORDER BY score DESC, a.id DESC
+                LIMIT ? OFFSET ?
+            ''', (json.dumps(terms), fts5_query(terms), max_candidates, limit, offset))
+            rows = [dict(row) for row in cursor.fetchall()]
+        return search_page(rows, limit, offset, max_candidates)
+    def get_change_cursor(self) -> int:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT MAX(latest) FROM (
+                    SELECT MAX(id) AS latest FROM asset_changes
+                    UNION ALL SELECT compacted_through FROM asset_change_log
+                )
+            ''')
+            return cursor.fetchone()[0] or 0
+    def get_changes(self, since: int, limit: int) -> Dict:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, asset_id, op FROM asset_changes WHERE id > ? ORDER BY id LIMIT ?', (since, limit))
+            entries = [tuple(row) for row in cursor.fetchall()]
+            # 読み出し後に確認し、読み出し中に圧縮された場合も取りこぼしを検出する
+            cursor.execute('SELECT compacted_through FROM asset_change_log')
+            if since < cursor.fetchone()[0]:
+                raise ChangeLogExpiredError(since)
+            ids = sorted({asset_id for _, asset_id, op in entries if op != 'D'})
+            assets_by_id = {}
+            if ids:
+                cursor.execute('SELECT * FROM assets WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(ids),))
+                assets_by_id = {row['id']: dict(row) for row in cursor.fetchall()}
+        return {
+            'changes': coalesce_changes(entries, assets_by_id),
+            'cursor': entries[-1][0] if entries else since,
+            'has_more': len(entries) == limit,
+        }
+    def compact_changes(self, keep: Optional[int] = None) -> int:
+        keep = max(1, config.CHANGE_LOG_RETENTION if keep is None else keep)
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT MAX(id) FROM asset_changes')
+            through = (cursor.fetchone()[0] or 0) - keep
+            cursor.execute('DELETE FROM asset_changes WHERE id <= ?', (through,))
+            deleted = cursor.rowcount
+            cursor.execute('UPDATE asset_change_log SET compacted_through = ? WHERE compacted_through < ?',
+                           (through, through))
+            conn.commit()
+            return deleted
+    @bumps_version
+    def rebuild_category_totals(self):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('DELETE FROM asset_category_totals')
+            cursor.execute('''
+                INSERT INTO asset_category_totals (category, currency, total, asset_count)
+                SELECT COALESCE(category, ''), currency, SUM(amount * quantity), COUNT(*)
+                FROM assets GROUP BY COALESCE(category, ''), currency
+            ''')
+            conn.commit()
+    @bumps_version
     def insert_sample_data(self):
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM assets')
             cursor.executemany('''
-                INSERT INTO assets (name, amount, quantity, description, category)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO assets (name, amount, quantity, description, category, currency)
+                VALUES (?, ?, ?, ?, ?, ?)
             ''', [
-                ('現金', 500000, 1, '手元現金', '現金'),
-                ('株式', 1000000, 100, 'A社の株式', '株式'),
-                ('不動産', 30000000, 1, '自宅', '不動産'),
-                ('預金', 2000000, 1, '銀行預金', '預金')
+                (name, self.money.to_storage(amount), quantity, description, category, self.money.default_currency)
+                for name, amount, quantity, description, category in SAMPLE_ASSETS
             ])
             conn.commit()
+    @bumps_version
+    def revalue_assets(self, factor: str, category: Optional[str], after_id: int, limit: int) -> List[int]:
+        amount = 'CAST(round(amount * ?) AS INTEGER)' if self.money.minor else 'round(amount * ?, 2)'
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                UPDATE assets SET amount = {amount}
+                WHERE id IN (
+                    SELECT id FROM assets WHERE id > ? AND (? IS NULL OR category = ?) ORDER BY id LIMIT ?
+                )
+                RETURNING id
+            ''', (float(factor), after_id, category, category, limit))
+            updated = sorted(row[0] for row in cursor.fetchall())
+            conn.commit()
+            return updated
+    def _insert_job(self, cursor, kind: str, params: str, owner: str) -> int:
+        cursor.execute('INSERT INTO jobs (kind, params, owner) VALUES (?, ?, ?) RETURNING id', (kind, params, owner))
+        return cursor.fetchone()[0]
+
+AZURE_ASSET_OUTPUT_TABLE = (
+    'DECLARE @out TABLE (id INT, name NVARCHAR(255), amount {amount_type}, quantity INT, '
+    'description NVARCHAR(MAX), category NVARCHAR(100), created_at DATETIME2, currency CHAR(3))'
+)
+AZURE_ASSET_OUTPUT = (
+    'OUTPUT INSERTED.id, INSERTED.name, INSERTED.amount, INSERTED.quantity, '
+    'INSERTED.description, INSERTED.category, INSERTED.created_at, INSERTED.currency INTO @out'
+)
 
 class AzureSQLAssetRepository(AssetRepository):
-    def __init__(self, connection_string: str):
+    MIGRATIONS = AZURE_MIGRATIONS
+    CATEGORY_KEY = "COALESCE(category, N'')"
+    
+    def __init__(self, connection_string: str, read_connection_string: Optional[str] = None):
+        self._load_driver('pyodbc')
         self.connection_string = connection_string
-        self.init_table()
+        self.read_connection_string = read_connection_string
+        self.data_version = DataVersion(self.shared_version, config.DATA_VERSION_CHECK_INTERVAL)
+        self.pool = self._create_pool(self._connect)
+        self._initialize()
+        if read_connection_string:
+            self.read_pool = self._create_pool(self._connect_read)
     
-    def get_connection(self):
-        return pyodbc.connect(self.connection_string)
+    def _connect(self):
+        return self._driver.connect(self.connection_string, timeout=int(config.POOL_TIMEOUT))
     
-    def init_table(self):
+    def _connect_read(self):
+        # 読み取りスケールアウトやgeoレプリカ（接続文字列に ApplicationIntent=ReadOnly を指定する）
+        return self._driver.connect(self.read_connection_string, timeout=int(config.POOL_TIMEOUT))
+    
+    def shared_version(self):
+        # assets への書き込みはトリガーで asset_changes に記録されるため、その最新のidを版として使う
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='assets' AND xtype='U')
-                CREATE TABLE assets (
-                    id INT IDENTITY(1,1) PRIMARY KEY,
-                    name NVARCHAR(255) NOT NULL,
-                    amount DECIMAL(15,2) NOT NULL,
-                    quantity INT NOT NULL DEFAULT 1,
-                    description NVARCHAR(MAX),
-                    category NVARCHAR(100),
-                    created_at DATETIME2 DEFAULT GETDATE()
-                )
+            cursor.execute('SELECT MAX(id) FROM asset_changes')
+            return cursor.fetchone()[0]
+    
+    def _lock_schema(self, cursor):
+        cursor.execute("EXEC sp_getapplock @Resource = 'asset_manager_schema', @LockMode = 'Exclusive', "
+                       "@LockOwner = 'Session', @LockTimeout = 60000")
+        cursor.execute("IF OBJECT_ID('schema_version', 'U') IS NULL CREATE TABLE schema_version (version INT NOT NULL)")
+    
+    def _unlock_schema(self, cursor):
+        cursor.execute("EXEC sp_releaseapplock @Resource = 'asset_manager_schema', @LockOwner = 'Session'")
+
+    def _lock_assets(self, cursor):
+        cursor.execute('SELECT COUNT(*) FROM assets WITH (TABLOCKX, HOLDLOCK)')
+        cursor.fetchall()
+
+    def _convert_amounts(self, cursor, money: MoneyFormat):
+        # DECIMAL(15,2) のままでは桁が足りない場合があるため、BIGINTの列を作って置き換える
+        # （集計テーブルの DECIMAL(38,2) は整数も正確に保持できるため、読み出し時に BIGINT にする）
+        cursor.execute('ALTER TABLE assets ADD amount_minor BIGINT NULL')
+        cursor.execute(f'UPDATE assets SET amount_minor = CAST(ROUND(amount * {money.multiplier_sql()}, 0) AS BIGINT)')
+        cursor.execute('ALTER TABLE assets DROP COLUMN amount')
+        cursor.execute("EXEC sp_rename 'assets.amount_minor', 'amount', 'COLUMN'")
+        cursor.execute('ALTER TABLE assets ALTER COLUMN amount BIGINT NOT NULL')
+        cursor.execute('DELETE FROM asset_category_totals')
+        cursor.execute('''
+            INSERT INTO asset_category_totals (category, currency, total, asset_count)
+            SELECT COALESCE(category, N''), currency, SUM(amount * quantity), COUNT(*)
+            FROM assets GROUP BY COALESCE(category, N''), currency
+        ''')
+    
+    def _scale_valuations(self, cursor, money: MoneyFormat):
+        multiplier = money.multiplier_sql()
+        cursor.execute(f'''
+            UPDATE asset_valuations SET
+                amount = ROUND(amount * {multiplier}, 0), value = ROUND(value * {multiplier}, 0),
+                delta = ROUND(delta * {multiplier}, 0)
+        ''')
+    
+    def _rebuild_value_rollups(self, cursor):
+        for table, period in (('asset_value_daily', 'CAST(valued_at AS DATE)'),
+                              ('asset_value_monthly', 'DATEFROMPARTS(YEAR(valued_at), MONTH(valued_at), 1)')):
+            cursor.execute(f'DELETE FROM {table}')
+            cursor.execute(f'''
+                INSERT INTO {table} (currency, period, closing_value, net_change, change_count)
+                SELECT currency, period,
+                       SUM(net_change) OVER (PARTITION BY currency ORDER BY period ROWS UNBOUNDED PRECEDING),
+                       net_change, change_count
+                FROM (
+                    SELECT currency, {period} AS period, SUM(delta) AS net_change, COUNT(*) AS change_count
+                    FROM asset_valuations GROUP BY currency, {period}
+                ) AS d
             ''')
-            conn.commit()
     
-    def get_all(self) -> List[Dict]:
+    def has_assets(self) -> bool:
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM assets ORDER BY created_at DESC')
+            cursor.execute('SELECT CASE WHEN EXISTS (SELECT 1 FROM assets) THEN 1 ELSE 0 END')
+            return bool(cursor.fetchone()[0])
+    
+    def explain(self, sql: str, params=None) -> List[str]:
+        # SHOWPLAN_XML が有効な間は文を実行せずに計画だけを返す。計画を確実に得るため、値はリテラルとして埋め込む
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SET SHOWPLAN_XML ON')
+            try:
+                cursor.execute(inline_params(sql, params))
+                documents = []
+                while True:
+                    documents.extend(row[0] for row in cursor.fetchall())
+                    if not cursor.nextset():
+                        break
+            finally:
+                cursor.execute('SET SHOWPLAN_XML OFF')
+        return [line for document in documents for line in showplan_lines(document)]
+    
+    def _value_column(self, factors: Optional[Dict[str, Decimal]]) -> Tuple[str, List]:
+        if factors is None:
+            return '', []
+        value = ("amount * quantity * (SELECT CAST([value] AS FLOAT) FROM OPENJSON(?) WHERE [key] = assets.currency)")
+        value = f'CAST(ROUND({value}, 0) AS BIGINT)' if self.money.minor else f'ROUND({value}, 2)'
+        return f', {value} AS value', [json.dumps({code: float(factor) for code, factor in factors.items()})]
+    
+    def get_all(self, factors: Optional[Dict[str, Decimal]] = None) -> List[Dict]:
+        value, value_params = self._value_column(factors)
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT *{value} FROM assets ORDER BY created_at DESC, id DESC', value_params)
             columns = [column[0] for column in cursor.description]
             rows = cursor.fetchall()
             return [dict(zip(columns, row)) for row in rows]
     
+    def list_assets(self, limit: int, cursor: Optional[Tuple[str, int]] = None,
+                    filters: Optional[Dict] = None, factors: Optional[Dict[str, Decimal]] = None) -> List[Dict]:
+        value, value_params = self._value_column(factors)
+        where, params = build_asset_filters(filters, cursor, self.money)
+        with self.get_read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT TOP (?) *{value} FROM assets{where} ORDER BY created_at DESC, id DESC',
+                        [limit] + value_params + params)
+            columns = [column[0] for column in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+    
+    def iter_assets(self, filters: Optional[Dict] = None, batch_size: Optional[int] = None,
+                    factors: Optional[Dict[str, Decimal]] = None) -> Iterator[Dict]:
+        # fetchmanyで少しずつ読み出し、全件をメモリに載せない
+        batch_size = batch_size or config.STREAM_BATCH_SIZE
+        value, value_params = self._value_column(factors)
+        where, params = build_asset_filters(filters, money=self.money)
+        with self.get_read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT *{value} FROM assets{where} ORDER BY created_at DESC, id DESC', value_params + params)
+            columns = [column[0] for column in cur.description]
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(columns, row))
+    
     def get_by_id(self, asset_id: int) -> Optional[Dict]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
@@ -159,92 +1312,348 @@ class AzureSQLAssetRepository(AssetRepository):
             row = cursor.fetchone()
             return dict(zip(columns, row)) if row else None
     
-    def create(self, asset_data: Dict) -> Dict:
+    def get_by_ids(self, asset_ids: List[int]) -> List[Dict]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO assets (name, amount, quantity, description, category)
-                OUTPUT INSERTED.*
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
+            cursor.execute('SELECT * FROM assets WHERE id IN (SELECT CAST(value AS INT) FROM OPENJSON(?))',
+                           (json.dumps(asset_ids),))
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def iter_analytics_rows(self, batch_size: Optional[int] = None) -> Iterator[List[Tuple]]:
+        batch_size = batch_size or config.STREAM_BATCH_SIZE
+        with self.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT id, amount, quantity, category, currency FROM assets ORDER BY id')
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [tuple(row) for row in rows]
+    
+    def _amount_type(self) -> str:
+        return 'BIGINT' if self.money.minor else 'DECIMAL(15,2)'
+    
+    def _execute_returning(self, cursor, dml: str, params) -> List[Dict]:
+        """OUTPUT句付きのDMLと結果の取得を1往復で行う
+
+        トリガーのあるテーブルでは OUTPUT ... INTO が必須なため、テーブル変数を経由して返す。
+        """
+        cursor.execute(
+            f'SET NOCOUNT ON; {AZURE_ASSET_OUTPUT_TABLE.format(amount_type=self._amount_type())}; '
+            f'{dml.format(output=AZURE_ASSET_OUTPUT)}; SELECT * FROM @out;',
+            params,
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def _create(self, cursor, asset_data: Dict) -> Dict:
+        rows = self._execute_returning(cursor,
+            'INSERT INTO assets (name, amount, quantity, description, category, currency) {output} '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (
                 asset_data.get('name'),
                 asset_data.get('amount'),
                 asset_data.get('quantity', 1),
                 asset_data.get('description'),
-                asset_data.get('category')
+                asset_data.get('category'),
+                asset_data.get('currency') or self.money.default_currency
             ))
-            columns = [column[0] for column in cursor.description]
-            row = cursor.fetchone()
-            conn.commit()
-            return dict(zip(columns, row)) if row else None
+        return rows[0] if rows else None
     
-    def update(self, asset_id: int, asset_data: Dict) -> Optional[Dict]:
+    @bumps_version
+    def insert_many(self, rows: List[Tuple]) -> int:
+        # (name, amount, quantity, description, category, currency) のタプルを1トランザクションで挿入する
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            fields = []
-            values = []
-            for key in ['name', 'amount', 'quantity', 'description', 'category']:
-                if key in asset_data:
-                    fields.append(f"{key} = ?")
-                    values.append(asset_data[key])
-            if not fields:
-                return self.get_by_id(asset_id)
-            values.append(asset_id)
-            cursor.execute(f"UPDATE assets SET {', '.join(fields)} WHERE id = ?", values)
+            # パラメータ配列を一括送信し、行ごとの往復をなくす
+            cursor.fast_executemany = True
+            cursor.executemany('''
+                INSERT INTO assets (name, amount, quantity, description, category, currency)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
             conn.commit()
-            return self.get_by_id(asset_id)
+            return len(rows)
     
-    def delete(self, asset_id: int) -> bool:
+    def _update(self, cursor, asset_id: int, asset_data: Dict) -> Optional[Dict]:
+        rows = self._execute_returning(cursor, f'UPDATE assets SET {PARTIAL_UPDATE_SET} {{output}} WHERE id = ?',
+                                       partial_update_params(asset_data) + [asset_id])
+        return rows[0] if rows else None
+    
+    @bumps_version
+    def update_many(self, asset_ids: List[int], asset_data: Dict) -> List[Dict]:
+        # id一覧はJSON配列1つで渡し、件数によらず同じ文を使う
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('DELETE FROM assets WHERE id = ?', (asset_id,))
+            rows = self._execute_returning(
+                cursor,
+                f'UPDATE assets SET {PARTIAL_UPDATE_SET} {{output}} WHERE id IN (SELECT CAST(value AS INT) FROM OPENJSON(?))',
+                partial_update_params(asset_data) + [json.dumps(asset_ids)])
             conn.commit()
-            return cursor.rowcount > 0
+            return rows
+    
+    def _delete(self, cursor, asset_id: int) -> bool:
+        cursor.execute('DELETE FROM assets WHERE id = ?', (asset_id,))
+        return cursor.rowcount > 0
     
-    def get_summary(self) -> Dict:
+    @bumps_version
+    def delete_many(self, asset_ids: List[int]) -> List[int]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT SUM(amount * quantity) FROM assets')
-            total_amount = cursor.fetchone()[0] or 0
-            cursor.execute('SELECT category, SUM(amount * quantity) as total, COUNT(*) as count FROM assets GROUP BY category')
-            category_summary = [
-                {'category': row[0], 'total': row[1], 'count': row[2]}
+            cursor.execute('''
+                SET NOCOUNT ON;
+                DECLARE @deleted TABLE (id INT);
+                DELETE FROM assets OUTPUT DELETED.id INTO @deleted
+                WHERE id IN (SELECT CAST(value AS INT) FROM OPENJSON(?));
+                SELECT id FROM @deleted;
+            ''', (json.dumps(asset_ids),))
+            deleted = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            return deleted
+    
+    def get_category_totals(self) -> List[Dict]:
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            # 金額を整数で保存している場合は、集計もDecimalではなく整数で受け取る
+            total = 'CAST(total AS BIGINT)' if self.money.minor else 'total'
+            cursor.execute(f'''
+                SELECT NULLIF(category, N''), currency, {total}, asset_count FROM asset_category_totals
+                WHERE asset_count > 0 ORDER BY category, currency
+            ''')
+            return [
+                {'category': row[0], 'currency': row[1], 'total': row[2], 'count': row[3]}
                 for row in cursor.fetchall()
             ]
-            return {'total_amount': total_amount, 'category_summary': category_summary}
     
+    def register_portfolio(self, portfolio_id: str) -> bool:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SET NOCOUNT ON;
+                INSERT INTO portfolios (id) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM portfolios WITH (UPDLOCK, HOLDLOCK) WHERE id = ?);
+                SELECT @@ROWCOUNT;
+            ''', (portfolio_id, portfolio_id))
+            created = cursor.fetchone()[0] > 0
+            conn.commit()
+            return created
+    
+    def search(self, terms: List[str], limit: int, offset: int = 0) -> Dict:
+        # N-gram索引で全ての語を含みうる行を新しいものから候補として絞り、実際の文字列で確かめてから
+        # AZURE_SEARCH_SCORE の順に並べる
+        max_candidates = config.SEARCH_MAX_CANDIDATES
+        patterns = []
+        for term in terms:
+            for gram in search_grams(term):
+                pattern = like_escape(gram) + ('%' if len(term) == 1 else '')
+                if pattern not in patterns:
+                    patterns.append(pattern)
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT a.*, (
+                    SELECT SUM({AZURE_SEARCH_SCORE}) FROM OPENJSON(?) AS t
+                ) AS score, COUNT(*) OVER () AS total
+                FROM (
+                    SELECT TOP (?) g.asset_id
+                    FROM OPENJSON(?) AS p
+                    JOIN asset_search_grams AS g ON g.gram LIKE p.value
+                    GROUP BY g.asset_id
+                    HAVING COUNT(DISTINCT p.value) = ?
+                    ORDER BY g.asset_id DESC
+                ) AS s
+                JOIN assets AS a ON a.id = s.asset_id
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM OPENJSON(?) AS t
+                    WHERE CHARINDEX(t.value, CONCAT(a.name, N' ', a.description, N' ', a.category)) = 0
+                )
+                ORDER BY score DESC, a.id DESC
+                OFFSET ? ROWS FETCH NEXT ? ROWS ONLY
+            ''', (json.dumps(terms), max_candidates, json.dumps(patterns), len(patterns), json.dumps(terms), offset, limit))
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return search_page(rows, limit, offset, max_candidates)
+    
+    def get_change_cursor(self) -> int:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT MAX(latest) FROM (
+                    SELECT MAX(id) AS latest FROM asset_changes
+                    UNION ALL SELECT compacted_through FROM asset_change_log
+                ) AS t
+            ''')
+            return cursor.fetchone()[0] or 0
+    
+    def get_changes(self, since: int, limit: int) -> Dict:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            # IDENTITYの採番順とコミット順は一致しないため、行ロックを取る読み取りにして
+            # 未コミットの変更を飛ばしてカーソルを進めないようにする
+            cursor.execute(
+                'SELECT TOP (?) id, asset_id, op FROM asset_changes WITH (READCOMMITTEDLOCK) WHERE id > ? ORDER BY id',
+                (limit, since),
+            )
+            entries = [tuple(row) for row in cursor.fetchall()]
+            # 読み出し後に確認し、読み出し中に圧縮された場合も取りこぼしを検出する
+            cursor.execute('SELECT compacted_through FROM asset_change_log')
+            if since < cursor.fetchone()[0]:
+                raise ChangeLogExpiredError(since)
+            ids = sorted({asset_id for _, asset_id, op in entries if op != 'D'})
+            assets_by_id = {}
+            if ids:
+                cursor.execute('SELECT * FROM assets WHERE id IN (SELECT CAST(value AS INT) FROM OPENJSON(?))',
+                               (json.dumps(ids),))
+                columns = [column[0] for column in cursor.description]
+                assets_by_id = {asset['id']: asset for asset in (dict(zip(columns, row)) for row in cursor.fetchall())}
+        return {
+            'changes': coalesce_changes(entries, assets_by_id),
+            'cursor': entries[-1][0] if entries else since,
+            'has_more': len(entries) == limit,
+        }
+    
+    def compact_changes(self, keep: Optional[int] = None) -> int:
+        keep = max(1, config.CHANGE_LOG_RETENTION if keep is None else keep)
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SET NOCOUNT ON;
+                DECLARE @through BIGINT = (SELECT MAX(id) FROM asset_changes) - ?;
+                UPDATE asset_change_log WITH (UPDLOCK) SET compacted_through = @through
+                WHERE compacted_through < @through;
+                DELETE FROM asset_changes WHERE id <= @through;
+                SELECT @@ROWCOUNT;
+            ''', (keep,))
+            deleted = cursor.fetchone()[0]
+            conn.commit()
+            return deleted
+    
+    @bumps_version
+    def rebuild_category_totals(self):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM asset_category_totals')
+            cursor.execute('''
+                INSERT INTO asset_category_totals (category, currency, total, asset_count)
+                SELECT COALESCE(category, N''), currency, SUM(amount * quantity), COUNT(*)
+                FROM assets WITH (TABLOCK, HOLDLOCK) GROUP BY COALESCE(category, N''), currency
+            ''')
+            conn.commit()
+    
+    @bumps_version
     def insert_sample_data(self):
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM assets')
             cursor.executemany('''
-                INSERT INTO assets (name, amount, quantity, description, category)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO assets (name, amount, quantity, description, category, currency)
+                VALUES (?, ?, ?, ?, ?, ?)
             ''', [
-                ('現金', 500000, 1, '手元現金', '現金'),
-                ('株式', 1000000, 100, 'A社の株式', '株式'),
-                ('不動産', 30000000, 1, '自宅', '不動産'),
-                ('預金', 2000000, 1, '銀行預金', '預金')
+                (name, self.money.to_storage(amount), quantity, description, category, self.money.default_currency)
+                for name, amount, quantity, description, category in SAMPLE_ASSETS
             ])
             conn.commit()
+    
+    @bumps_version
+    def revalue_assets(self, factor: str, category: Optional[str], after_id: int, limit: int) -> List[int]:
+        amount = 'CAST(ROUND(amount * ?, 0) AS BIGINT)' if self.money.minor else 'ROUND(amount * ?, 2)'
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SET NOCOUNT ON;
+                DECLARE @updated TABLE (id INT);
+                UPDATE assets SET amount = {amount} OUTPUT INSERTED.id INTO @updated
+                WHERE id IN (
+                    SELECT TOP (?) id FROM assets WHERE id > ? AND (? IS NULL OR category = ?) ORDER BY id
+                );
+                SELECT id FROM @updated ORDER BY id;
+            ''', (Decimal(factor), limit, after_id, category, category))
+            updated = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            return updated
+    
+    def _insert_job(self, cursor, kind: str, params: str, owner: str) -> int:
+        cursor.execute('''
+            SET NOCOUNT ON;
+            INSERT INTO jobs (kind, params, owner) OUTPUT INSERTED.id VALUES (?, ?, ?);
+        ''', (kind, params, owner))
+        return cursor.fetchone()[0]
 
-def get_repository() -> AssetRepository:
-    database_url = config.DATABASE_URL
+def get_repository(database_url: Optional[str] = None, read_url: Optional[str] = None) -> AssetRepository:
+    """接続先のURL（省略時は DATABASE_URL / DATABASE_READ_URL）に応じたリポジトリを作る"""
+    if database_url is None:
+        database_url, read_url = config.DATABASE_URL, config.DATABASE_READ_URL
     if database_url.startswith('sqlite:///'):
         db_path = database_url.replace('sqlite:///', '')
-        return SQLiteAssetRepository(db_path)
+        if read_url and not read_url.startswith('sqlite:///'):
+            raise ValueError('DATABASE_URL がSQLiteの場合、DATABASE_READ_URL も sqlite:/// で指定してください')
+        return SQLiteAssetRepository(db_path, read_url.replace('sqlite:///', '') if read_url else None)
     else:
-        return AzureSQLAssetRepository(database_url)
+        return AzureSQLAssetRepository(database_url, read_url)
+
+class LazyRepository:
+    """最初に使われた時点でリポジトリを生成するプロキシ
+
+    database モジュールの読み込みだけでは接続もDDLも発生しない。
+    """
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_instance', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+    def get(self):
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                instance = self._instance
+                if instance is None:
+                    instance = self._factory()
+                    object.__setattr__(self, '_instance', instance)
+        return instance
+    @property
+    def initialized(self) -> bool:
+        return self._instance is not None
+    def reset(self):
+        """生成済みのリポジトリを手放し、次に使われた時点で作り直す
+
+        gunicornのワーカーがフォークした直後に呼ぶ。親プロセスから引き継いだ接続や
+        書き込みスレッド（フォーク後は動いていない）を使わないようにするため。閉じる処理は親プロセスで行う。
+        """
+        with self._lock:
+            object.__setattr__(self, '_instance', None)
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
+def wrap_repository(repo: AssetRepository):
+    repo = InstrumentedRepository(repo)
+    # 枠の空きを待つ時間は、リポジトリメソッドの処理時間に含めない
+    return AdmissionControlledRepository.from_config(repo) if config.ADMISSION_CONTROL else repo
+
+def _build_repository():
+    if config.SHARD_URL_TEMPLATE:
+        # ポートフォリオごとに別のデータベースに振り分ける（sharding は database を読み込むため、ここで読み込む）
+        from sharding import ShardedRepository
+        return ShardedRepository.from_config()
+    return wrap_repository(get_repository())
 
-repository = get_repository()
+repository = LazyRepository(_build_repository)
 
 def init_db():
-    repository.init_table()
+    started = time.perf_counter()
+    repo = repository.get()
+    timings = dict(repo.startup_timings)
+    timings['repository'] = time.perf_counter() - started
     # サンプルデータが存在しない場合のみ挿入
+    sample_started = time.perf_counter()
     try:
-        assets = repository.get_all()
-        if not assets:
+        if not repository.has_assets():
             repository.insert_sample_data()
     except Exception as e:
         print(f"サンプルデータ挿入エラー: {e}")
-        # エラーが発生してもアプリは起動する 
\ No newline at end of file
+        # エラーが発生してもアプリは起動する
+    timings['sample_data'] = time.perf_counter() - sample_started
+    timings['total'] = time.perf_counter() - started
+    print("起動時間の内訳: " + ", ".join(
+        f"{key}={value * 1000:.1f}ms" for key, value in timings.items() if isinstance(value, float)
+    ) + f" (schema {'migrated' if timings.get('schema_migrated') else 'current'})")
+    return timings 
\ No newline at end of file
@@ -0,0 +1,133 @@
+"""為替レート表（ファイルから読み込む。ネットワークには接続しない）
+
+FX_RATES_FILE のJSONを読み込み、資産の通貨から報告通貨への換算係数を返す。
+
+    {"base": "JPY", "as_of": "2024-06-28", "rates": {"USD": "160.88", "EUR": "172.33"}}
+
+rates は「その通貨1単位が base の何単位か」。ファイルが更新されると次に参照したときに読み直し、
+内容のハッシュをレート表のバージョンとする（応答キャッシュ・ETagのキーに使う）。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger('asset_manager.fx')
+
+CURRENCY_CODE = re.compile(r'^[A-Z]{3}$')
+
+
+class UnknownCurrencyError(ValueError):
+    """レート表に無い通貨が指定された"""
+
+
+def normalize_currency(value, name: str = 'currency') -> str:
+    """通貨コードを大文字の3文字に揃える（不正な値は ValueError）"""
+    code = value.strip().upper() if isinstance(value, str) else None
+    if not code or not CURRENCY_CODE.match(code):
+        raise ValueError(f'{name} はISO 4217の3文字の通貨コード（例: USD）で指定してください')
+    return code
+
+
+class FxRates:
+    """ある時点のレート表（変更しない）"""
+
+    def __init__(self, base: str, rates: Dict[str, Decimal], as_of: Optional[str] = None, version: str = 'none'):
+        self.base = base
+        self.rates = dict(rates)
+        self.rates[base] = Decimal(1)
+        self.as_of = as_of
+        self.version = version
+
+    @classmethod
+    def parse(cls, data: bytes) -> 'FxRates':
+        try:
+            document = json.loads(data)
+            base = normalize_currency(document.get('base'), 'base')
+            rates = {}
+            for currency, rate in (document.get('rates') or {}).items():
+                rate = Decimal(str(rate))
+                if not rate.is_finite() or rate <= 0:
+                    raise ValueError(f'{currency} のレートは正の数値で指定してください')
+                rates[normalize_currency(currency, 'rates のキー')] = rate
+        except (AttributeError, InvalidOperation, TypeError) as e:
+            raise ValueError(f'レート表の形式が正しくありません: {e}')
+        as_of = document.get('as_of')
+        return cls(base, rates, str(as_of) if as_of is not None else None, hashlib.sha256(data).hexdigest()[:12])
+
+    @property
+    def currencies(self) -> List[str]:
+        return sorted(self.rates)
+
+    def factors(self, currency: str) -> Dict[str, Decimal]:
+        """各通貨の金額に掛けると currency の金額になる係数"""
+        if currency not in self.rates:
+            raise UnknownCurrencyError(f'{currency} の為替レートがありません')
+        target = self.rates[currency]
+        return {code: rate / target for code, rate in self.rates.items()}
+
+    def describe(self) -> Dict:
+        return {'version': self.version, 'base': self.base, 'as_of': self.as_of}
+
+
+class FxTable:
+    """FX_RATES_FILE を読み込み、更新されていれば読み直す
+
+    ファイルが無ければ既定の通貨だけのレート表（換算は係数1のみ）とする。読み直したファイルが
+    不正な場合は警告を出し、直前に読み込めたレート表を使い続ける。
+    """
+
+    def __init__(self, path: str, default_currency: str):
+        self.path = path
+        self.default_currency = default_currency
+        self._lock = threading.Lock()
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._rates = FxRates(default_currency, {})
+
+    def current(self) -> FxRates:
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._stamp:
+            return self._rates
+        with self._lock:
+            if stamp != self._stamp:
+                self._load(stamp)
+            return self._rates
+
+    def _load(self, stamp: Optional[Tuple[int, int]]):
+        if stamp is None:
+            self._rates = FxRates(self.default_currency, {})
+            self._stamp = None
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self._rates = FxRates.parse(f.read())
+        except (OSError, ValueError) as e:
+            logger.warning('為替レート表を読み込めませんでした（%s）: %s', self.path, e)
+        self._stamp = stamp
+
+
+def convert_totals(totals: Iterable[Tuple[str, object]], factors: Dict[str, Decimal]) -> Tuple[Decimal, List[str]]:
+    """(通貨, 金額) の組を換算して合計する。レートの無い通貨は合計に含めず、その通貨の一覧を返す"""
+    total, missing = Decimal(0), set()
+    for currency, amount in totals:
+        factor = factors.get(currency)
+        if factor is None:
+            missing.add(currency)
+            continue
+        total += to_decimal(amount) * factor
+    return total, sorted(missing)
+
+
+def to_decimal(value) -> Decimal:
+    # floatは最短の10進表記から変換する（SQLiteの集計値など）
+    if value is None:
+        return Decimal(0)
+    return Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List
+
+from metrics import registry
+
+BATCH_SIZE = registry.histogram(
+    'group_commit_batch_size', '1回のコミットにまとめた書き込みの数', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+QUEUE_WAIT = registry.histogram(
+    'group_commit_queue_wait_seconds', '書き込みがキューに入ってから実行が始まるまでの時間')
+COMMIT_DURATION = registry.histogram(
+    'group_commit_batch_duration_seconds', '1バッチの実行とコミットにかかった時間')
+RETRIES = registry.counter(
+    'group_commit_retries_total', '一部の書き込みが失敗したため、残りをやり直した回数')
+
+
+class _Operation:
+    __slots__ = ('func', 'future', 'enqueued')
+
+    def __init__(self, func: Callable):
+        self.func = func
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+_STOP = object()
+
+
+class GroupCommitQueue:
+    """同時に届いた書き込みを1つのトランザクションにまとめてコミットする
+
+    書き込みは専用のスレッドが実行する。最初の書き込みが届いてから max_latency 秒経つか、
+    max_batch 件たまった時点でまとめて実行し、1回だけコミットする。
+    各呼び出し元には、それぞれの書き込みの結果（または例外）が返る。
+    """
+
+    def __init__(self, get_connection: Callable, max_latency: float = 0.002, max_batch: int = 64):
+        self.get_connection = get_connection
+        self.max_latency = max_latency
+        self.max_batch = max(1, max_batch)
+        self._queue = queue.Queue()
+        self._closed = False
+        # _closed の確認とキューへの追加を close() と排他にする（_STOP の後ろに入った書き込みは実行されない）
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, func: Callable):
+        """func(cursor) を次のバッチで実行し、その戻り値を返す（コミットされるまで待つ）"""
+        operation = _Operation(func)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('書き込みキューは停止しています')
+            self._queue.put(operation)
+        return operation.future.result()
+
+    def close(self):
+        """キューに残っている書き込みを実行してからスレッドを止める"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = time.perf_counter() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    operation = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if operation is _STOP:
+                    stopping = True
+                    break
+                batch.append(operation)
+            self._execute(batch)
+
+    def _execute(self, batch: List[_Operation]):
+        started = time.perf_counter()
+        BATCH_SIZE.observe(len(batch))
+        for operation in batch:
+            QUEUE_WAIT.observe(started - operation.enqueued)
+        pending = batch
+        while pending:
+            failed = None
+            try:
+                with self.get_connection() as conn:
+                    try:
+                        cursor = conn.cursor()
+                        results = []
+                        for operation in pending:
+                            failed = operation
+                            results.append(operation.func(cursor))
+                        failed = None
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+            except Exception as e:
+                if failed is None:
+                    # 接続の取得やコミットに失敗した場合は、バッチ全体を失敗とする
+                    for operation in pending:
+                        operation.future.set_exception(e)
+                    break
+                # 失敗した書き込みだけにエラーを返し、残りを新しいトランザクションでやり直す
+                failed.future.set_exception(e)
+                pending = [operation for operation in pending if operation is not failed]
+                if pending:
+                    RETRIES.inc()
+                continue
+            for operation, result in zip(pending, results):
+                operation.future.set_result(result)
+            break
+        COMMIT_DURATION.observe(time.perf_counter() - started)
@@ -0,0 +1,33 @@
+"""gunicorn の設定（Procfile から -c gunicorn.conf.py で読み込む）
+
+アプリは master プロセスで一度だけ読み込み、スキーマの移行とサンプルデータの投入を1回で済ませる。
+リポジトリ（接続プール・グループコミットの書き込みスレッド）は、フォーク後に各ワーカーで作り直す。
+ワーカー間の応答キャッシュの無効化は、データバージョン（DATA_VERSION_CHECK_INTERVAL）で行う。
+"""
+import os
+
+from config import config as app_config
+
+
+def default_workers() -> int:
+    """CPU数から決めるワーカー数（gunicornの推奨する 2 × コア数 + 1）"""
+    return (os.cpu_count() or 1) * 2 + 1
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+timeout = 120
+workers = app_config.WEB_CONCURRENCY or default_workers()
+preload_app = True
+
+
+def when_ready(server):
+    # master が使った接続と書き込みスレッドを、ワーカーをフォークする前に閉じる
+    from database import repository
+    if repository.initialized:
+        repository.close()
+        repository.reset()
+
+
+def post_fork(server, worker):
+    from database import repository
+    repository.reset()
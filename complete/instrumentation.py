@@ -0,0 +1,268 @@
+import functools
+import inspect
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from config import config
+from metrics import registry
+
+HTTP_REQUESTS = registry.counter(
+    'http_requests_total', 'HTTPリクエスト数', ('method', 'route', 'status'))
+HTTP_DURATION = registry.histogram(
+    'http_request_duration_seconds', 'HTTPリクエストの処理時間（ストリーミング本文の送信は含まない）', ('method', 'route'))
+SERIALIZE_DURATION = registry.histogram(
+    'http_response_serialize_seconds', 'レスポンスのJSONシリアライズ時間', ('route',))
+REPOSITORY_DURATION = registry.histogram(
+    'repository_call_duration_seconds', 'リポジトリメソッドの処理時間', ('method',))
+REPOSITORY_PHASE = registry.histogram(
+    'repository_phase_duration_seconds',
+    'リポジトリメソッド内の内訳（connect: 接続取得, execute: SQL実行, fetch: 行の取得, commit: コミット, other: 行の変換など）',
+    ('method', 'phase'))
+REPOSITORY_ROWS = registry.counter(
+    'repository_rows_returned_total', 'リポジトリメソッドが取得した行数', ('method',))
+REPOSITORY_ERRORS = registry.counter(
+    'repository_errors_total', 'リポジトリメソッドで発生した例外の数', ('method',))
+SLOW_QUERIES = registry.counter(
+    'db_slow_queries_total', 'しきい値を超えたSQLの数')
+
+slow_query_logger = logging.getLogger('asset_manager.slow_query')
+
+PHASES = ('connect', 'execute', 'fetch', 'commit')
+# get_connection などはコンテキストマネージャを返すため計測の対象外とする
+UNINSTRUMENTED_METHODS = {'get_connection', 'get_read_connection', 'get_pool_stats', 'close'}
+
+_state = threading.local()
+
+
+class _CallStats:
+    """1回のリポジトリ呼び出し中に積算する内訳"""
+
+    __slots__ = PHASES + ('rows', 'method')
+
+    def __init__(self, method: str):
+        for phase in PHASES:
+            setattr(self, phase, 0.0)
+        self.rows = 0
+        self.method = method
+
+
+def _add(phase: str, seconds: float, rows: int = 0):
+    stats = getattr(_state, 'call', None)
+    if stats is not None:
+        setattr(stats, phase, getattr(stats, phase) + seconds)
+        stats.rows += rows
+
+
+def _capture(sql: str, params):
+    statements = getattr(_state, 'statements', None)
+    if statements is not None:
+        stats = getattr(_state, 'call', None)
+        statements.append((stats.method if stats is not None else None, sql, params))
+
+
+@contextmanager
+def capture_statements():
+    """このスレッドで実行したSQLを (リポジトリのメソッド名, SQL, パラメータ) のリストに記録する（実行計画の確認用）"""
+    statements = []
+    previous = getattr(_state, 'statements', None)
+    _state.statements = statements
+    try:
+        yield statements
+    finally:
+        _state.statements = previous
+
+
+def params_shape(params) -> str:
+    """パラメータの値は出さず、型の並びだけを文字列にする"""
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in params.items()) + '}'
+    if isinstance(params, (list, tuple)):
+        return '(' + ', '.join(type(value).__name__ for value in params) + ')'
+    return type(params).__name__
+
+
+def _log_if_slow(sql: str, shape: str, seconds: float):
+    if config.SLOW_QUERY_LOG and seconds * 1000 >= config.SLOW_QUERY_THRESHOLD_MS:
+        SLOW_QUERIES.inc()
+        slow_query_logger.warning('slow query %.1fms params=%s sql=%s',
+                                  seconds * 1000, shape, re.sub(r'\s+', ' ', sql).strip())
+
+
+class InstrumentedCursor:
+    """SQLの実行と行の取得にかかった時間を計測するカーソル"""
+
+    def __init__(self, cursor):
+        object.__setattr__(self, '_cursor', cursor)
+
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        result = self._cursor.execute(sql, *args)
+        elapsed = time.perf_counter() - started
+        _add('execute', elapsed)
+        _log_if_slow(sql, params_shape(args[0] if args else None), elapsed)
+        _capture(sql, args[0] if args else None)
+        return self if result is self._cursor else result
+
+    def executemany(self, sql, rows):
+        started = time.perf_counter()
+        result = self._cursor.executemany(sql, rows)
+        elapsed = time.perf_counter() - started
+        _add('execute', elapsed)
+        if isinstance(rows, (list, tuple)):
+            shape = f'{len(rows)} x {params_shape(rows[0]) if rows else "()"}'
+        else:
+            shape = type(rows).__name__
+        _log_if_slow(sql, shape, elapsed)
+        if isinstance(rows, (list, tuple)) and rows:
+            _capture(sql, rows[0])
+        return self if result is self._cursor else result
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self._cursor.fetchone()
+        _add('fetch', time.perf_counter() - started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, *args):
+        started = time.perf_counter()
+        rows = self._cursor.fetchmany(*args)
+        _add('fetch', time.perf_counter() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self._cursor.fetchall()
+        _add('fetch', time.perf_counter() - started, len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        # pyodbc の fast_executemany などは元のカーソルに設定する
+        setattr(self._cursor, name, value)
+
+
+class InstrumentedConnection:
+    """カーソルを計測付きにし、コミットの時間を記録する接続"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return InstrumentedCursor(self._conn.cursor())
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def commit(self):
+        started = time.perf_counter()
+        self._conn.commit()
+        _add('commit', time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+@contextmanager
+def instrumented_connection(pool):
+    """プールから接続を取得し、取得にかかった時間を connect として記録する"""
+    started = time.perf_counter()
+    with pool.connection() as conn:
+        _add('connect', time.perf_counter() - started)
+        yield InstrumentedConnection(conn)
+
+
+class InstrumentedRepository:
+    """AssetRepository の公開メソッド呼び出しごとに処理時間と内訳を記録するラッパー"""
+
+    def __init__(self, repository):
+        object.__setattr__(self, '_repository', repository)
+
+    def __getattr__(self, name):
+        attr = getattr(self._repository, name)
+        if name.startswith('_') or name in UNINSTRUMENTED_METHODS or not callable(attr):
+            return attr
+        return functools.partial(self._call, name, attr)
+
+    def __setattr__(self, name, value):
+        setattr(self._repository, name, value)
+
+    def _call(self, name, method, *args, **kwargs):
+        stats = _CallStats(name)
+        previous = getattr(_state, 'call', None)
+        _state.call = stats
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            REPOSITORY_ERRORS.inc(name)
+            raise
+        finally:
+            _state.call = previous
+        if inspect.isgenerator(result):
+            return self._iterate(name, result)
+        self._observe(name, stats, time.perf_counter() - started)
+        return result
+
+    def _iterate(self, name, generator):
+        """ジェネレータを返すメソッドは、最後まで読み出した時点で記録する"""
+        stats = _CallStats(name)
+        elapsed = 0.0
+        try:
+            while True:
+                previous = getattr(_state, 'call', None)
+                _state.call = stats
+                started = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                except Exception:
+                    REPOSITORY_ERRORS.inc(name)
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - started
+                    _state.call = previous
+                yield item
+        finally:
+            generator.close()
+            self._observe(name, stats, elapsed)
+
+    @staticmethod
+    def _observe(name, stats, elapsed):
+        REPOSITORY_DURATION.observe(elapsed, name)
+        measured = 0.0
+        for phase in PHASES:
+            value = getattr(stats, phase)
+            measured += value
+            REPOSITORY_PHASE.observe(value, name, phase)
+        REPOSITORY_PHASE.observe(max(0.0, elapsed - measured), name, 'other')
+        if stats.rows:
+            REPOSITORY_ROWS.inc(name, amount=stats.rows)
+
+
+def init_app(app):
+    """Flaskアプリにルート単位のレイテンシ計測を追加する"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop('request_started', None)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUESTS.inc(request.method, route, str(response.status_code))
+        if started is not None:
+            HTTP_DURATION.observe(time.perf_counter() - started, request.method, route)
+        return response
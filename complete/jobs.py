@@ -0,0 +1,281 @@
+"""バックグラウンドジョブ
+
+全件のエクスポートや集計の再計算、一括の再評価のように時間のかかる処理を、リクエストの処理とは別の
+スレッドで実行する。ジョブの状態と進捗はデータベースの jobs テーブルに記録するため、どのワーカーからでも
+参照・取り消しができる。成果物（エクスポートしたファイル）は JOB_ARTIFACT_DIR に書き出す。
+ジョブは投入したリクエストのポートフォリオのデータベースに記録し、そのポートフォリオを対象に実行する。
+
+ジョブは一定件数ごとに接続を返し、進捗を記録する。取り消しはその時点で確認する。
+"""
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Dict, List, Optional
+
+from config import config
+from database import decode_cursor, encode_cursor
+from metrics import registry
+from sharding import DEFAULT_PORTFOLIO, current_portfolio, use_portfolio
+from streaming import STREAM_FORMATS
+
+JOBS_FINISHED = registry.counter(
+    'jobs_finished_total', '終了したバックグラウンドジョブの数', ('kind', 'status'))
+JOB_DURATION = registry.histogram(
+    'job_duration_seconds', 'バックグラウンドジョブの実行時間', ('kind',),
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0))
+
+class JobCancelled(Exception):
+    """ジョブの取り消しが要求された"""
+
+
+class JobQueueFullError(Exception):
+    """このプロセスで待機中のジョブが上限に達している"""
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobContext:
+    """実行中のジョブに渡す。進捗の記録と取り消しの確認を行う"""
+
+    def __init__(self, manager: 'JobManager', job: Dict):
+        self.manager = manager
+        self.job = job
+        self.params = job['params']
+        self.processed = 0
+        self.total = None
+        self._reported_at = 0.0
+
+    def progress(self, processed: int, total: Optional[int] = None, force: bool = False):
+        """進捗を記録する（JOB_PROGRESS_INTERVAL 秒に1回まで）。取り消しが要求されていれば JobCancelled を送出する"""
+        self.processed = processed
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if not force and now - self._reported_at < config.JOB_PROGRESS_INTERVAL:
+            return
+        self._reported_at = now
+        if self.manager.repository.update_job_progress(self.job['id'], self.processed, self.total):
+            raise JobCancelled()
+
+    def artifact_name(self, extension: str) -> str:
+        # ジョブのidはポートフォリオ（データベース）ごとに採番されるため、ポートフォリオも名前に含める
+        portfolio = current_portfolio()
+        if portfolio == DEFAULT_PORTFOLIO:
+            return f"job-{self.job['id']}.{extension}"
+        return f"job-{portfolio}-{self.job['id']}.{extension}"
+
+
+def export_assets(ctx: JobContext, manager: 'JobManager') -> Dict:
+    """絞り込み条件に一致する資産を NDJSON または JSON で書き出す"""
+    fmt = ctx.params['format']
+    filters = ctx.params['filters']
+    encoder, _ = STREAM_FORMATS[fmt]
+    repository = manager.repository
+    money = repository.money
+    total = None
+    if not any(value is not None for key, value in filters.items() if key != 'category'):
+        # カテゴリだけの絞り込みなら、件数はカテゴリ別集計から分かる
+        total = sum(item['count'] for item in repository.get_summary()['category_summary']
+                    if filters.get('category') is None or item['category'] == filters['category'])
+
+    def rows():
+        # キーセットページングで batch_size 件ずつ読み、読み終えるたびに接続を返す
+        cursor, processed = None, 0
+        while True:
+            batch = repository.list_assets(config.STREAM_BATCH_SIZE, cursor, filters)
+            for asset in batch:
+                yield money.present_asset(asset)
+            processed += len(batch)
+            ctx.progress(processed, total)
+            if len(batch) < config.STREAM_BATCH_SIZE:
+                return
+            cursor = decode_cursor(encode_cursor(batch[-1]))
+
+    name = ctx.artifact_name(fmt)
+    path = manager.artifact_path(name)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        for chunk in encoder(rows()):
+            f.write(chunk)
+    os.replace(path + '.tmp', path)
+    return {'rows': ctx.processed, 'format': fmt, 'bytes': os.path.getsize(path), 'artifact': name}
+
+
+def rebuild_summary(ctx: JobContext, manager: 'JobManager') -> Dict:
+    """カテゴリ別集計のずれを確認してから再計算する"""
+    repository = manager.repository
+    drift = repository.verify_category_totals()
+    ctx.progress(0, 1, force=True)
+    repository.rebuild_category_totals()
+    ctx.progress(1, 1, force=True)
+    return {'corrected_categories': len(drift), 'drift': drift}
+
+
+def revalue_assets(ctx: JobContext, manager: 'JobManager') -> Dict:
+    """資産の金額を factor 倍にする（category を指定するとそのカテゴリだけ）
+
+    JOB_BATCH_SIZE 件ずつ別のトランザクションで更新するため、取り消した場合はそれまでのバッチの更新が残る。
+    """
+    repository = manager.repository
+    factor, category = ctx.params['factor'], ctx.params.get('category')
+    total = sum(item['count'] for item in repository.get_summary()['category_summary']
+                if category is None or item['category'] == category)
+    after_id, processed = 0, 0
+    ctx.progress(0, total, force=True)
+    while True:
+        updated = repository.revalue_assets(factor, category, after_id, config.JOB_BATCH_SIZE)
+        if not updated:
+            break
+        processed += len(updated)
+        after_id = updated[-1]
+        ctx.progress(processed, max(total, processed))
+    return {'updated': processed, 'factor': factor, 'category': category}
+
+
+def _validate_export(params: Dict, parse_filters: Callable) -> Dict:
+    fmt = params.get('format', 'ndjson')
+    if fmt not in STREAM_FORMATS:
+        raise ValueError('format は ndjson または json を指定してください')
+    return {'format': fmt, 'filters': parse_filters(params)}
+
+
+def _validate_revalue(params: Dict, parse_filters: Callable) -> Dict:
+    try:
+        factor = Decimal(str(params.get('factor')))
+    except InvalidOperation:
+        raise ValueError('factor は正の数値で指定してください')
+    if not factor.is_finite() or factor <= 0:
+        raise ValueError('factor は正の数値で指定してください')
+    return {'factor': str(factor), 'category': params.get('category') or None}
+
+
+# kind -> (実行する関数, パラメータを検証・正規化する関数)
+JOB_KINDS = {
+    'export': (export_assets, _validate_export),
+    'summary_rebuild': (rebuild_summary, lambda params, parse_filters: {}),
+    'revalue': (revalue_assets, _validate_revalue),
+}
+
+
+class JobManager:
+    """ジョブを jobs テーブルに登録し、上限つきのスレッドプールで実行する
+
+    スレッドプールはプロセスごとに最初のジョブの投入時に作る（gunicornのフォーク前に作ったスレッドは
+    ワーカーに引き継がれないため）。同じ時点で、このホストで終了済みのプロセスが実行していたジョブを
+    失敗として記録する。
+    """
+
+    def __init__(self, repository, artifact_dir: str, max_workers: int = 2, max_queued: int = 16,
+                 parse_filters: Optional[Callable] = None):
+        self.repository = repository
+        self.artifact_dir = artifact_dir
+        self.max_workers = max(1, max_workers)
+        self.max_queued = max_queued
+        self.parse_filters = parse_filters or (lambda params: {})
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._pending = 0
+
+    @property
+    def owner(self) -> str:
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def _ensure_process(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job-worker')
+            self._pending = 0
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        self.recover_orphaned()
+
+    def recover_orphaned(self) -> int:
+        """このホストで終了済みのプロセスが実行していたジョブを失敗として記録する"""
+        host = socket.gethostname()
+        recovered = 0
+        for job in self.repository.list_jobs(config.JOB_LIST_MAX, active_only=True):
+            owner_host, _, pid = (job['owner'] or '').rpartition(':')
+            if owner_host == host and pid.isdigit() and not _process_alive(int(pid)):
+                self.repository.finish_job(job['id'], 'failed', error='ジョブを実行していたプロセスが終了しました')
+                recovered += 1
+        return recovered
+
+    def submit(self, kind: str, params: Optional[Dict] = None) -> Dict:
+        """パラメータを検証してジョブを登録し、実行を予約する（不正なパラメータは ValueError）"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f'kind には {", ".join(JOB_KINDS)} のいずれかを指定してください')
+        params = JOB_KINDS[kind][1](params or {}, self.parse_filters)
+        self._ensure_process()
+        with self._lock:
+            if self._pending >= self.max_queued:
+                raise JobQueueFullError('実行待ちのジョブが多すぎます。しばらくしてから再試行してください')
+            self._pending += 1
+        try:
+            job = self.repository.create_job(kind, params, self.owner)
+            self._executor.submit(self._run, job, current_portfolio())
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return job
+
+    def get(self, job_id: int) -> Optional[Dict]:
+        self._ensure_process()
+        return self.repository.get_job(job_id)
+
+    def recent(self, limit: int) -> List[Dict]:
+        self._ensure_process()
+        return self.repository.list_jobs(limit)
+
+    def cancel(self, job_id: int) -> Optional[Dict]:
+        """取り消しを要求する。別のワーカーで実行中のジョブも、次の進捗の記録で止まる"""
+        return self.repository.cancel_job(job_id)
+
+    def artifact_path(self, name: str) -> str:
+        return os.path.join(self.artifact_dir, os.path.basename(name))
+
+    def _run(self, job: Dict, portfolio_id: str):
+        with self._lock:
+            self._pending -= 1
+        with use_portfolio(portfolio_id):
+            self._execute(job)
+
+    def _execute(self, job: Dict):
+        if not self.repository.start_job(job['id']):
+            return
+        func = JOB_KINDS[job['kind']][0]
+        ctx = JobContext(self, job)
+        started = time.perf_counter()
+        try:
+            result = func(ctx, self)
+        except JobCancelled:
+            status, result, error = 'cancelled', None, None
+        except Exception as e:
+            status, result, error = 'failed', None, str(e)
+        else:
+            status, error = 'succeeded', None
+        finally:
+            JOB_DURATION.observe(time.perf_counter() - started, job['kind'])
+        if status == 'succeeded':
+            self.repository.update_job_progress(job['id'], ctx.processed, ctx.total)
+        artifact = result.pop('artifact', None) if result else None
+        if status != 'succeeded':
+            # 書きかけの成果物は残さない
+            for name in (ctx.artifact_name(ext) for ext in STREAM_FORMATS):
+                for path in (self.artifact_path(name), self.artifact_path(name) + '.tmp'):
+                    if os.path.exists(path):
+                        os.remove(path)
+        self.repository.finish_job(job['id'], status, result=result, error=error, artifact=artifact)
+        JOBS_FINISHED.inc(job['kind'], status)
@@ -0,0 +1,193 @@
+"""運用コマンド
+
+使い方:
+    python manage.py summary verify    # カテゴリ別集計のずれを検出する
+    python manage.py summary rebuild   # カテゴリ別集計を assets から再計算する
+    python manage.py schema status     # スキーマのバージョンを表示する（未適用の移行は接続時に適用される）
+    python manage.py changes compact   # 差分同期用の変更ログを CHANGE_LOG_RETENTION 件まで削除する
+    python manage.py money status      # 金額の保存形式を表示する
+    python manage.py money convert     # 金額を補助通貨単位の整数で保存する形式に変換する
+    python manage.py static build      # 静的ファイルをフィンガープリント付きの名前で書き出し、事前圧縮する
+    python manage.py jobs purge        # 終了してから JOB_RETENTION_DAYS 日を過ぎたジョブと成果物を削除する
+    python manage.py history rebuild   # 評価額の履歴から日次・月次の集計を作り直す
+    python manage.py portfolios list   # ポートフォリオの一覧を表示する
+    python manage.py portfolios create ID  # ポートフォリオ（とそのデータベース）を作る
+
+--portfolio ID を付けると、default 以外のポートフォリオのデータベースに対して実行する。
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+from config import config
+from database import repository
+from sharding import DEFAULT_PORTFOLIO, PortfolioNotFoundError, ShardedRepository, normalize_portfolio_id, set_portfolio
+import static_assets
+
+
+def summary_verify(args) -> int:
+    drift = repository.verify_category_totals()
+    if drift:
+        print(json.dumps(drift, ensure_ascii=False, indent=2))
+        print(f'{len(drift)}件のカテゴリで集計にずれがあります', file=sys.stderr)
+        return 1
+    print('カテゴリ別集計は最新です')
+    return 0
+
+
+def summary_rebuild(args) -> int:
+    drift = repository.verify_category_totals()
+    repository.rebuild_category_totals()
+    print(f'カテゴリ別集計を再計算しました（修正したカテゴリ: {len(drift)}件）')
+    return 0
+
+
+def schema_status(args) -> int:
+    version = repository.get_schema_version()
+    print(f"スキーマバージョン: {version['current']}（最新: {version['latest']}）")
+    return 0 if version['current'] >= version['latest'] else 1
+
+
+def changes_compact(args) -> int:
+    deleted = repository.compact_changes(args.keep)
+    print(f'変更ログを{deleted}件削除しました')
+    return 0
+
+
+def money_status(args) -> int:
+    money = repository.money
+    if money.minor:
+        print(f'金額の保存形式: 整数（{money.currency}は小数点以下{money.scale}桁、ほかの通貨は通貨ごとの桁数）')
+    else:
+        print('金額の保存形式: DECIMAL（従来の形式）')
+    return 0
+
+
+def money_convert(args) -> int:
+    try:
+        report = repository.convert_money_storage(args.currency, args.scale)
+    except ValueError as e:
+        print(f'変換を中止しました: {e}', file=sys.stderr)
+        return 1
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"{report['rows']}件の金額を整数（通貨ごとの補助通貨単位、{report['currency']}は小数点以下{report['scale']}桁）に"
+          '変換しました。カテゴリ・通貨別の合計・件数は変換前と一致しています')
+    return 0
+
+
+def history_rebuild(args) -> int:
+    repository.rebuild_value_rollups()
+    print('評価額の日次・月次の集計を作り直しました')
+    return 0
+
+
+def static_build(args) -> int:
+    manifest = static_assets.build(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+    for logical, entry in sorted(manifest.items()):
+        print(f"{logical} -> {entry['path']}（{', '.join(entry['encodings']) or '圧縮なし'}）")
+    return 0
+
+
+def jobs_purge(args) -> int:
+    # finished_at はデータベースの CURRENT_TIMESTAMP（UTC）で記録している
+    cutoff = datetime.now(timezone.utc) - timedelta(days=args.days)
+    artifacts = repository.delete_jobs(cutoff.strftime('%Y-%m-%d %H:%M:%S'))
+    removed = 0
+    for name in artifacts:
+        path = os.path.join(config.JOB_ARTIFACT_DIR, os.path.basename(name))
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+    print(f'終了してから{args.days:g}日を過ぎたジョブを削除しました（成果物のファイル: {removed}件）')
+    return 0
+
+
+def portfolios_list(args) -> int:
+    for portfolio_id in repository.list_portfolios():
+        print(portfolio_id)
+    return 0
+
+
+def portfolios_create(args) -> int:
+    if not isinstance(repository.get(), ShardedRepository):
+        print('ポートフォリオを分けるには SHARD_URL_TEMPLATE を設定してください', file=sys.stderr)
+        return 1
+    created = repository.create_portfolio(args.id)
+    print(f'ポートフォリオ {args.id} を作成しました' if created else f'ポートフォリオ {args.id} はすでにあります')
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='資産管理アプリの運用コマンド')
+    parser.add_argument('--portfolio', type=normalize_portfolio_id, default=DEFAULT_PORTFOLIO,
+                        help='対象のポートフォリオ（既定: default）')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    summary = commands.add_parser('summary', help='カテゴリ別集計の検証・再計算')
+    summary_commands = summary.add_subparsers(dest='action', required=True)
+    summary_commands.add_parser('verify', help='集計のずれを検出する（ずれがあれば終了コード1）').set_defaults(func=summary_verify)
+    summary_commands.add_parser('rebuild', help='集計を再計算する').set_defaults(func=summary_rebuild)
+
+    schema = commands.add_parser('schema', help='スキーマのバージョン管理')
+    schema_commands = schema.add_subparsers(dest='action', required=True)
+    schema_commands.add_parser('status', help='現在のスキーマバージョンを表示する').set_defaults(func=schema_status)
+
+    changes = commands.add_parser('changes', help='差分同期用の変更ログ')
+    changes_commands = changes.add_subparsers(dest='action', required=True)
+    compact = changes_commands.add_parser('compact', help='古い変更ログを削除する')
+    compact.add_argument('--keep', type=int, default=None, help='残す件数（既定: CHANGE_LOG_RETENTION）')
+    compact.set_defaults(func=changes_compact)
+
+    money = commands.add_parser('money', help='金額の保存形式')
+    money_commands = money.add_subparsers(dest='action', required=True)
+    money_commands.add_parser('status', help='現在の保存形式を表示する').set_defaults(func=money_status)
+    convert = money_commands.add_parser('convert', help='金額を補助通貨単位の整数に変換する（変換前後の合計を照合する）')
+    convert.add_argument('--currency', default=config.CURRENCY, help='通貨コード（既定: CURRENCY）')
+    convert.add_argument('--scale', type=int, default=config.MONEY_SCALE,
+                         help='小数点以下の桁数（既定: MONEY_SCALE、未設定なら通貨の標準の桁数）')
+    convert.set_defaults(func=money_convert)
+
+    history = commands.add_parser('history', help='評価額の履歴')
+    history_commands = history.add_subparsers(dest='action', required=True)
+    history_commands.add_parser('rebuild', help='履歴から日次・月次の集計を作り直す').set_defaults(func=history_rebuild)
+
+    static = commands.add_parser('static', help='静的ファイル')
+    static_commands = static.add_subparsers(dest='action', required=True)
+    static_commands.add_parser('build', help='フィンガープリント付きの名前で書き出し、gzip・brotliで事前圧縮する').set_defaults(
+        func=static_build)
+
+    jobs = commands.add_parser('jobs', help='バックグラウンドジョブ')
+    jobs_commands = jobs.add_subparsers(dest='action', required=True)
+    purge = jobs_commands.add_parser('purge', help='終了したジョブと成果物を削除する')
+    purge.add_argument('--days', type=float, default=config.JOB_RETENTION_DAYS,
+                       help='終了してからこの日数を過ぎたジョブを削除する（既定: JOB_RETENTION_DAYS）')
+    purge.set_defaults(func=jobs_purge)
+
+    portfolios = commands.add_parser('portfolios', help='ポートフォリオ（データベースの分割）')
+    portfolios_commands = portfolios.add_subparsers(dest='action', required=True)
+    portfolios_commands.add_parser('list', help='ポートフォリオの一覧を表示する').set_defaults(func=portfolios_list)
+    create = portfolios_commands.add_parser('create', help='ポートフォリオとそのデータベースを作る')
+    create.add_argument('id', type=normalize_portfolio_id, help='ポートフォリオのid（英小文字・数字・-・_）')
+    create.set_defaults(func=portfolios_create)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.portfolio != DEFAULT_PORTFOLIO:
+        if not isinstance(repository.get(), ShardedRepository):
+            print('ポートフォリオを分けるには SHARD_URL_TEMPLATE を設定してください', file=sys.stderr)
+            return 1
+        try:
+            repository.shard(args.portfolio)
+        except PortfolioNotFoundError as e:
+            print(e, file=sys.stderr)
+            return 1
+    set_portfolio(args.portfolio)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,939 @@
+"""スキーマのマイグレーション定義
+
+各要素は (バージョン, 説明, SQL文のリスト)。既存のデータベース（バージョン管理導入前に作られたもの）に
+適用しても壊れないよう、すべての文は冪等に書く。新しい変更は末尾に追加し、既存の要素は変更しない。
+"""
+
+SQLITE_MIGRATIONS = [
+    (1, '資産テーブル', [
+        '''
+        CREATE TABLE IF NOT EXISTS assets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name VARCHAR(255) NOT NULL,
+            amount DECIMAL(15,2) NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 1,
+            description TEXT,
+            category VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, '一覧のキーセットページングとカテゴリ絞り込み用のインデックス', [
+        'CREATE INDEX IF NOT EXISTS idx_assets_created_at_id ON assets (created_at DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_assets_category_created_at_id ON assets (category, created_at DESC, id DESC)',
+    ]),
+    (3, 'カテゴリ別集計の実体化テーブルと更新トリガー', [
+        # categoryがNULLの資産は '' として集計する
+        '''
+        CREATE TABLE IF NOT EXISTS asset_category_totals (
+            category VARCHAR(100) NOT NULL PRIMARY KEY,
+            total DECIMAL(15,2) NOT NULL DEFAULT 0,
+            asset_count INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # assetsへの書き込みと同じトランザクション内で集計を更新する
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_totals_insert AFTER INSERT ON assets
+        BEGIN
+            INSERT INTO asset_category_totals (category, total, asset_count)
+            VALUES (COALESCE(NEW.category, ''), NEW.amount * NEW.quantity, 1)
+            ON CONFLICT(category) DO UPDATE SET
+                total = total + excluded.total,
+                asset_count = asset_count + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_totals_delete AFTER DELETE ON assets
+        BEGIN
+            UPDATE asset_category_totals
+            SET total = total - OLD.amount * OLD.quantity, asset_count = asset_count - 1
+            WHERE category = COALESCE(OLD.category, '');
+            DELETE FROM asset_category_totals
+            WHERE category = COALESCE(OLD.category, '') AND asset_count <= 0;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_totals_update AFTER UPDATE OF amount, quantity, category ON assets
+        WHEN OLD.amount IS NOT NEW.amount OR OLD.quantity IS NOT NEW.quantity OR OLD.category IS NOT NEW.category
+        BEGIN
+            UPDATE asset_category_totals
+            SET total = total - OLD.amount * OLD.quantity, asset_count = asset_count - 1
+            WHERE category = COALESCE(OLD.category, '');
+            INSERT INTO asset_category_totals (category, total, asset_count)
+            VALUES (COALESCE(NEW.category, ''), NEW.amount * NEW.quantity, 1)
+            ON CONFLICT(category) DO UPDATE SET
+                total = total + excluded.total,
+                asset_count = asset_count + 1;
+            DELETE FROM asset_category_totals
+            WHERE category = COALESCE(OLD.category, '') AND asset_count <= 0;
+        END
+        ''',
+        # 既存データから集計を作り直す
+        'DELETE FROM asset_category_totals',
+        '''
+        INSERT INTO asset_category_totals (category, total, asset_count)
+        SELECT COALESCE(category, ''), SUM(amount * quantity), COUNT(*)
+        FROM assets GROUP BY COALESCE(category, '')
+        ''',
+    ]),
+    (4, '差分同期用の変更ログ', [
+        # op は 'I'（追加）、'U'（更新）、'D'（削除）。id の順にたどれば変更順になる
+        '''
+        CREATE TABLE IF NOT EXISTS asset_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            asset_id INTEGER NOT NULL,
+            op CHAR(1) NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # 圧縮済みの範囲（この値以下の変更は削除済み）
+        'CREATE TABLE IF NOT EXISTS asset_change_log (compacted_through INTEGER NOT NULL)',
+        'INSERT INTO asset_change_log (compacted_through) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM asset_change_log)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_changes_insert AFTER INSERT ON assets
+        BEGIN
+            INSERT INTO asset_changes (asset_id, op) VALUES (NEW.id, 'I');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_changes_update AFTER UPDATE ON assets
+        BEGIN
+            INSERT INTO asset_changes (asset_id, op) VALUES (NEW.id, 'U');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_changes_delete AFTER DELETE ON assets
+        BEGIN
+            INSERT INTO asset_changes (asset_id, op) VALUES (OLD.id, 'D');
+        END
+        ''',
+    ]),
+    (5, '全文検索（2文字ずつのN-gram索引）', [
+        # 日本語は単語の区切りが無いため、文字列を2文字ずつ（末尾は1文字）に区切った語の並びを索引にする
+        # 位置の表は、トリガー内で再帰CTEが使えないSQLiteで文字列を分割するために使う（先頭2000文字までを索引にする）
+        'CREATE TABLE IF NOT EXISTS search_positions (i INTEGER PRIMARY KEY)',
+        '''
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 2000)
+        INSERT OR IGNORE INTO search_positions (i) SELECT i FROM n
+        ''',
+        # prefix = '1' は1文字の検索語（前方一致）用の索引
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS asset_search
+        USING fts5(name, description, category, tokenize = 'unicode61', prefix = '1')
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_search_insert AFTER INSERT ON assets
+        BEGIN
+            INSERT INTO asset_search (rowid, name, description, category) VALUES (
+                NEW.id,
+                (SELECT group_concat(gram, ' ') FROM (SELECT substr(NEW.name || '_', i, 2) AS gram FROM search_positions WHERE i <= length(NEW.name) ORDER BY i)),
+                (SELECT group_concat(gram, ' ') FROM (SELECT substr(NEW.description || '_', i, 2) AS gram FROM search_positions WHERE i <= length(NEW.description) ORDER BY i)),
+                (SELECT group_concat(gram, ' ') FROM (SELECT substr(NEW.category || '_', i, 2) AS gram FROM search_positions WHERE i <= length(NEW.category) ORDER BY i))
+            );
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_search_delete AFTER DELETE ON assets
+        BEGIN
+            DELETE FROM asset_search WHERE rowid = OLD.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_search_update AFTER UPDATE OF name, description, category ON assets
+        WHEN OLD.name IS NOT NEW.name OR OLD.description IS NOT NEW.description OR OLD.category IS NOT NEW.category
+        BEGIN
+            DELETE FROM asset_search WHERE rowid = OLD.id;
+            INSERT INTO asset_search (rowid, name, description, category) VALUES (
+                NEW.id,
+                (SELECT group_concat(gram, ' ') FROM (SELECT substr(NEW.name || '_', i, 2) AS gram FROM search_positions WHERE i <= length(NEW.name) ORDER BY i)),
+                (SELECT group_concat(gram, ' ') FROM (SELECT substr(NEW.description || '_', i, 2) AS gram FROM search_positions WHERE i <= length(NEW.description) ORDER BY i)),
+                (SELECT group_concat(gram, ' ') FROM (SELECT substr(NEW.category || '_', i, 2) AS gram FROM search_positions WHERE i <= length(NEW.category) ORDER BY i))
+            );
+        END
+        ''',
+        'DELETE FROM asset_search',
+        '''
+        INSERT INTO asset_search (rowid, name, description, category)
+        SELECT
+            id,
+            (SELECT group_concat(gram, ' ') FROM (SELECT substr(name || '_', i, 2) AS gram FROM search_positions WHERE i <= length(name) ORDER BY i)),
+            (SELECT group_concat(gram, ' ') FROM (SELECT substr(description || '_', i, 2) AS gram FROM search_positions WHERE i <= length(description) ORDER BY i)),
+            (SELECT group_concat(gram, ' ') FROM (SELECT substr(category || '_', i, 2) AS gram FROM search_positions WHERE i <= length(category) ORDER BY i))
+        FROM assets
+        ''',
+    ]),
+    (6, '金額の保存形式', [
+        # 行が無ければ従来どおり DECIMAL の値で保存する。整数（補助通貨単位）への変換は
+        # AssetRepository.convert_money_storage が行い、変換後の通貨と桁数をここに記録する
+        'CREATE TABLE IF NOT EXISTS money_storage (currency CHAR(3) NOT NULL, scale INTEGER NOT NULL)',
+    ]),
+    (7, 'バックグラウンドジョブ', [
+        # params / result はJSON文字列、artifact は JOB_ARTIFACT_DIR 内のファイル名、owner は実行したプロセス（ホスト名:pid）
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind VARCHAR(50) NOT NULL,
+            params TEXT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            processed INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            result TEXT,
+            error TEXT,
+            artifact VARCHAR(255),
+            owner VARCHAR(255),
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)',
+    ]),
+    (8, '評価額の履歴と日次・月次の集計', [
+        # 金額か数量が変わるたびに1行追記する（削除では value = 0）。delta は評価額（金額×数量）の増減
+        '''
+        CREATE TABLE IF NOT EXISTS asset_valuations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            asset_id INTEGER NOT NULL,
+            op CHAR(1) NOT NULL,
+            amount DECIMAL(15,2) NOT NULL,
+            quantity INTEGER NOT NULL,
+            value DECIMAL(38,2) NOT NULL,
+            delta DECIMAL(38,2) NOT NULL,
+            valued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_asset_valuations_asset_id ON asset_valuations (asset_id, id)',
+        # period は日次なら日付、月次なら月初の日付（UTC）。closing_value はその期間の終わりの評価額の合計
+        '''
+        CREATE TABLE IF NOT EXISTS asset_value_daily (
+            period DATE NOT NULL PRIMARY KEY,
+            closing_value DECIMAL(38,2) NOT NULL,
+            net_change DECIMAL(38,2) NOT NULL,
+            change_count INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS asset_value_monthly (
+            period DATE NOT NULL PRIMARY KEY,
+            closing_value DECIMAL(38,2) NOT NULL,
+            net_change DECIMAL(38,2) NOT NULL,
+            change_count INTEGER NOT NULL
+        )
+        ''',
+        # 既存の資産は登録日時の評価額として履歴を作る（削除済みの資産の履歴は残っていない）
+        '''
+        INSERT INTO asset_valuations (asset_id, op, amount, quantity, value, delta, valued_at)
+        SELECT id, 'I', amount, quantity, amount * quantity, amount * quantity, COALESCE(created_at, CURRENT_TIMESTAMP)
+        FROM assets WHERE NOT EXISTS (SELECT 1 FROM asset_valuations)
+        ORDER BY id
+        ''',
+        'DELETE FROM asset_value_daily',
+        '''
+        INSERT INTO asset_value_daily (period, closing_value, net_change, change_count)
+        SELECT period, SUM(net_change) OVER (ORDER BY period), net_change, change_count FROM (
+            SELECT date(valued_at) AS period, SUM(delta) AS net_change, COUNT(*) AS change_count
+            FROM asset_valuations GROUP BY date(valued_at)
+        )
+        ''',
+        'DELETE FROM asset_value_monthly',
+        '''
+        INSERT INTO asset_value_monthly (period, closing_value, net_change, change_count)
+        SELECT period, SUM(net_change) OVER (ORDER BY period), net_change, change_count FROM (
+            SELECT strftime('%Y-%m-01', valued_at) AS period, SUM(delta) AS net_change, COUNT(*) AS change_count
+            FROM asset_valuations GROUP BY strftime('%Y-%m-01', valued_at)
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_valuations_insert AFTER INSERT ON assets
+        BEGIN
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, value, delta)
+            VALUES (NEW.id, 'I', NEW.amount, NEW.quantity, NEW.amount * NEW.quantity, NEW.amount * NEW.quantity);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_valuations_update AFTER UPDATE OF amount, quantity ON assets
+        WHEN OLD.amount IS NOT NEW.amount OR OLD.quantity IS NOT NEW.quantity
+        BEGIN
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, value, delta)
+            VALUES (NEW.id, 'U', NEW.amount, NEW.quantity, NEW.amount * NEW.quantity,
+                    NEW.amount * NEW.quantity - OLD.amount * OLD.quantity);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_valuations_delete AFTER DELETE ON assets
+        BEGIN
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, value, delta)
+            VALUES (OLD.id, 'D', OLD.amount, OLD.quantity, 0, -(OLD.amount * OLD.quantity));
+        END
+        ''',
+        # 履歴の追記と同じトランザクション内で、その日・その月の集計を更新する。
+        # 期間の最初の変更では、直前の期間の終わりの評価額から始める
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_asset_valuations_rollup AFTER INSERT ON asset_valuations
+        BEGIN
+            INSERT INTO asset_value_daily (period, closing_value, net_change, change_count)
+            VALUES (
+                date(NEW.valued_at),
+                COALESCE((SELECT closing_value FROM asset_value_daily WHERE period < date(NEW.valued_at)
+                          ORDER BY period DESC LIMIT 1), 0) + NEW.delta,
+                NEW.delta, 1
+            )
+            ON CONFLICT(period) DO UPDATE SET
+                closing_value = closing_value + excluded.net_change,
+                net_change = net_change + excluded.net_change,
+                change_count = change_count + 1;
+            INSERT INTO asset_value_monthly (period, closing_value, net_change, change_count)
+            VALUES (
+                strftime('%Y-%m-01', NEW.valued_at),
+                COALESCE((SELECT closing_value FROM asset_value_monthly WHERE period < strftime('%Y-%m-01', NEW.valued_at)
+                          ORDER BY period DESC LIMIT 1), 0) + NEW.delta,
+                NEW.delta, 1
+            )
+            ON CONFLICT(period) DO UPDATE SET
+                closing_value = closing_value + excluded.net_change,
+                net_change = net_change + excluded.net_change,
+                change_count = change_count + 1;
+        END
+        ''',
+    ]),
+    (9, '資産の通貨と通貨別の集計', [
+        # 既存の資産の通貨は、整数で保存していればその通貨、そうでなければ円とする。
+        # 列の追加は冪等に書けないが、移行は1つのトランザクションで行うため途中で止まっても残らない
+        "ALTER TABLE assets ADD COLUMN currency CHAR(3) NOT NULL DEFAULT 'JPY'",
+        'UPDATE assets SET currency = (SELECT currency FROM money_storage) WHERE EXISTS (SELECT 1 FROM money_storage)',
+        # カテゴリ別集計を (カテゴリ, 通貨) ごとにする（通貨の異なる金額は足さない）
+        'DROP TRIGGER IF EXISTS trg_assets_totals_insert',
+        'DROP TRIGGER IF EXISTS trg_assets_totals_delete',
+        'DROP TRIGGER IF EXISTS trg_assets_totals_update',
+        'DROP TABLE IF EXISTS asset_category_totals',
+        '''
+        CREATE TABLE IF NOT EXISTS asset_category_totals (
+            category VARCHAR(100) NOT NULL,
+            currency CHAR(3) NOT NULL,
+            total DECIMAL(15,2) NOT NULL DEFAULT 0,
+            asset_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (category, currency)
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_totals_insert AFTER INSERT ON assets
+        BEGIN
+            INSERT INTO asset_category_totals (category, currency, total, asset_count)
+            VALUES (COALESCE(NEW.category, ''), NEW.currency, NEW.amount * NEW.quantity, 1)
+            ON CONFLICT(category, currency) DO UPDATE SET
+                total = total + excluded.total,
+                asset_count = asset_count + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_totals_delete AFTER DELETE ON assets
+        BEGIN
+            UPDATE asset_category_totals
+            SET total = total - OLD.amount * OLD.quantity, asset_count = asset_count - 1
+            WHERE category = COALESCE(OLD.category, '') AND currency = OLD.currency;
+            DELETE FROM asset_category_totals
+            WHERE category = COALESCE(OLD.category, '') AND currency = OLD.currency AND asset_count <= 0;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_totals_update AFTER UPDATE OF amount, quantity, category, currency ON assets
+        WHEN OLD.amount IS NOT NEW.amount OR OLD.quantity IS NOT NEW.quantity OR OLD.category IS NOT NEW.category
+            OR OLD.currency IS NOT NEW.currency
+        BEGIN
+            UPDATE asset_category_totals
+            SET total = total - OLD.amount * OLD.quantity, asset_count = asset_count - 1
+            WHERE category = COALESCE(OLD.category, '') AND currency = OLD.currency;
+            INSERT INTO asset_category_totals (category, currency, total, asset_count)
+            VALUES (COALESCE(NEW.category, ''), NEW.currency, NEW.amount * NEW.quantity, 1)
+            ON CONFLICT(category, currency) DO UPDATE SET
+                total = total + excluded.total,
+                asset_count = asset_count + 1;
+            DELETE FROM asset_category_totals
+            WHERE category = COALESCE(OLD.category, '') AND currency = OLD.currency AND asset_count <= 0;
+        END
+        ''',
+        '''
+        INSERT INTO asset_category_totals (category, currency, total, asset_count)
+        SELECT COALESCE(category, ''), currency, SUM(amount * quantity), COUNT(*)
+        FROM assets GROUP BY COALESCE(category, ''), currency
+        ''',
+        # 評価額の履歴と日次・月次の集計も通貨ごとにする（直前の期間の値を通貨ごとに引けるよう、主キーは通貨が先）
+        "ALTER TABLE asset_valuations ADD COLUMN currency CHAR(3) NOT NULL DEFAULT 'JPY'",
+        'UPDATE asset_valuations SET currency = (SELECT currency FROM money_storage) WHERE EXISTS (SELECT 1 FROM money_storage)',
+        'DROP TRIGGER IF EXISTS trg_asset_valuations_rollup',
+        'DROP TRIGGER IF EXISTS trg_assets_valuations_insert',
+        'DROP TRIGGER IF EXISTS trg_assets_valuations_update',
+        'DROP TRIGGER IF EXISTS trg_assets_valuations_delete',
+        'DROP TABLE IF EXISTS asset_value_daily',
+        'DROP TABLE IF EXISTS asset_value_monthly',
+        '''
+        CREATE TABLE IF NOT EXISTS asset_value_daily (
+            period DATE NOT NULL,
+            currency CHAR(3) NOT NULL,
+            closing_value DECIMAL(38,2) NOT NULL,
+            net_change DECIMAL(38,2) NOT NULL,
+            change_count INTEGER NOT NULL,
+            PRIMARY KEY (currency, period)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS asset_value_monthly (
+            period DATE NOT NULL,
+            currency CHAR(3) NOT NULL,
+            closing_value DECIMAL(38,2) NOT NULL,
+            net_change DECIMAL(38,2) NOT NULL,
+            change_count INTEGER NOT NULL,
+            PRIMARY KEY (currency, period)
+        )
+        ''',
+        '''
+        INSERT INTO asset_value_daily (period, currency, closing_value, net_change, change_count)
+        SELECT period, currency, SUM(net_change) OVER (PARTITION BY currency ORDER BY period), net_change, change_count
+        FROM (
+            SELECT date(valued_at) AS period, currency, SUM(delta) AS net_change, COUNT(*) AS change_count
+            FROM asset_valuations GROUP BY date(valued_at), currency
+        )
+        ''',
+        '''
+        INSERT INTO asset_value_monthly (period, currency, closing_value, net_change, change_count)
+        SELECT period, currency, SUM(net_change) OVER (PARTITION BY currency ORDER BY period), net_change, change_count
+        FROM (
+            SELECT strftime('%Y-%m-01', valued_at) AS period, currency, SUM(delta) AS net_change, COUNT(*) AS change_count
+            FROM asset_valuations GROUP BY strftime('%Y-%m-01', valued_at), currency
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_valuations_insert AFTER INSERT ON assets
+        BEGIN
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, currency, value, delta)
+            VALUES (NEW.id, 'I', NEW.amount, NEW.quantity, NEW.currency, NEW.amount * NEW.quantity, NEW.amount * NEW.quantity);
+        END
+        ''',
+        # 通貨が変わった場合は、元の通貨から評価額を除く行と新しい通貨に加える行の2行を追記する
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_valuations_update AFTER UPDATE OF amount, quantity, currency ON assets
+        WHEN OLD.amount IS NOT NEW.amount OR OLD.quantity IS NOT NEW.quantity OR OLD.currency IS NOT NEW.currency
+        BEGIN
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, currency, value, delta)
+            SELECT OLD.id, 'U', OLD.amount, OLD.quantity, OLD.currency, 0, -(OLD.amount * OLD.quantity)
+            WHERE OLD.currency IS NOT NEW.currency;
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, currency, value, delta)
+            VALUES (NEW.id, 'U', NEW.amount, NEW.quantity, NEW.currency, NEW.amount * NEW.quantity,
+                    NEW.amount * NEW.quantity
+                    - CASE WHEN OLD.currency IS NEW.currency THEN OLD.amount * OLD.quantity ELSE 0 END);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_valuations_delete AFTER DELETE ON assets
+        BEGIN
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, currency, value, delta)
+            VALUES (OLD.id, 'D', OLD.amount, OLD.quantity, OLD.currency, 0, -(OLD.amount * OLD.quantity));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_asset_valuations_rollup AFTER INSERT ON asset_valuations
+        BEGIN
+            INSERT INTO asset_value_daily (period, currency, closing_value, net_change, change_count)
+            VALUES (
+                date(NEW.valued_at), NEW.currency,
+                COALESCE((SELECT closing_value FROM asset_value_daily
+                          WHERE currency = NEW.currency AND period < date(NEW.valued_at)
+                          ORDER BY period DESC LIMIT 1), 0) + NEW.delta,
+                NEW.delta, 1
+            )
+            ON CONFLICT(currency, period) DO UPDATE SET
+                closing_value = closing_value + excluded.net_change,
+                net_change = net_change + excluded.net_change,
+                change_count = change_count + 1;
+            INSERT INTO asset_value_monthly (period, currency, closing_value, net_change, change_count)
+            VALUES (
+                strftime('%Y-%m-01', NEW.valued_at), NEW.currency,
+                COALESCE((SELECT closing_value FROM asset_value_monthly
+                          WHERE currency = NEW.currency AND period < strftime('%Y-%m-01', NEW.valued_at)
+                          ORDER BY period DESC LIMIT 1), 0) + NEW.delta,
+                NEW.delta, 1
+            )
+            ON CONFLICT(currency, period) DO UPDATE SET
+                closing_value = closing_value + excluded.net_change,
+                net_change = net_change + excluded.net_change,
+                change_count = change_count + 1;
+        END
+        ''',
+    ]),
+    (10, 'ポートフォリオの一覧', [
+        # ポートフォリオごとにデータベースを分ける場合（SHARD_URL_TEMPLATE）、既定のデータベースの一覧を正とする
+        '''
+        CREATE TABLE IF NOT EXISTS portfolios (
+            id VARCHAR(64) NOT NULL PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "INSERT OR IGNORE INTO portfolios (id) VALUES ('default')",
+    ]),
+]
+
+AZURE_MIGRATIONS = [
+    (1, '資産テーブル', [
+        '''
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='assets' AND xtype='U')
+        CREATE TABLE assets (
+            id INT IDENTITY(1,1) PRIMARY KEY,
+            name NVARCHAR(255) NOT NULL,
+            amount DECIMAL(15,2) NOT NULL,
+            quantity INT NOT NULL DEFAULT 1,
+            description NVARCHAR(MAX),
+            category NVARCHAR(100),
+            created_at DATETIME2 DEFAULT GETDATE()
+        )
+        ''',
+    ]),
+    (2, '一覧のキーセットページングとカテゴリ絞り込み用のインデックス', [
+        '''
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_assets_created_at_id' AND object_id=OBJECT_ID('assets'))
+        CREATE INDEX idx_assets_created_at_id ON assets (created_at DESC, id DESC)
+        ''',
+        '''
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_assets_category_created_at_id' AND object_id=OBJECT_ID('assets'))
+        CREATE INDEX idx_assets_category_created_at_id ON assets (category, created_at DESC, id DESC)
+        ''',
+    ]),
+    (3, 'カテゴリ別集計の実体化テーブルと更新トリガー', [
+        # categoryがNULLの資産は N'' として集計する
+        '''
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='asset_category_totals' AND xtype='U')
+        CREATE TABLE asset_category_totals (
+            category NVARCHAR(100) NOT NULL PRIMARY KEY,
+            total DECIMAL(38,2) NOT NULL DEFAULT 0,
+            asset_count INT NOT NULL DEFAULT 0
+        )
+        ''',
+        # assetsへの書き込みと同じトランザクション内で集計を更新する
+        '''
+        CREATE OR ALTER TRIGGER trg_assets_category_totals ON assets
+        AFTER INSERT, UPDATE, DELETE
+        AS
+        BEGIN
+            SET NOCOUNT ON;
+            MERGE asset_category_totals WITH (HOLDLOCK) AS t
+            USING (
+                SELECT category, SUM(total) AS total, SUM(cnt) AS cnt
+                FROM (
+                    SELECT COALESCE(category, N'') AS category, amount * quantity AS total, 1 AS cnt FROM inserted
+                    UNION ALL
+                    SELECT COALESCE(category, N''), -(amount * quantity), -1 FROM deleted
+                ) AS d
+                GROUP BY category
+            ) AS s
+            ON t.category = s.category
+            WHEN MATCHED THEN
+                UPDATE SET t.total = t.total + s.total, t.asset_count = t.asset_count + s.cnt
+            WHEN NOT MATCHED THEN
+                INSERT (category, total, asset_count) VALUES (s.category, s.total, s.cnt);
+            DELETE FROM asset_category_totals WHERE asset_count <= 0;
+        END
+        ''',
+        # 既存データから集計を作り直す
+        'DELETE FROM asset_category_totals',
+        '''
+        INSERT INTO asset_category_totals (category, total, asset_count)
+        SELECT COALESCE(category, N''), SUM(amount * quantity), COUNT(*)
+        FROM assets WITH (TABLOCK, HOLDLOCK) GROUP BY COALESCE(category, N'')
+        ''',
+    ]),
+    (4, '差分同期用の変更ログ', [
+        # op は 'I'（追加）、'U'（更新）、'D'（削除）。id の順にたどれば変更順になる
+        '''
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='asset_changes' AND xtype='U')
+        CREATE TABLE asset_changes (
+            id BIGINT IDENTITY(1,1) PRIMARY KEY,
+            asset_id INT NOT NULL,
+            op CHAR(1) NOT NULL,
+            changed_at DATETIME2 DEFAULT GETDATE()
+        )
+        ''',
+        # 圧縮済みの範囲（この値以下の変更は削除済み）
+        '''
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='asset_change_log' AND xtype='U')
+        CREATE TABLE asset_change_log (compacted_through BIGINT NOT NULL)
+        ''',
+        'INSERT INTO asset_change_log (compacted_through) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM asset_change_log)',
+        '''
+        CREATE OR ALTER TRIGGER trg_assets_changes ON assets
+        AFTER INSERT, UPDATE, DELETE
+        AS
+        BEGIN
+            SET NOCOUNT ON;
+            INSERT INTO asset_changes (asset_id, op)
+            SELECT COALESCE(i.id, d.id),
+                   CASE WHEN d.id IS NULL THEN 'I' WHEN i.id IS NULL THEN 'D' ELSE 'U' END
+            FROM inserted AS i FULL OUTER JOIN deleted AS d ON i.id = d.id;
+        END
+        ''',
+    ]),
+    (5, '全文検索（2文字ずつのN-gram索引）', [
+        # 日本語は単語の区切りが無いため、文字列を2文字ずつ（末尾は1文字）に区切った語を索引にする
+        # field は 1: name, 2: description, 3: category
+        "IF OBJECT_ID('search_positions', 'U') IS NULL CREATE TABLE search_positions (i INT NOT NULL PRIMARY KEY)",
+        '''
+        IF NOT EXISTS (SELECT 1 FROM search_positions)
+        INSERT INTO search_positions (i)
+        SELECT TOP (2000) ROW_NUMBER() OVER (ORDER BY (SELECT NULL))
+        FROM sys.all_objects AS a CROSS JOIN sys.all_objects AS b
+        ''',
+        '''
+        IF OBJECT_ID('asset_search_grams', 'U') IS NULL
+        CREATE TABLE asset_search_grams (
+            gram NVARCHAR(2) NOT NULL,
+            asset_id INT NOT NULL,
+            field TINYINT NOT NULL,
+            CONSTRAINT pk_asset_search_grams PRIMARY KEY (gram, asset_id, field)
+        )
+        ''',
+        '''
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_asset_search_grams_asset_id' AND object_id=OBJECT_ID('asset_search_grams'))
+        CREATE INDEX idx_asset_search_grams_asset_id ON asset_search_grams (asset_id)
+        ''',
+        '''
+        CREATE OR ALTER TRIGGER trg_assets_search ON assets
+        AFTER INSERT, UPDATE, DELETE
+        AS
+        BEGIN
+            SET NOCOUNT ON;
+            -- name / description / category が変わった行だけ索引を作り直す
+            DECLARE @changed TABLE (id INT PRIMARY KEY);
+            INSERT INTO @changed (id)
+            SELECT COALESCE(i.id, d.id)
+            FROM inserted AS i FULL OUTER JOIN deleted AS d ON i.id = d.id
+            WHERE NOT EXISTS (SELECT i.name, i.description, i.category INTERSECT SELECT d.name, d.description, d.category);
+            DELETE g FROM asset_search_grams AS g JOIN @changed AS c ON g.asset_id = c.id;
+            INSERT INTO asset_search_grams (gram, asset_id, field)
+            SELECT DISTINCT SUBSTRING(f.text + N'_', p.i, 2), i.id, f.field
+            FROM inserted AS i
+            JOIN @changed AS c ON c.id = i.id
+            CROSS APPLY (VALUES (1, i.name), (2, i.description), (3, i.category)) AS f(field, text)
+            JOIN search_positions AS p ON p.i <= LEN(f.text);
+        END
+        ''',
+        'TRUNCATE TABLE asset_search_grams',
+        '''
+        INSERT INTO asset_search_grams (gram, asset_id, field)
+        SELECT DISTINCT SUBSTRING(f.text + N'_', p.i, 2), a.id, f.field
+        FROM assets AS a
+        CROSS APPLY (VALUES (1, a.name), (2, a.description), (3, a.category)) AS f(field, text)
+        JOIN search_positions AS p ON p.i <= LEN(f.text)
+        ''',
+    ]),
+    (6, '金額の保存形式', [
+        # 行が無ければ従来どおり DECIMAL の値で保存する。整数（補助通貨単位）への変換は
+        # AssetRepository.convert_money_storage が行い、変換後の通貨と桁数をここに記録する
+        "IF OBJECT_ID('money_storage', 'U') IS NULL CREATE TABLE money_storage (currency CHAR(3) NOT NULL, scale INT NOT NULL)",
+    ]),
+    (7, 'バックグラウンドジョブ', [
+        '''
+        IF OBJECT_ID('jobs', 'U') IS NULL
+        CREATE TABLE jobs (
+            id INT IDENTITY(1,1) PRIMARY KEY,
+            kind NVARCHAR(50) NOT NULL,
+            params NVARCHAR(MAX) NOT NULL,
+            status NVARCHAR(20) NOT NULL DEFAULT 'queued',
+            processed BIGINT NOT NULL DEFAULT 0,
+            total BIGINT NULL,
+            result NVARCHAR(MAX) NULL,
+            error NVARCHAR(MAX) NULL,
+            artifact NVARCHAR(255) NULL,
+            owner NVARCHAR(255) NULL,
+            cancel_requested BIT NOT NULL DEFAULT 0,
+            created_at DATETIME2 DEFAULT GETDATE(),
+            started_at DATETIME2 NULL,
+            finished_at DATETIME2 NULL
+        )
+        ''',
+        '''
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_jobs_status' AND object_id=OBJECT_ID('jobs'))
+        CREATE INDEX idx_jobs_status ON jobs (status)
+        ''',
+    ]),
+    (8, '評価額の履歴と日次・月次の集計', [
+        # 金額か数量が変わるたびに1行追記する（削除では value = 0）。delta は評価額（金額×数量）の増減
+        '''
+        IF OBJECT_ID('asset_valuations', 'U') IS NULL
+        CREATE TABLE asset_valuations (
+            id BIGINT IDENTITY(1,1) PRIMARY KEY,
+            asset_id INT NOT NULL,
+            op CHAR(1) NOT NULL,
+            amount DECIMAL(38,2) NOT NULL,
+            quantity INT NOT NULL,
+            value DECIMAL(38,2) NOT NULL,
+            delta DECIMAL(38,2) NOT NULL,
+            valued_at DATETIME2 DEFAULT GETDATE()
+        )
+        ''',
+        '''
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_asset_valuations_asset_id' AND object_id=OBJECT_ID('asset_valuations'))
+        CREATE INDEX idx_asset_valuations_asset_id ON asset_valuations (asset_id, id)
+        ''',
+        # period は日次なら日付、月次なら月初の日付。closing_value はその期間の終わりの評価額の合計
+        '''
+        IF OBJECT_ID('asset_value_daily', 'U') IS NULL
+        CREATE TABLE asset_value_daily (
+            period DATE NOT NULL PRIMARY KEY,
+            closing_value DECIMAL(38,2) NOT NULL,
+            net_change DECIMAL(38,2) NOT NULL,
+            change_count INT NOT NULL
+        )
+        ''',
+        '''
+        IF OBJECT_ID('asset_value_monthly', 'U') IS NULL
+        CREATE TABLE asset_value_monthly (
+            period DATE NOT NULL PRIMARY KEY,
+            closing_value DECIMAL(38,2) NOT NULL,
+            net_change DECIMAL(38,2) NOT NULL,
+            change_count INT NOT NULL
+        )
+        ''',
+        # 既存の資産は登録日時の評価額として履歴を作る（削除済みの資産の履歴は残っていない）
+        '''
+        IF NOT EXISTS (SELECT 1 FROM asset_valuations)
+        INSERT INTO asset_valuations (asset_id, op, amount, quantity, value, delta, valued_at)
+        SELECT id, 'I', amount, quantity, amount * quantity, amount * quantity, COALESCE(created_at, GETDATE())
+        FROM assets WITH (TABLOCK, HOLDLOCK) ORDER BY id
+        ''',
+        'DELETE FROM asset_value_daily',
+        '''
+        INSERT INTO asset_value_daily (period, closing_value, net_change, change_count)
+        SELECT period, SUM(net_change) OVER (ORDER BY period ROWS UNBOUNDED PRECEDING), net_change, change_count FROM (
+            SELECT CAST(valued_at AS DATE) AS period, SUM(delta) AS net_change, COUNT(*) AS change_count
+            FROM asset_valuations GROUP BY CAST(valued_at AS DATE)
+        ) AS d
+        ''',
+        'DELETE FROM asset_value_monthly',
+        '''
+        INSERT INTO asset_value_monthly (period, closing_value, net_change, change_count)
+        SELECT period, SUM(net_change) OVER (ORDER BY period ROWS UNBOUNDED PRECEDING), net_change, change_count FROM (
+            SELECT DATEFROMPARTS(YEAR(valued_at), MONTH(valued_at), 1) AS period, SUM(delta) AS net_change,
+                   COUNT(*) AS change_count
+            FROM asset_valuations GROUP BY DATEFROMPARTS(YEAR(valued_at), MONTH(valued_at), 1)
+        ) AS d
+        ''',
+        # 履歴の追記と同じトランザクション内で、その日・その月の集計を更新する。
+        # 期間の最初の変更では、直前の期間の終わりの評価額から始める
+        '''
+        CREATE OR ALTER TRIGGER trg_assets_valuations ON assets
+        AFTER INSERT, UPDATE, DELETE
+        AS
+        BEGIN
+            SET NOCOUNT ON;
+            DECLARE @now DATETIME2 = GETDATE();
+            DECLARE @rows TABLE (delta DECIMAL(38,2));
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, value, delta, valued_at)
+            OUTPUT INSERTED.delta INTO @rows
+            SELECT COALESCE(i.id, d.id),
+                   CASE WHEN d.id IS NULL THEN 'I' WHEN i.id IS NULL THEN 'D' ELSE 'U' END,
+                   COALESCE(i.amount, d.amount), COALESCE(i.quantity, d.quantity),
+                   COALESCE(i.amount * i.quantity, 0),
+                   COALESCE(i.amount * i.quantity, 0) - COALESCE(d.amount * d.quantity, 0),
+                   @now
+            FROM inserted AS i FULL OUTER JOIN deleted AS d ON i.id = d.id
+            WHERE i.id IS NULL OR d.id IS NULL OR i.amount <> d.amount OR i.quantity <> d.quantity;
+            IF NOT EXISTS (SELECT 1 FROM @rows) RETURN;
+            DECLARE @delta DECIMAL(38,2) = (SELECT SUM(delta) FROM @rows);
+            DECLARE @count INT = (SELECT COUNT(*) FROM @rows);
+            DECLARE @day DATE = CAST(@now AS DATE);
+            DECLARE @month DATE = DATEFROMPARTS(YEAR(@now), MONTH(@now), 1);
+            UPDATE asset_value_daily WITH (UPDLOCK, HOLDLOCK)
+            SET closing_value = closing_value + @delta, net_change = net_change + @delta, change_count = change_count + @count
+            WHERE period = @day;
+            IF @@ROWCOUNT = 0
+                INSERT INTO asset_value_daily (period, closing_value, net_change, change_count)
+                SELECT @day, COALESCE((SELECT TOP (1) closing_value FROM asset_value_daily WITH (UPDLOCK, HOLDLOCK)
+                                       WHERE period < @day ORDER BY period DESC), 0) + @delta, @delta, @count;
+            UPDATE asset_value_monthly WITH (UPDLOCK, HOLDLOCK)
+            SET closing_value = closing_value + @delta, net_change = net_change + @delta, change_count = change_count + @count
+            WHERE period = @month;
+            IF @@ROWCOUNT = 0
+                INSERT INTO asset_value_monthly (period, closing_value, net_change, change_count)
+                SELECT @month, COALESCE((SELECT TOP (1) closing_value FROM asset_value_monthly WITH (UPDLOCK, HOLDLOCK)
+                                         WHERE period < @month ORDER BY period DESC), 0) + @delta, @delta, @count;
+        END
+        ''',
+    ]),
+    (9, '資産の通貨と通貨別の集計', [
+        # 既存の資産の通貨は、整数で保存していればその通貨、そうでなければ円とする
+        '''
+        IF COL_LENGTH('assets', 'currency') IS NULL
+        ALTER TABLE assets ADD currency CHAR(3) NOT NULL CONSTRAINT df_assets_currency DEFAULT 'JPY'
+        ''',
+        '''
+        IF EXISTS (SELECT 1 FROM money_storage)
+        UPDATE assets SET currency = (SELECT TOP (1) currency FROM money_storage)
+        WHERE currency <> (SELECT TOP (1) currency FROM money_storage)
+        ''',
+        # カテゴリ別集計を (カテゴリ, 通貨) ごとにする（通貨の異なる金額は足さない）
+        '''
+        IF OBJECT_ID('asset_category_totals', 'U') IS NOT NULL AND COL_LENGTH('asset_category_totals', 'currency') IS NULL
+        DROP TABLE asset_category_totals
+        ''',
+        '''
+        IF OBJECT_ID('asset_category_totals', 'U') IS NULL
+        CREATE TABLE asset_category_totals (
+            category NVARCHAR(100) NOT NULL,
+            currency CHAR(3) NOT NULL,
+            total DECIMAL(38,2) NOT NULL DEFAULT 0,
+            asset_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (category, currency)
+        )
+        ''',
+        '''
+        CREATE OR ALTER TRIGGER trg_assets_category_totals ON assets
+        AFTER INSERT, UPDATE, DELETE
+        AS
+        BEGIN
+            SET NOCOUNT ON;
+            MERGE asset_category_totals WITH (HOLDLOCK) AS t
+            USING (
+                SELECT category, currency, SUM(total) AS total, SUM(cnt) AS cnt
+                FROM (
+                    SELECT COALESCE(category, N'') AS category, currency, amount * quantity AS total, 1 AS cnt FROM inserted
+                    UNION ALL
+                    SELECT COALESCE(category, N''), currency, -(amount * quantity), -1 FROM deleted
+                ) AS d
+                GROUP BY category, currency
+            ) AS s
+            ON t.category = s.category AND t.currency = s.currency
+            WHEN MATCHED THEN
+                UPDATE SET t.total = t.total + s.total, t.asset_count = t.asset_count + s.cnt
+            WHEN NOT MATCHED THEN
+                INSERT (category, currency, total, asset_count) VALUES (s.category, s.currency, s.total, s.cnt);
+            DELETE FROM asset_category_totals WHERE asset_count <= 0;
+        END
+        ''',
+        'DELETE FROM asset_category_totals',
+        '''
+        INSERT INTO asset_category_totals (category, currency, total, asset_count)
+        SELECT COALESCE(category, N''), currency, SUM(amount * quantity), COUNT(*)
+        FROM assets WITH (TABLOCK, HOLDLOCK) GROUP BY COALESCE(category, N''), currency
+        ''',
+        # 評価額の履歴と日次・月次の集計も通貨ごとにする（直前の期間の値を通貨ごとに引けるよう、主キーは通貨が先）
+        '''
+        IF COL_LENGTH('asset_valuations', 'currency') IS NULL
+        ALTER TABLE asset_valuations ADD currency CHAR(3) NOT NULL CONSTRAINT df_asset_valuations_currency DEFAULT 'JPY'
+        ''',
+        '''
+        IF EXISTS (SELECT 1 FROM money_storage)
+        UPDATE asset_valuations SET currency = (SELECT TOP (1) currency FROM money_storage)
+        WHERE currency <> (SELECT TOP (1) currency FROM money_storage)
+        ''',
+        "IF COL_LENGTH('asset_value_daily', 'currency') IS NULL DROP TABLE asset_value_daily",
+        "IF COL_LENGTH('asset_value_monthly', 'currency') IS NULL DROP TABLE asset_value_monthly",
+        '''
+        IF OBJECT_ID('asset_value_daily', 'U') IS NULL
+        CREATE TABLE asset_value_daily (
+            period DATE NOT NULL,
+            currency CHAR(3) NOT NULL,
+            closing_value DECIMAL(38,2) NOT NULL,
+            net_change DECIMAL(38,2) NOT NULL,
+            change_count INT NOT NULL,
+            PRIMARY KEY (currency, period)
+        )
+        ''',
+        '''
+        IF OBJECT_ID('asset_value_monthly', 'U') IS NULL
+        CREATE TABLE asset_value_monthly (
+            period DATE NOT NULL,
+            currency CHAR(3) NOT NULL,
+            closing_value DECIMAL(38,2) NOT NULL,
+            net_change DECIMAL(38,2) NOT NULL,
+            change_count INT NOT NULL,
+            PRIMARY KEY (currency, period)
+        )
+        ''',
+        'DELETE FROM asset_value_daily',
+        '''
+        INSERT INTO asset_value_daily (period, currency, closing_value, net_change, change_count)
+        SELECT period, currency, SUM(net_change) OVER (PARTITION BY currency ORDER BY period ROWS UNBOUNDED PRECEDING),
+               net_change, change_count
+        FROM (
+            SELECT CAST(valued_at AS DATE) AS period, currency, SUM(delta) AS net_change, COUNT(*) AS change_count
+            FROM asset_valuations GROUP BY CAST(valued_at AS DATE), currency
+        ) AS d
+        ''',
+        'DELETE FROM asset_value_monthly',
+        '''
+        INSERT INTO asset_value_monthly (period, currency, closing_value, net_change, change_count)
+        SELECT period, currency, SUM(net_change) OVER (PARTITION BY currency ORDER BY period ROWS UNBOUNDED PRECEDING),
+               net_change, change_count
+        FROM (
+            SELECT DATEFROMPARTS(YEAR(valued_at), MONTH(valued_at), 1) AS period, currency, SUM(delta) AS net_change,
+                   COUNT(*) AS change_count
+            FROM asset_valuations GROUP BY DATEFROMPARTS(YEAR(valued_at), MONTH(valued_at), 1), currency
+        ) AS d
+        ''',
+        # 通貨が変わった場合は、元の通貨から評価額を除く行と新しい通貨に加える行の2行を追記する
+        '''
+        CREATE OR ALTER TRIGGER trg_assets_valuations ON assets
+        AFTER INSERT, UPDATE, DELETE
+        AS
+        BEGIN
+            SET NOCOUNT ON;
+            DECLARE @now DATETIME2 = GETDATE();
+            DECLARE @rows TABLE (currency CHAR(3), delta DECIMAL(38,2));
+            INSERT INTO asset_valuations (asset_id, op, amount, quantity, currency, value, delta, valued_at)
+            OUTPUT INSERTED.currency, INSERTED.delta INTO @rows
+            SELECT COALESCE(i.id, d.id),
+                   CASE WHEN d.id IS NULL THEN 'I' WHEN i.id IS NULL THEN 'D' ELSE 'U' END,
+                   COALESCE(i.amount, d.amount), COALESCE(i.quantity, d.quantity), COALESCE(i.currency, d.currency),
+                   COALESCE(i.amount * i.quantity, 0),
+                   COALESCE(i.amount * i.quantity, 0)
+                   - CASE WHEN i.id IS NULL OR i.currency = d.currency THEN COALESCE(d.amount * d.quantity, 0) ELSE 0 END,
+                   @now
+            FROM inserted AS i FULL OUTER JOIN deleted AS d ON i.id = d.id
+            WHERE i.id IS NULL OR d.id IS NULL OR i.amount <> d.amount OR i.quantity <> d.quantity OR i.currency <> d.currency
+            UNION ALL
+            SELECT d.id, 'U', d.amount, d.quantity, d.currency, 0, -(d.amount * d.quantity), @now
+            FROM inserted AS i JOIN deleted AS d ON i.id = d.id
+            WHERE i.currency <> d.currency;
+            IF NOT EXISTS (SELECT 1 FROM @rows) RETURN;
+            DECLARE @totals TABLE (currency CHAR(3) PRIMARY KEY, delta DECIMAL(38,2), cnt INT);
+            INSERT INTO @totals (currency, delta, cnt) SELECT currency, SUM(delta), COUNT(*) FROM @rows GROUP BY currency;
+            DECLARE @day DATE = CAST(@now AS DATE);
+            DECLARE @month DATE = DATEFROMPARTS(YEAR(@now), MONTH(@now), 1);
+            UPDATE t SET closing_value = t.closing_value + s.delta, net_change = t.net_change + s.delta,
+                         change_count = t.change_count + s.cnt
+            FROM asset_value_daily AS t WITH (UPDLOCK, HOLDLOCK) JOIN @totals AS s ON t.currency = s.currency
+            WHERE t.period = @day;
+            INSERT INTO asset_value_daily (period, currency, closing_value, net_change, change_count)
+            SELECT @day, s.currency,
+                   COALESCE((SELECT TOP (1) closing_value FROM asset_value_daily WITH (UPDLOCK, HOLDLOCK)
+                             WHERE currency = s.currency AND period < @day ORDER BY period DESC), 0) + s.delta,
+                   s.delta, s.cnt
+            FROM @totals AS s
+            WHERE NOT EXISTS (SELECT 1 FROM asset_value_daily WITH (UPDLOCK, HOLDLOCK)
+                              WHERE period = @day AND currency = s.currency);
+            UPDATE t SET closing_value = t.closing_value + s.delta, net_change = t.net_change + s.delta,
+                         change_count = t.change_count + s.cnt
+            FROM asset_value_monthly AS t WITH (UPDLOCK, HOLDLOCK) JOIN @totals AS s ON t.currency = s.currency
+            WHERE t.period = @month;
+            INSERT INTO asset_value_monthly (period, currency, closing_value, net_change, change_count)
+            SELECT @month, s.currency,
+                   COALESCE((SELECT TOP (1) closing_value FROM asset_value_monthly WITH (UPDLOCK, HOLDLOCK)
+                             WHERE currency = s.currency AND period < @month ORDER BY period DESC), 0) + s.delta,
+                   s.delta, s.cnt
+            FROM @totals AS s
+            WHERE NOT EXISTS (SELECT 1 FROM asset_value_monthly WITH (UPDLOCK, HOLDLOCK)
+                              WHERE period = @month AND currency = s.currency);
+        END
+        ''',
+    ]),
+    (10, 'ポートフォリオの一覧', [
+        # ポートフォリオごとにデータベースを分ける場合（SHARD_URL_TEMPLATE）、既定のデータベースの一覧を正とする
+        '''
+        IF OBJECT_ID('portfolios', 'U') IS NULL
+        CREATE TABLE portfolios (
+            id NVARCHAR(64) NOT NULL PRIMARY KEY,
+            created_at DATETIME2 DEFAULT GETDATE()
+        )
+        ''',
+        "IF NOT EXISTS (SELECT 1 FROM portfolios WHERE id = N'default') INSERT INTO portfolios (id) VALUES (N'default')",
+    ]),
+]
@@ -0,0 +1,184 @@
+import math
+import re
+from decimal import Decimal, InvalidOperation, ROUND_CEILING, ROUND_FLOOR
+from typing import Dict, List, Optional, Tuple
+
+# ISO 4217 の小数点以下の桁数（補助通貨単位）。ここに無い通貨は2桁とする
+CURRENCY_SCALES = {
+    'JPY': 0, 'KRW': 0, 'VND': 0, 'CLP': 0, 'ISK': 0,
+    'USD': 2, 'EUR': 2, 'GBP': 2, 'CNY': 2, 'AUD': 2, 'CAD': 2, 'CHF': 2, 'HKD': 2, 'SGD': 2,
+    'BHD': 3, 'KWD': 3, 'OMR': 3, 'JOD': 3, 'TND': 3,
+}
+
+INT64_MAX = 2 ** 63 - 1
+
+# 従来の形式の列 DECIMAL(15,2) に収まる金額の上限（整数部13桁）
+DECIMAL_LIMIT = Decimal(10) ** 13
+
+# SQLにリテラルとして埋め込む通貨コード
+CURRENCY_CODE = re.compile(r'^[A-Z]{3}$')
+
+# 通貨の列を追加する前の資産（金額はすべて円）の通貨
+DEFAULT_CURRENCY = 'JPY'
+
+
+def currency_scale(currency: str) -> int:
+    return CURRENCY_SCALES.get(currency.upper(), 2)
+
+
+def parse_amount(value) -> Decimal:
+    """入力された金額（数値または数値の文字列）を丸めずに Decimal にする（NaN・無限大を含め、数値でなければ ValueError）"""
+    if isinstance(value, bool) or (isinstance(value, float) and not math.isfinite(value)):
+        raise ValueError('amount は数値で指定してください')
+    try:
+        # floatは最短の10進表記から変換する（0.1 を 0.1000000000000000055... にしない）
+        number = Decimal(repr(value)) if isinstance(value, float) else Decimal(str(value).strip())
+    except (InvalidOperation, ValueError):
+        raise ValueError('amount は数値で指定してください')
+    # 'nan'・'Infinity' などの文字列も Decimal には変換できてしまう
+    if not number.is_finite():
+        raise ValueError('amount は数値で指定してください')
+    return number
+
+
+class MoneyFormat:
+    """金額の保存形式
+
+    currency を指定すると、金額を補助通貨単位の64ビット整数（例: USDなら1.23ドルを123）で保存する形式になる。
+    桁数は資産の通貨（assets.currency）ごとに決まり、currency の資産は scale 桁、それ以外の通貨は
+    CURRENCY_SCALES の桁数で保存する。通貨ごとの合計も同じ桁数の整数になる。
+    集計は整数のまま行い、表示用の値への変換は応答の直前（present_*）で1回だけ行う。
+    currency が None の場合は従来どおり DECIMAL(15,2) の列に保存し、入力の検証と10進表記への正規化だけを行う。
+    default_currency は通貨を指定しない資産の通貨（整数で保存している場合はその通貨）。
+    """
+
+    def __init__(self, currency: Optional[str] = None, scale: Optional[int] = None,
+                 default_currency: Optional[str] = None):
+        self.currency = currency.upper() if currency else None
+        self.default_currency = self.currency or (default_currency or DEFAULT_CURRENCY).upper()
+        self.minor = self.currency is not None
+        self.scale = (currency_scale(self.currency) if scale is None else scale) if self.minor else 2
+        self.divisor = 10 ** self.scale if self.minor else 1
+
+    def describe(self) -> Dict:
+        return {'storage': 'minor' if self.minor else 'decimal', 'currency': self.currency, 'scale': self.scale}
+
+    def scale_of(self, currency: Optional[str] = None) -> int:
+        """currency（省略時は既定の通貨）の金額を保存する桁数"""
+        if not self.minor:
+            return 2
+        code = (currency or self.default_currency).strip().upper()
+        return self.scale if code == self.currency else currency_scale(code)
+
+    def divisor_of(self, currency: Optional[str] = None) -> int:
+        return 10 ** self.scale_of(currency) if self.minor else 1
+
+    def _scale_groups(self) -> Tuple[List[Tuple[List[str], int]], int]:
+        # 桁数が2桁以外の既知の通貨を桁数ごとにまとめる（一覧に無い通貨は2桁）
+        known = set(CURRENCY_SCALES) | {self.currency}
+        groups: Dict[int, List[str]] = {}
+        for code in sorted(code for code in known if CURRENCY_CODE.match(code)):
+            groups.setdefault(self.scale_of(code), []).append(code)
+        return [(codes, scale) for scale, codes in sorted(groups.items()) if scale != 2], 2
+
+    def scale_case(self, column: str, values: Dict[int, str]) -> str:
+        """通貨の列 column から桁数ごとの値 values[桁数] を選ぶSQLのCASE式（SQLite / Azure SQL共通）
+
+        通貨コードは CURRENCY_SCALES と currency だけなので、リテラルとして埋め込む。
+        """
+        groups, default = self._scale_groups()
+        whens = ' '.join(f'WHEN {column} IN ({", ".join(map(repr, codes))}) THEN {values[scale]}' for codes, scale in groups)
+        return f'CASE {whens} ELSE {values[default]} END' if whens else values[default]
+
+    def multiplier_sql(self, column: str = 'currency') -> str:
+        """表示用の値に掛けると保存する値になる倍率（10の桁数乗）を通貨の列から求めるSQLの式"""
+        groups, default = self._scale_groups()
+        return self.scale_case(column, {scale: str(10 ** scale) for scale in {default, *(s for _, s in groups)}})
+
+    def bound_sql(self, value, upper: bool) -> Tuple[str, List]:
+        """絞り込み条件の金額の境界値を、資産の通貨の桁数に合わせて比べるSQLの式とパラメータ"""
+        groups, default = self._scale_groups()
+        scales = [scale for _, scale in groups] + [default]
+        params = [self.to_storage_bound(value, upper, scale) for scale in scales]
+        return self.scale_case('currency', {scale: '?' for scale in scales}), params
+
+    def storage_factors(self, factors: Dict[str, Decimal], currency: str) -> Dict[str, Decimal]:
+        """通貨ごとの換算係数を、保存している値（各通貨の補助通貨単位）から currency の補助通貨単位への係数にする"""
+        if not self.minor:
+            return factors
+        target = self.scale_of(currency)
+        return {code: factor.scaleb(target - self.scale_of(code)) for code, factor in factors.items()}
+
+    def to_storage(self, value, currency: Optional[str] = None):
+        """入力された金額を currency（省略時は既定の通貨）の保存する値に変換する
+
+        数値でない値・NaN・無限大と、補助通貨単位で割り切れない値は ValueError。従来の形式では10進表記の
+        文字列にする（floatを経由すると15桁を超える桁が丸められ、数値でない値はそのまま保存されてしまうため）。
+        """
+        number = parse_amount(value)
+        if not self.minor:
+            if abs(number) >= DECIMAL_LIMIT:
+                raise ValueError('amount が大きすぎます')
+            return format(number, 'f')
+        scale = self.scale_of(currency)
+        minor = number.scaleb(scale)
+        if minor != minor.to_integral_value():
+            raise ValueError(f'amount は小数点以下{scale}桁までで指定してください' if scale
+                             else 'amount は整数で指定してください')
+        if abs(minor) > INT64_MAX:
+            raise ValueError('amount が大きすぎます')
+        return int(minor)
+
+    def to_storage_bound(self, value, upper: bool, scale: int):
+        """絞り込み条件の境界値を scale 桁の保存する値に変換する（下限は切り上げ、上限は切り捨て）"""
+        minor = parse_amount(value).scaleb(scale).to_integral_value(ROUND_FLOOR if upper else ROUND_CEILING)
+        return int(max(-INT64_MAX, min(INT64_MAX, minor)))
+
+    def to_display(self, stored, currency: Optional[str] = None):
+        """保存されている currency（省略時は既定の通貨）の値を表示用の値に変換する"""
+        if not self.minor or stored is None:
+            return stored
+        divisor = self.divisor_of(currency)
+        return stored if divisor == 1 else stored / divisor
+
+    def present_asset(self, asset: Optional[Dict], currency: Optional[str] = None) -> Optional[Dict]:
+        """currency は報告通貨での評価額（一覧で currency を指定した場合の value）の通貨"""
+        if asset is not None and self.minor:
+            asset['amount'] = self.to_display(asset['amount'], asset.get('currency'))
+            if 'value' in asset:
+                asset['value'] = self.to_display(asset['value'], currency)
+        return asset
+
+    def present_assets(self, assets: List[Dict], currency: Optional[str] = None) -> List[Dict]:
+        if self.minor:
+            for asset in assets:
+                self.present_asset(asset, currency)
+        return assets
+
+    def present_summary(self, summary: Dict) -> Dict:
+        if self.minor:
+            currency = summary['currency']
+            summary['total_amount'] = self.to_display(summary['total_amount'], currency)
+            for item in summary['category_summary']:
+                item['total'] = self.to_display(item['total'], currency)
+            for item in summary['currency_summary']:
+                item['total'] = self.to_display(item['total'], item['currency'])
+                item['converted'] = self.to_display(item['converted'], currency)
+            for item in summary.get('portfolios', ()):
+                item['total'] = self.to_display(item['total'], currency)
+        return summary
+
+    def present_history(self, history: Dict) -> Dict:
+        if self.minor:
+            currency = history['currency']
+            history['opening_value'] = self.to_display(history['opening_value'], currency)
+            for point in history['points']:
+                point['value'] = self.to_display(point['value'], currency)
+                point['change'] = self.to_display(point['change'], currency)
+        return history
+
+    def present_changes(self, result: Dict) -> Dict:
+        if self.minor:
+            for change in result['changes']:
+                self.present_asset(change.get('asset'))
+        return result
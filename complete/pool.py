@@ -0,0 +1,194 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+
+class PoolTimeoutError(Exception):
+    """プールから接続を取得できずにタイムアウトした場合の例外"""
+
+
+class _PooledConnection:
+    """プールが管理する接続とそのメタデータ"""
+
+    __slots__ = ('raw', 'created_at', 'last_used_at')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+
+class ConnectionPool:
+    """スレッドごとにチェックアウトする上限付きコネクションプール
+
+    同じスレッド内でネストして取得した場合は同じ接続を返すため、
+    create() から get_by_id() を呼ぶようなケースでも接続は1本で済む。
+    """
+
+    def __init__(self, factory: Callable, max_size: int = 5, timeout: float = 30.0,
+                 recycle: float = 1800.0, ping_interval: float = 30.0,
+                 ping: Optional[Callable] = None):
+        self._factory = factory
+        self._ping = ping
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._local = threading.local()
+        self._size = 0
+        self._in_use = 0
+
+        self._created = 0
+        self._closed = 0
+        self._recycled = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+
+    @contextmanager
+    def connection(self):
+        """接続を取得し、ブロックを抜けたらプールへ返却する"""
+        local = self._local
+        if getattr(local, 'depth', 0) > 0:
+            local.depth += 1
+            try:
+                yield local.pooled.raw
+            finally:
+                local.depth -= 1
+            return
+
+        pooled = self._checkout()
+        local.pooled = pooled
+        local.depth = 1
+        broken = False
+        try:
+            yield pooled.raw
+        except Exception:
+            broken = not self._rollback(pooled)
+            raise
+        finally:
+            local.depth = 0
+            local.pooled = None
+            self._checkin(pooled, broken)
+
+    def _checkout(self) -> _PooledConnection:
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        while True:
+            pooled = None
+            with self._available:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError(
+                            f'{self.timeout}秒以内に接続を取得できませんでした（上限: {self.max_size}）')
+                    waited = True
+                    self._available.wait(remaining)
+                if self._idle:
+                    pooled = self._idle.pop()
+                else:
+                    self._size += 1
+                self._in_use += 1
+
+            # 接続の確立とヘルスチェックはロックの外で行う
+            if pooled is None:
+                try:
+                    pooled = _PooledConnection(self._factory())
+                except Exception:
+                    with self._available:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._available.notify()
+                    raise
+                with self._lock:
+                    self._created += 1
+            elif not self._is_usable(pooled):
+                with self._available:
+                    self._in_use -= 1
+                    self._discard(pooled)
+                    self._available.notify()
+                continue
+
+            with self._lock:
+                self._checkouts += 1
+                if waited:
+                    self._waits += 1
+                    self._wait_time += time.monotonic() - started
+            return pooled
+
+    def _checkin(self, pooled: _PooledConnection, broken: bool):
+        pooled.last_used_at = time.monotonic()
+        with self._available:
+            self._in_use -= 1
+            if broken or self._expired(pooled):
+                self._discard(pooled)
+            else:
+                self._idle.append(pooled)
+            self._available.notify()
+
+    def _is_usable(self, pooled: _PooledConnection) -> bool:
+        """期限切れ・切断済みの接続を検出する"""
+        if self._expired(pooled):
+            with self._lock:
+                self._recycled += 1
+            return False
+        if self._ping and time.monotonic() - pooled.last_used_at > self.ping_interval:
+            try:
+                self._ping(pooled.raw)
+            except Exception:
+                return False
+        return True
+
+    def _expired(self, pooled: _PooledConnection) -> bool:
+        return self.recycle > 0 and time.monotonic() - pooled.created_at > self.recycle
+
+    def _rollback(self, pooled: _PooledConnection) -> bool:
+        """例外発生時に未確定のトランザクションを破棄し、接続が生きているかを返す"""
+        try:
+            pooled.raw.rollback()
+            if self._ping:
+                self._ping(pooled.raw)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, pooled: _PooledConnection):
+        self._size -= 1
+        self._closed += 1
+        try:
+            pooled.raw.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """アイドル状態の接続をすべて閉じる"""
+        with self._available:
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._available.notify_all()
+
+    def stats(self) -> Dict:
+        """プールの利用状況を返す（サイズ調整用）"""
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': round(self._wait_time, 6),
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'closed': self._closed,
+                'recycled': self._recycled,
+            }
@@ -0,0 +1,283 @@
+"""リポジトリが発行するSQLの実行計画の確認と、記録した計画との比較
+
+合成データ（benchmark.py と同じ分布）を投入したデータベースに対して、AssetRepository の公開メソッドを
+一通り呼び出し、発行されたSQLを記録する。記録したSQLごとに実行計画（SQLiteは EXPLAIN QUERY PLAN、
+Azure SQLは SET SHOWPLAN_XML）を求め、大きなテーブルの全件走査と一時的な並べ替えを指摘する。
+
+使い方:
+    python query_plans.py --rows 100000                                   # 計画を表示し、走査・並べ替えを指摘する
+    python query_plans.py --rows 100000 --record query_plans.baseline.json  # 計画を記録する
+    python query_plans.py --rows 100000 --check query_plans.baseline.json   # 記録と比べ、悪化していれば終了コード1
+    python query_plans.py --backend azure --dsn "Driver=...;Server=localhost,1433;..."  # ローカルのSQL Server等
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+# 行数がデータに比例して増えるテーブル（これ以外のテーブルの走査は指摘しない）
+LARGE_TABLES = {'assets', 'asset_changes', 'asset_valuations', 'asset_value_daily', 'asset_search_grams', 'jobs'}
+# リクエストの処理中に呼ばれるメソッド（バックグラウンドジョブや運用コマンドだけで使うものは含まない）
+HOT_METHODS = {
+    'get_by_id', 'get_by_ids', 'list_assets', 'get_summary', 'get_category_totals', 'search', 'get_changes',
+    'get_change_cursor', 'get_value_history', 'create', 'update', 'update_many', 'delete', 'delete_many',
+    'create_job', 'get_job', 'list_jobs', 'cancel_job', 'list_portfolios', 'register_portfolio',
+}
+# SQLを発行しない、または確認の対象にしないメソッド（convert_money_storage は保存形式を変えてしまうため）
+SKIPPED_METHODS = {
+    'get_connection', 'get_read_connection', 'get_pool_stats', 'shared_version', 'close', 'summarize', 'explain',
+    'init_table', 'insert_sample_data', 'convert_money_storage',
+}
+# 計画を求めない文（接続の設定、トランザクションの制御、DDL）
+NOT_EXPLAINED = re.compile(r'\s*(PRAGMA|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|CREATE|DROP|ALTER|EXEC)\b'
+                           r'|\s*SET\s+\w+\s+\w+\s*;?\s*$', re.IGNORECASE)
+
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(.*)$')
+SQLITE_SORT = re.compile(r'^USE TEMP B-TREE FOR (.+)$')
+AZURE_SCAN = re.compile(r'^(Table Scan|Clustered Index Scan|Index Scan) (\w+)')
+
+
+def normalize_sql(sql: str) -> str:
+    """空白をまとめ、件数によって数が変わる ? の並び（IN (?, ?, ...) など）を1つにまとめる"""
+    sql = re.sub(r'\s+', ' ', sql).strip()
+    return re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', sql)
+
+
+def findings(sql: str, plan):
+    """計画の行から、大きなテーブルの走査と一時的な並べ替えを取り出す
+
+    インデックスの順に読む走査（index scan）は LIMIT で打ち切れるため指摘はしないが、絞り込みに使っていた
+    インデックスが使われなくなった場合に気づけるよう、記録との比較には含める。
+    """
+    # SQLiteの計画では別名を付けたテーブルは別名で表示されるため、元のテーブル名に戻す
+    aliases = {alias: table for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+AS)?\s+(\w+)', sql, re.I)}
+    found = set()
+    for line in plan:
+        line = line.strip()
+        kind, table = None, None
+        scan = SQLITE_SCAN.match(line)
+        if scan:
+            kind = 'index scan' if 'USING' in scan.group(2) else 'scan'
+            table = aliases.get(scan.group(1), scan.group(1))
+        scan = AZURE_SCAN.match(line)
+        if scan:
+            kind = 'index scan' if scan.group(1) == 'Index Scan' else 'scan'
+            table = scan.group(2)
+        if table in LARGE_TABLES:
+            found.add(f'{kind}: {table}')
+        sort = SQLITE_SORT.match(line)
+        if sort:
+            found.add(f'sort: {sort.group(1)}')
+        elif line == 'Sort':
+            found.add('sort')
+    return sorted(found)
+
+
+def exercise(repository):
+    """公開メソッドを一通り呼び出す（追加した行は最後に削除する）"""
+    from database import parse_search_terms
+    from money import DEFAULT_CURRENCY
+
+    money = repository.money
+    first = repository.list_assets(51)
+    cursor = (str(first[-1]['created_at']), first[-1]['id'])
+    factors = {money.default_currency: 1, 'USD': 150}
+    repository.list_assets(51, cursor)
+    repository.list_assets(51, None, {'category': '株式'})
+    repository.list_assets(51, cursor, {'category': '株式'})
+    repository.list_assets(51, None, {'min_amount': 1000, 'max_amount': 100000})
+    repository.list_assets(51, None, {'created_from': '2023-01-01', 'created_to': '2023-02-01'})
+    repository.list_assets(51, None, None, factors)
+    for _ in repository.iter_assets({'category': '預金'}, 500, factors):
+        pass
+    repository.get_all(factors)
+    for _ in repository.iter_analytics_rows(5000):
+        pass
+    ids = [asset['id'] for asset in first]
+    repository.get_by_id(ids[0])
+    repository.get_by_ids(ids[:10])
+    repository.has_assets()
+    repository.get_schema_version()
+    repository.get_category_totals()
+    repository.get_summary()
+    repository.verify_category_totals()
+    for query in ('株式', '株式 ベンチマーク', 'サ'):
+        repository.search(parse_search_terms(query), 20, 0)
+
+    since = repository.get_change_cursor()
+    created = repository.create({'name': '計画の確認', 'amount': money.to_storage(1000), 'quantity': 1,
+                                 'description': None, 'category': 'その他', 'currency': DEFAULT_CURRENCY})
+    repository.insert_many([(f'計画の確認{i}', money.to_storage(100 + i), 1, None, 'その他', DEFAULT_CURRENCY)
+                            for i in range(10)])
+    added = [asset['id'] for asset in repository.list_assets(12, None, {'created_from': created['created_at']})]
+    repository.update(created['id'], {'name': '計画の確認', 'amount': money.to_storage(2000), 'quantity': 2,
+                                      'description': '更新', 'category': 'その他', 'currency': DEFAULT_CURRENCY})
+    repository.update_many(added, {'description': '一括更新'})
+    repository.get_changes(since, 100)
+    repository.revalue_assets('1', 'その他', max(added) - 1, 10)
+    repository.delete(created['id'])
+    repository.delete_many([asset_id for asset_id in added if asset_id != created['id']])
+    for granularity in ('day', 'month'):
+        repository.get_value_history(granularity)
+        repository.get_value_history(granularity, '2023-01-01', '2023-12-31', 'USD', factors)
+    repository.compact_changes()
+    repository.rebuild_category_totals()
+    repository.rebuild_value_rollups()
+
+    job = repository.create_job('export', {}, 'query_plans')
+    repository.start_job(job['id'])
+    repository.update_job_progress(job['id'], 1, 1)
+    repository.finish_job(job['id'], 'succeeded', {'rows': 1})
+    repository.cancel_job(repository.create_job('export', {}, 'query_plans')['id'])
+    repository.get_job(job['id'])
+    repository.list_jobs(20)
+    repository.list_jobs(20, active_only=True)
+    repository.delete_jobs(datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+    repository.list_portfolios()
+    repository.register_portfolio('default')
+
+
+def flagged(statement) -> bool:
+    """リクエストの処理中に全件走査・並べ替えを行う文か"""
+    return statement['hot'] and any(not finding.startswith('index scan') for finding in statement['findings'])
+
+
+def inspect(repository):
+    """exercise() で発行された文ごとに計画を求める。戻り値は (文の一覧, 呼び出さなかったメソッド)"""
+    from database import AssetRepository
+    from instrumentation import capture_statements
+
+    with capture_statements() as captured:
+        exercise(repository)
+    statements, seen = [], set()
+    for method, sql, params in captured:
+        key = (method, normalize_sql(sql))
+        if method is None or key in seen or NOT_EXPLAINED.match(sql):
+            continue
+        seen.add(key)
+        plan = repository.explain(sql, params)
+        statements.append({
+            'method': method,
+            'sql': key[1],
+            'hot': method in HOT_METHODS,
+            'plan': plan,
+            'findings': findings(sql, plan),
+        })
+    public = {name for name in dir(AssetRepository) if not name.startswith('_') and callable(getattr(AssetRepository, name))}
+    uncovered = sorted(public - SKIPPED_METHODS - {method for method, _, _ in captured})
+    return statements, uncovered
+
+
+def compare(baseline, statements):
+    """記録と比べ、(悪化, 計画の変化, 記録に無い文, 発行されなくなった文) を返す
+
+    記録に無い走査・並べ替えが増えた文を悪化とする。記録に無い文は、リクエストの処理中に
+    全件走査・並べ替えを行う場合（flagged）だけ悪化とする。
+    """
+    recorded = {(entry['method'], entry['sql']): entry for entry in baseline['statements']}
+    regressions, changed, added = [], [], []
+    for statement in statements:
+        entry = recorded.pop((statement['method'], statement['sql']), None)
+        if entry is None:
+            (regressions if flagged(statement) else added).append(statement)
+            continue
+        new = sorted(set(statement['findings']) - set(entry['findings']))
+        if new:
+            regressions.append(dict(statement, new_findings=new, baseline_plan=entry['plan']))
+        elif statement['plan'] != entry['plan']:
+            changed.append(dict(statement, baseline_plan=entry['plan']))
+    return regressions, changed, added, list(recorded.values())
+
+
+def print_statement(statement, file=sys.stdout):
+    print(f"{'[hot] ' if statement['hot'] else ''}{statement['method']}", file=file)
+    print(f"  {statement['sql']}", file=file)
+    for line in statement['plan']:
+        print(f'    {line}', file=file)
+    for finding in statement.get('new_findings', statement['findings']):
+        print(f'  ! {finding}', file=file)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='リポジトリのSQLの実行計画の確認')
+    parser.add_argument('--backend', choices=['sqlite', 'azure'], default='sqlite')
+    parser.add_argument('--rows', type=int, default=100000, help='合成データの行数')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db', help='SQLiteのファイルパス（省略時は一時ディレクトリ。同じ行数なら再利用する）')
+    parser.add_argument('--dsn', help='--backend azure で使う接続文字列（ローカルのSQL Server / Azure SQL Edge など）')
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--record', metavar='PATH', help='計画をJSONに記録する')
+    modes.add_argument('--check', metavar='PATH', help='記録した計画と比べ、悪化していれば終了コード1')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # database モジュールは読み込み時に接続先を決めるため、先に環境変数を設定する
+    if args.backend == 'azure':
+        if not args.dsn:
+            print('--backend azure には --dsn が必要です', file=sys.stderr)
+            return 2
+        os.environ['DATABASE_URL'] = args.dsn
+    else:
+        db_path = args.db or os.path.join(tempfile.gettempdir(), f'asset_plans_{args.rows}_{args.seed}.db')
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    # 書き込みを別のスレッドで実行すると発行した文を記録できないため、グループコミットは使わない
+    os.environ['GROUP_COMMIT'] = 'false'
+    os.environ.pop('SHARD_URL_TEMPLATE', None)
+    os.environ.pop('DATABASE_READ_URL', None)
+
+    import database
+    from benchmark import seed_database
+    repository = database.repository.get()
+    print(f'データ投入中: {args.rows}行', file=sys.stderr)
+    seed_database(repository, args.rows, args.seed)
+    statements, uncovered = inspect(repository)
+    if uncovered:
+        print(f"呼び出していないメソッド: {', '.join(uncovered)}", file=sys.stderr)
+
+    meta = {'backend': args.backend, 'rows': args.rows, 'sqlite_version': sqlite3.sqlite_version}
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'statements': statements}, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f'{len(statements)}件の文の計画を {args.record} に記録しました')
+        return 0
+    if args.check:
+        with open(args.check, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['meta']['backend'] != args.backend:
+            print(f"記録はバックエンド {baseline['meta']['backend']} のものです", file=sys.stderr)
+            return 2
+        regressions, changed, added, missing = compare(baseline, statements)
+        for title, entries in (('計画が変わった文（走査・並べ替えは増えていない）', changed),
+                               ('記録に無い文', added), ('悪化した文', regressions)):
+            if entries:
+                print(f'== {title}: {len(entries)}件')
+                for statement in entries:
+                    print_statement(statement)
+        for entry in missing:
+            print(f"発行されなくなった文: {entry['method']}: {entry['sql']}", file=sys.stderr)
+        if regressions:
+            print(f'{len(regressions)}件の文で実行計画が悪化しています'
+                  '（意図した変更なら --record で記録し直してください）', file=sys.stderr)
+            return 1
+        print(f'{len(statements)}件の文の実行計画に悪化はありません')
+        return 0
+
+    for statement in statements:
+        print_statement(statement)
+    hot = [statement for statement in statements if flagged(statement)]
+    print(f'{len(statements)}件の文のうち、リクエストの処理中に全件走査・並べ替えを行う文: {len(hot)}件')
+    for statement in hot:
+        print(f"  {statement['method']}: {', '.join(statement['findings'])}: {statement['sql'][:100]}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""ポートフォリオごとのデータベースの分割（シャーディング）
+
+ポートフォリオ（独立した資産の集まり）ごとに別のデータベースを使い、あるポートフォリオへの大量の書き込みが
+他のポートフォリオの書き込みを待たせないようにする（SQLiteはファイル単位でしか書き込めないため）。
+接続先は SHARD_URL_TEMPLATE の {portfolio} をidに置き換えたもので、default のポートフォリオだけは
+DATABASE_URL（分割前からのデータベース）を使う。ポートフォリオの一覧は default のデータベースに持つ。
+
+シャードごとにリポジトリ（接続プール、アドミッション制御の枠、グループコミットのキュー、データバージョン）を持つ。
+リクエストで扱うポートフォリオは set_portfolio / use_portfolio でスレッドごとに選び、ShardedRepository は
+その時点のポートフォリオのリポジトリに呼び出しを振り分ける。
+"""
+import contextlib
+import itertools
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional
+
+import admission
+from config import config
+
+DEFAULT_PORTFOLIO = 'default'
+# ファイル名・データベース名の一部になるため、使える文字を限る
+PORTFOLIO_ID = re.compile(r'^[a-z0-9][a-z0-9_-]{0,63}$')
+
+_local = threading.local()
+
+
+class PortfolioNotFoundError(LookupError):
+    """一覧に無いポートフォリオが指定された"""
+
+
+def normalize_portfolio_id(value) -> str:
+    """ポートフォリオのidを小文字に揃えて検証する（不正な値は ValueError）"""
+    portfolio_id = value.strip().lower() if isinstance(value, str) else None
+    if not portfolio_id or not PORTFOLIO_ID.match(portfolio_id):
+        raise ValueError('portfolio_id は英小文字・数字・-・_ の64文字以内で指定してください')
+    return portfolio_id
+
+
+def current_portfolio() -> str:
+    return getattr(_local, 'portfolio', DEFAULT_PORTFOLIO)
+
+
+def set_portfolio(portfolio_id: Optional[str]):
+    """このスレッドで扱うポートフォリオを設定する（None なら default）"""
+    _local.portfolio = portfolio_id or DEFAULT_PORTFOLIO
+
+
+@contextlib.contextmanager
+def use_portfolio(portfolio_id: str):
+    previous = current_portfolio()
+    set_portfolio(portfolio_id)
+    try:
+        yield
+    finally:
+        set_portfolio(previous)
+
+
+def shard_url(template: str, portfolio_id: str) -> str:
+    # Azure SQLの接続文字列は Driver={...} のように波括弧を含むため、str.format は使わない
+    return template.replace('{portfolio}', portfolio_id)
+
+
+def summarize_portfolios(repository, totals: Dict[str, List[Dict]], currency: Optional[str] = None,
+                         factors: Optional[Dict[str, Decimal]] = None) -> Dict:
+    """ポートフォリオごとの get_category_totals の結果を合算して換算し、ポートフォリオ別の合計を添える"""
+    summary = repository.summarize(itertools.chain.from_iterable(totals.values()), currency, factors)
+    summary['portfolios'] = []
+    for portfolio_id, rows in sorted(totals.items()):
+        part = repository.summarize(rows, currency, factors)
+        summary['portfolios'].append({
+            'portfolio_id': portfolio_id,
+            'total': part['total_amount'],
+            'count': sum(item['count'] for item in part['category_summary']),
+            'unconverted_currencies': part['unconverted_currencies'],
+        })
+    return summary
+
+
+class ShardedRepository:
+    """このスレッドのポートフォリオのリポジトリ（シャード）に呼び出しを振り分けるプロキシ
+
+    シャードは最初に使われた時点で開き（未適用のスキーマの移行もそのとき行う）、以降は開いたままにする。
+    金額の保存形式はすべてのシャードで default と揃える（集計を合算するため）。
+    """
+
+    def __init__(self, primary, template: str, open_repository: Callable[[str], object], max_workers: int = 8):
+        object.__setattr__(self, '_primary', primary)
+        object.__setattr__(self, '_template', template)
+        object.__setattr__(self, '_open', open_repository)
+        object.__setattr__(self, '_max_workers', max(1, max_workers))
+        object.__setattr__(self, '_shards', {DEFAULT_PORTFOLIO: primary})
+        object.__setattr__(self, '_known', {DEFAULT_PORTFOLIO})
+        object.__setattr__(self, '_lock', threading.Lock())
+        object.__setattr__(self, '_executor', None)
+
+    @classmethod
+    def from_config(cls) -> 'ShardedRepository':
+        from database import get_repository, wrap_repository
+
+        def open_repository(url: str):
+            if url.startswith('sqlite:///'):
+                directory = os.path.dirname(url[len('sqlite:///'):])
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+            return wrap_repository(get_repository(url))
+        return cls(wrap_repository(get_repository()), config.SHARD_URL_TEMPLATE, open_repository,
+                   config.SHARD_FANOUT_WORKERS)
+
+    def __getattr__(self, name):
+        return getattr(self.shard(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.shard(), name, value)
+
+    @property
+    def primary(self):
+        return self._primary
+
+    def shard(self, portfolio_id: Optional[str] = None):
+        """ポートフォリオのリポジトリ（省略時はこのスレッドのポートフォリオ）。一覧に無ければ PortfolioNotFoundError"""
+        portfolio_id = portfolio_id or current_portfolio()
+        repository = self._shards.get(portfolio_id)
+        if repository is not None:
+            return repository
+        if portfolio_id not in self._known:
+            # 他のワーカーで作られたポートフォリオもあるため、一覧を読み直して確かめる
+            self._known.update(self._primary.list_portfolios())
+            if portfolio_id not in self._known:
+                raise PortfolioNotFoundError(f'ポートフォリオ {portfolio_id} が見つかりません')
+        with self._lock:
+            repository = self._shards.get(portfolio_id)
+            if repository is None:
+                repository = self._shards[portfolio_id] = self._open_shard(portfolio_id)
+        return repository
+
+    def _open_shard(self, portfolio_id: str):
+        repository = self._open(shard_url(self._template, portfolio_id))
+        expected = self._primary.money
+        if repository.money.describe() != expected.describe():
+            if expected.minor and not repository.money.minor and not repository.has_assets():
+                repository.convert_money_storage(expected.currency, expected.scale)
+            else:
+                repository.close()
+                raise ValueError(f'ポートフォリオ {portfolio_id} の金額の保存形式が default と異なります'
+                                 f'（python manage.py --portfolio {portfolio_id} money convert で揃えてください）')
+        return repository
+
+    def list_portfolios(self) -> List[str]:
+        portfolios = self._primary.list_portfolios()
+        self._known.update(portfolios)
+        return portfolios
+
+    def create_portfolio(self, portfolio_id: str) -> bool:
+        """ポートフォリオを作る（データベースを開いてスキーマを作ってから一覧に加える）。すでにあれば False"""
+        with self._lock:
+            if portfolio_id not in self._shards:
+                self._shards[portfolio_id] = self._open_shard(portfolio_id)
+        created = self._primary.register_portfolio(portfolio_id)
+        self._known.add(portfolio_id)
+        return created
+
+    def fan_out(self, func: Callable, portfolio_ids: Optional[List[str]] = None) -> Dict[str, object]:
+        """各ポートフォリオのリポジトリで func(repository) を並行に実行し、{id: 結果} を返す"""
+        portfolio_ids = self.list_portfolios() if portfolio_ids is None else portfolio_ids
+        repositories = {portfolio_id: self.shard(portfolio_id) for portfolio_id in portfolio_ids}
+        deadline = admission.get_deadline()
+
+        def run(repository):
+            # 呼び出し元のリクエストの期限を引き継ぐ（混み合っているシャードは待たずに断る）
+            admission.set_deadline(deadline)
+            try:
+                return func(repository)
+            finally:
+                admission.set_deadline(None)
+        executor = self._get_executor()
+        futures = {portfolio_id: executor.submit(run, repository) for portfolio_id, repository in repositories.items()}
+        return {portfolio_id: future.result() for portfolio_id, future in futures.items()}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                object.__setattr__(self, '_executor', ThreadPoolExecutor(
+                    max_workers=self._max_workers, thread_name_prefix='shard-fanout'))
+            return self._executor
+
+    def get_portfolio_summary(self, currency: Optional[str] = None,
+                              factors: Optional[Dict[str, Decimal]] = None) -> Dict:
+        """全ポートフォリオのカテゴリ別・通貨別の集計を並行に読み、合算する"""
+        return summarize_portfolios(self._primary, self.fan_out(lambda repository: repository.get_category_totals()),
+                                    currency, factors)
+
+    def get_shard_count(self) -> int:
+        return len(self._shards)
+
+    def close(self):
+        with self._lock:
+            executor = self._executor
+            object.__setattr__(self, '_executor', None)
+            shards = list(self._shards.values())
+        if executor is not None:
+            executor.shutdown(wait=False)
+        for repository in shards:
+            repository.close()
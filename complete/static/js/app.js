@@ -5,12 +5,21 @@ const API_BASE_URL = '/api';
 
 // アプリケーションの状態管理
 let assets = [];
+let nextCursor = null;
+// 差分同期のカーソル（/api/assets/changes）
+let changeCursor = null;
+// 検索中の文字列と、検索結果の次ページのoffset
+let searchQuery = '';
+let searchNextOffset = null;
+let searchTimer = null;
 
 // DOM要素の取得
 const assetForm = document.getElementById('asset-form');
 const assetsTable = document.getElementById('assets-table');
 const assetsTbody = document.getElementById('assets-tbody');
 const refreshButton = document.getElementById('refresh-assets');
+const loadMoreButton = document.getElementById('load-more-assets');
+const searchInput = document.getElementById('search-assets');
 const editModal = document.getElementById('edit-modal');
 const editForm = document.getElementById('edit-form');
 const cancelEditButton = document.getElementById('cancel-edit');
@@ -76,13 +85,119 @@ function hideLoading(element) {
 }
 
 // API通信関数
+async function fetchChangeCursor() {
+    const response = await fetch(`${API_BASE_URL}/assets/changes`);
+    if (!response.ok) {
+        throw new Error('変更履歴の取得に失敗しました');
+    }
+    const data = await response.json();
+    return data.cursor;
+}
+
 async function fetchAssets() {
     try {
+        // 一覧より先にカーソルを取得しておき、取得中の変更も次の差分同期で拾えるようにする
+        changeCursor = await fetchChangeCursor();
         const response = await fetch(`${API_BASE_URL}/assets`);
         if (!response.ok) {
             throw new Error('資産の取得に失敗しました');
         }
-        assets = await response.json();
+        const data = await response.json();
+        // ページング無効時（ASSETS_UNPAGINATED）は配列がそのまま返る
+        assets = Array.isArray(data) ? data : data.items;
+        nextCursor = Array.isArray(data) ? null : data.next_cursor;
+        renderAssets();
+    } catch (error) {
+        showMessage(error.message, 'error');
+    }
+}
+
+async function searchAssets(offset = 0) {
+    try {
+        const params = new URLSearchParams({ q: searchQuery, offset: offset });
+        const response = await fetch(`${API_BASE_URL}/assets/search?${params}`);
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.error || '検索に失敗しました');
+        }
+        const data = await response.json();
+        assets = offset === 0 ? data.items : assets.concat(data.items);
+        searchNextOffset = data.next_offset;
+        nextCursor = null;
+        renderAssets();
+    } catch (error) {
+        showMessage(error.message, 'error');
+    }
+}
+
+async function fetchMoreAssets() {
+    if (searchQuery) {
+        if (searchNextOffset !== null) {
+            await searchAssets(searchNextOffset);
+        }
+        return;
+    }
+    if (!nextCursor) {
+        return;
+    }
+    try {
+        const response = await fetch(`${API_BASE_URL}/assets?cursor=${encodeURIComponent(nextCursor)}`);
+        if (!response.ok) {
+            throw new Error('資産の取得に失敗しました');
+        }
+        const data = await response.json();
+        assets = assets.concat(data.items);
+        nextCursor = data.next_cursor;
+        renderAssets();
+    } catch (error) {
+        showMessage(error.message, 'error');
+    }
+}
+
+function applyChanges(changes) {
+    changes.forEach(change => {
+        const index = assets.findIndex(asset => asset.id === change.id);
+        if (change.op === 'delete') {
+            if (index !== -1) {
+                assets.splice(index, 1);
+            }
+        } else if (index !== -1) {
+            assets[index] = change.asset;
+        } else if (change.op === 'insert') {
+            // 新しい資産は一覧の先頭（作成日時の降順）に入る
+            assets.unshift(change.asset);
+        }
+        // 未取得のページにある資産の更新は、そのページを読み込んだときに反映される
+    });
+}
+
+async function syncChanges() {
+    if (searchQuery) {
+        // 検索中は関連度順の並びが変わりうるため、検索をやり直す
+        await searchAssets();
+        return;
+    }
+    if (changeCursor === null) {
+        await fetchAssets();
+        return;
+    }
+    try {
+        let hasMore = true;
+        while (hasMore) {
+            const response = await fetch(`${API_BASE_URL}/assets/changes?since=${changeCursor}`);
+            if (response.status === 410) {
+                // カーソルが古すぎる場合は一覧ごと取り直す
+                await fetchAssets();
+                return;
+            }
+            if (!response.ok) {
+                throw new Error('変更履歴の取得に失敗しました');
+            }
+            const data = await response.json();
+            applyChanges(data.changes);
+            changeCursor = data.cursor;
+            hasMore = data.has_more;
+        }
         renderAssets();
     } catch (error) {
         showMessage(error.message, 'error');
@@ -154,6 +269,7 @@ async function deleteAsset(assetId) {
 function renderAssets() {
     const tbody = document.getElementById('assets-tbody');
     tbody.innerHTML = '';
+    loadMoreButton.classList.toggle('hidden', searchQuery ? searchNextOffset === null : !nextCursor);
 
     if (assets.length === 0) {
         tbody.innerHTML = `
@@ -229,7 +345,7 @@ async function handleAssetSubmit(event) {
         await createAsset(assetData);
         showMessage('資産を登録しました');
         assetForm.reset();
-        await fetchAssets();
+        await syncChanges();
     } catch (error) {
         showMessage(error.message, 'error');
     }
@@ -251,7 +367,7 @@ async function handleEditSubmit(event) {
         await updateAsset(assetId, assetData);
         showMessage('資産を更新しました');
         handleCancelEdit();
-        await fetchAssets();
+        await syncChanges();
     } catch (error) {
         showMessage(error.message, 'error');
     }
@@ -265,7 +381,7 @@ async function handleDeleteAsset(assetId) {
     try {
         await deleteAsset(assetId);
         showMessage('資産を削除しました');
-        await fetchAssets();
+        await syncChanges();
     } catch (error) {
         showMessage(error.message, 'error');
     }
@@ -281,6 +397,20 @@ function handleCancelEdit() {
     editModal.classList.remove('show');
 }
 
+function handleSearchInput() {
+    // 入力のたびに検索しないよう、入力が止まってから検索する
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(async () => {
+        searchQuery = searchInput.value.trim();
+        searchNextOffset = null;
+        if (searchQuery) {
+            await searchAssets();
+        } else {
+            await fetchAssets();
+        }
+    }, 300);
+}
+
 async function handleRefresh() {
     try {
         await fetchAssets();
@@ -296,6 +426,8 @@ function setupEventListeners() {
     editForm.addEventListener('submit', handleEditSubmit);
     cancelEditButton.addEventListener('click', handleCancelEdit);
     refreshButton.addEventListener('click', handleRefresh);
+    loadMoreButton.addEventListener('click', fetchMoreAssets);
+    searchInput.addEventListener('input', handleSearchInput);
 
     // モーダルの外側をクリックした時に閉じる
     editModal.addEventListener('click', (event) => {
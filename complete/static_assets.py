@@ -0,0 +1,142 @@
+"""静的ファイルのフィンガープリントと事前圧縮
+
+static/ 以下のCSS・JavaScriptを内容のハッシュを含む名前（css/style.3f2a9c1b7d4e.css）で static/dist/ に
+書き出し、あわせてgzip（Brotliのモジュールがあればbrもあわせて）で圧縮したファイルを作る。
+名前が内容ごとに変わるため、ブラウザには1年間キャッシュさせ（immutable）、再検証させない。
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+from typing import Dict, Optional
+
+from flask import Response, request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BUILD_DIR = 'dist'
+MANIFEST = 'manifest.json'
+EXTENSIONS = ('.css', '.js')
+# 圧縮する価値のある大きさの下限（バイト）
+MIN_COMPRESS_SIZE = 256
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def fingerprint(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _write_atomic(path: str, data: bytes, overwrite: bool = False):
+    # 複数のプロセスが同時にビルドしても、書きかけのファイルを配信しないようにする
+    if not overwrite and os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def build(static_folder: str) -> Dict[str, Dict]:
+    """static_folder 以下のCSS・JavaScriptをフィンガープリント付きの名前で書き出し、マニフェストを返す
+
+    内容が変わらなければ同じ名前になるため、既にあるファイルは書き直さない。
+    """
+    manifest = {}
+    build_root = os.path.join(static_folder, BUILD_DIR)
+    for root, dirs, files in os.walk(static_folder):
+        # 書き出したファイルはビルドの対象にしない
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != build_root)
+        for name in sorted(files):
+            if not name.endswith(EXTENSIONS):
+                continue
+            source = os.path.join(root, name)
+            logical = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            stem, ext = os.path.splitext(logical)
+            hashed = f'{BUILD_DIR}/{stem}.{fingerprint(data)}{ext}'
+            path = os.path.join(static_folder, hashed)
+            encodings = []
+            _write_atomic(path, data)
+            if len(data) >= MIN_COMPRESS_SIZE:
+                if brotli is not None:
+                    _write_atomic(path + '.br', brotli.compress(data, quality=11))
+                    encodings.append('br')
+                # mtime=0 にして、同じ内容からは同じ圧縮ファイルができるようにする
+                _write_atomic(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+                encodings.append('gzip')
+            manifest[logical] = {'path': hashed, 'encodings': encodings}
+    _write_atomic(os.path.join(build_root, MANIFEST),
+                  json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'), overwrite=True)
+    return manifest
+
+
+def negotiate(encodings) -> Optional[str]:
+    """Accept-Encoding から、事前圧縮したファイルのうち使えるものを選ぶ（br を優先する）"""
+    for encoding in encodings:
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+class PageCache:
+    """描画したHTMLを、gzipで圧縮した本文とETagとあわせてメモリに保持する
+
+    テンプレートは起動後に変わらないため、Jinjaでの描画はキーごとに1回だけ行う。
+    """
+
+    def __init__(self, render):
+        self._render = render
+        self._pages = {}
+
+    def response(self, key=None) -> Response:
+        page = self._pages.get(key)
+        if page is None:
+            html = self._render().encode('utf-8')
+            page = self._pages[key] = (html, gzip.compress(html, mtime=0), fingerprint(html))
+        html, compressed, etag = page
+        encoding = negotiate(('gzip',))
+        response = Response(compressed if encoding else html, mimetype='text/html')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(f'{etag}-{encoding}' if encoding else etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+
+def init_app(app):
+    """静的ファイルをビルドし、url_for('static', ...) がフィンガープリント付きの名前を返すようにする"""
+    manifest = build(app.static_folder)
+    hashed = {entry['path']: entry for entry in manifest.values()}
+
+    @app.url_defaults
+    def fingerprinted_static(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]['path']
+
+    def static(filename):
+        entry = hashed.get(filename)
+        if entry is None:
+            return app.send_static_file(filename)
+        path = os.path.join(app.static_folder, filename)
+        encoding = negotiate(entry['encodings'])
+        mimetype = mimetypes.guess_type(filename)[0]
+        response = send_file(path + {'br': '.br', 'gzip': '.gz'}[encoding] if encoding else path,
+                             mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE, conditional=True)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions['static'] = static
+    return manifest
@@ -0,0 +1,48 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Iterable, Iterator
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+JSON_MIMETYPE = 'application/json'
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} はJSONに変換できません')
+
+
+def encode_row(row: Dict) -> str:
+    """1行分をJSON文字列に変換する"""
+    return json.dumps(row, ensure_ascii=False, default=_default)
+
+
+def ndjson_stream(rows: Iterable[Dict]) -> Iterator[str]:
+    """1行ごとに改行区切りのJSON（NDJSON）を送り出す"""
+    for row in rows:
+        yield encode_row(row) + '\n'
+
+
+def json_array_stream(rows: Iterable[Dict], chunk_rows: int = 100) -> Iterator[str]:
+    """JSON配列を数行ずつまとめたチャンクとして送り出す"""
+    yield '['
+    buffer = []
+    first = True
+    for row in rows:
+        buffer.append(encode_row(row))
+        if len(buffer) >= chunk_rows:
+            yield ('' if first else ',') + ','.join(buffer)
+            first = False
+            buffer = []
+    if buffer:
+        yield ('' if first else ',') + ','.join(buffer)
+    yield ']'
+
+
+STREAM_FORMATS = {
+    'ndjson': (ndjson_stream, NDJSON_MIMETYPE),
+    'json': (json_array_stream, JSON_MIMETYPE),
+}